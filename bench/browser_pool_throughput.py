@@ -0,0 +1,82 @@
+# bench/browser_pool_throughput.py
+'''
+Compare pages/minute of `load_page_playwright_stealth` launching a browser per page against loading through a
+`browser_pool` (warm browsers, images/fonts/media blocked)
+
+Serves local static fixtures from a stand-in aiohttp server: HTML pages each referencing a few images & a web
+font, served after a simulated delay, so blocking those resources shows up in the figures too.
+Requires playwright & playwright_stealth, with Chromium installed (`playwright install chromium`).
+
+Usage:
+    python browser_pool_throughput.py
+    python browser_pool_throughput.py --pages=500 --size=4 --pages_per_browser=4 --baseline_pages=10
+'''
+import time
+import asyncio
+
+import fire
+from aiohttp import web
+
+from arkestra.components.website import load_page_playwright_stealth, browser_pool
+
+IMAGES_PER_PAGE = 4
+IMAGE_SIZE = 200_000
+FONT_SIZE = 100_000
+
+
+def make_app(delay):
+    async def page(request):
+        n = request.match_info['n']
+        imgs = ''.join(f'<img src="/img/{n}-{i}.png">' for i in range(IMAGES_PER_PAGE))
+        html = (f'<html><head><style>@font-face {{font-family: f; src: url(/font/{n}.woff2)}}'
+                f' body {{font-family: f}}</style></head><body><h1>Page {n}</h1>{imgs}'
+                + '<p>lorem ipsum dolor sit amet</p>' * 200 + '</body></html>')
+        return web.Response(text=html, content_type='text/html')
+
+    async def asset(request):
+        await asyncio.sleep(delay)
+        size = FONT_SIZE if request.path.startswith('/font') else IMAGE_SIZE
+        return web.Response(body=b'\0' * size, content_type='application/octet-stream')
+
+    app = web.Application()
+    app.router.add_get('/page/{n}', page)
+    app.router.add_get('/img/{name}', asset)
+    app.router.add_get('/font/{name}', asset)
+    return app
+
+
+def report(label, count, elapsed):
+    print(f'{label:>36}: {count} pages in {elapsed:.2f}s -> {count / elapsed * 60:,.0f} pages/min')
+
+
+async def async_main(pages, size, pages_per_browser, page_budget, delay, baseline_pages):
+    runner = web.AppRunner(make_app(delay), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    urls = [f'http://127.0.0.1:{port}/page/{n}' for n in range(pages)]
+
+    # Baseline: browser launched & closed per page, everything downloaded
+    start = time.perf_counter()
+    for url in urls[:baseline_pages]:
+        await load_page_playwright_stealth(url)
+    report('browser per page', baseline_pages, time.perf_counter() - start)
+
+    for label, block in (('pool, all resources', ()), ('pool, images/fonts/media blocked', None)):
+        kwargs = {} if block is None else {'block_resources': block}
+        async with browser_pool(size=size, pages_per_browser=pages_per_browser, page_budget=page_budget,
+                                **kwargs) as pool:
+            start = time.perf_counter()
+            await asyncio.gather(*(pool.load_page(url) for url in urls))
+            report(f'{label} ({size}x{pages_per_browser})', pages, time.perf_counter() - start)
+
+    await runner.cleanup()
+
+
+def main(pages=200, size=2, pages_per_browser=4, page_budget=50, delay=0.01, baseline_pages=10):
+    asyncio.run(async_main(pages, size, pages_per_browser, page_budget, delay, baseline_pages))
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
@@ -0,0 +1,68 @@
+# bench/extract_text.py
+'''
+Compare page text extraction throughput (MB/s of HTML) of the web_scrape/extract_text cookbook's original pipeline
+(minify -> selectolax decompose -> link markers -> re-serialize -> inscriptis -> regex) against `extract_text`
+
+Uses the synthetic page corpus from `html_to_markdown.py`, or pass a directory of .html files.
+Requires inscriptis & minify_html for the cookbook pipeline.
+
+Usage:
+    python extract_text.py
+    python extract_text.py --pages=50 --sections=400
+    python extract_text.py --corpus_dir=~/scrapes/html
+'''
+import re
+import sys
+import time
+import random
+from pathlib import Path
+
+import fire
+from minify_html import minify
+from inscriptis import get_text
+try:
+    from selectolax.lexbor import LexborHTMLParser as HTMLParser
+except ImportError:  # selectolax < 1.0
+    from selectolax.parser import HTMLParser
+
+sys.path.insert(0, str(Path(__file__).parent))
+from html_to_markdown import make_page  # noqa: E402
+
+from arkestra.components.website import extract_text  # noqa: E402
+
+LINK_MARKER_PAT = re.compile(r'\[LINK_START:(.*?)\](.*?)\[LINK_END\]')
+
+
+def cookbook_extract(html):
+    '''The cookbook's original process_text'''
+    html = minify(html)
+    tree = HTMLParser(html)
+    for tag in ('script', 'style'):
+        for elem in tree.css(tag):
+            elem.decompose()
+    for a_tag in tree.css('a'):
+        href = a_tag.attributes.get('href', '')
+        if href:
+            a_tag.insert_before(f'[LINK_START:{href}]')
+            a_tag.insert_after('[LINK_END]')
+    text = get_text(tree.html)
+    return LINK_MARKER_PAT.sub(r'[\2](\1)', text)
+
+
+def main(pages=20, sections=200, corpus_dir=None):
+    if corpus_dir:
+        corpus = [f.read_text(errors='replace') for f in sorted(Path(corpus_dir).expanduser().glob('*.html'))]
+    else:
+        rnd = random.Random(42)
+        corpus = [make_page(rnd, sections) for _ in range(pages)]
+    total_mb = sum(len(html.encode('utf-8')) for html in corpus) / 2**20
+    print(f'Corpus: {len(corpus)} pages, {total_mb:.1f} MB')
+    for label, extract in (('cookbook pipeline', cookbook_extract), ('extract_text', extract_text)):
+        start = time.perf_counter()
+        chars = sum(len(extract(html)) for html in corpus)
+        elapsed = time.perf_counter() - start
+        print(f'{label:>18}: {total_mb / elapsed:6.2f} MB/s ({chars / len(corpus):,.0f} chars of text per page)')
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
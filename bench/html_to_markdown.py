@@ -0,0 +1,78 @@
+# bench/html_to_markdown.py
+'''
+Compare HTML to Markdown conversion by markdownify against `html_to_markdown` (single selectolax tree walk), on
+throughput (MB/s of HTML) & peak Python memory per page (tracemalloc)
+
+The corpus is synthetic pages shaped like scraped articles (nav, scripts, headings, paragraphs with links &
+emphasis, lists, tables), or pass a directory of .html files. Note tracemalloc only sees Python allocations,
+not selectolax's own (C) parse tree, which is about the size of the page.
+
+Usage:
+    python html_to_markdown.py
+    python html_to_markdown.py --pages=50 --sections=400
+    python html_to_markdown.py --corpus_dir=~/scrapes/html
+'''
+import time
+import random
+import string
+import tracemalloc
+from pathlib import Path
+
+import fire
+from markdownify import markdownify
+
+from arkestra.components.website import html_to_markdown
+
+
+def make_page(rnd, sections):
+    words = [''.join(rnd.choices(string.ascii_lowercase, k=rnd.randint(2, 10))) for _ in range(500)]
+
+    def sentence(n=12):
+        return ' '.join(rnd.choices(words, k=n))
+
+    parts = ['<html><head><title>Article</title><script>' + 'var x = 1;' * 200 + '</script>'
+             '<style>' + '.c { color: red }' * 100 + '</style></head><body>',
+             '<nav><ul>' + ''.join(f'<li><a href="/n{i}">{sentence(2)}</a></li>' for i in range(30)) + '</ul></nav>']
+    for s in range(sections):
+        parts.append(f'<h2 id="s{s}">{sentence(4)}</h2>')
+        for _ in range(3):
+            parts.append(f'<p>{sentence()} <a href="https://example.com/{s}">{sentence(3)}</a> {sentence()}'
+                         f' <strong>{sentence(2)}</strong> <em>{sentence(2)}</em> {sentence()}</p>')
+        if s % 5 == 0:
+            parts.append('<ul>' + ''.join(f'<li>{sentence(6)}</li>' for _ in range(5)) + '</ul>')
+        if s % 10 == 0:
+            parts.append('<table>' + ''.join('<tr>' + f'<td>{sentence(1)}</td>' * 4 + '</tr>' for _ in range(5))
+                         + '</table>')
+    parts.append('<footer>' + sentence() + '</footer></body></html>')
+    return ''.join(parts)
+
+
+def measure(convert, corpus):
+    start = time.perf_counter()
+    for html in corpus:
+        convert(html)
+    elapsed = time.perf_counter() - start
+    peak = 0
+    for html in corpus:
+        tracemalloc.start()
+        convert(html)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+def main(pages=20, sections=200, corpus_dir=None):
+    if corpus_dir:
+        corpus = [f.read_text(errors='replace') for f in sorted(Path(corpus_dir).expanduser().glob('*.html'))]
+    else:
+        rnd = random.Random(42)
+        corpus = [make_page(rnd, sections) for _ in range(pages)]
+    total_mb = sum(len(html.encode('utf-8')) for html in corpus) / 2**20
+    print(f'Corpus: {len(corpus)} pages, {total_mb:.1f} MB')
+    for label, convert in (('markdownify', markdownify), ('html_to_markdown', html_to_markdown)):
+        elapsed, peak = measure(convert, corpus)
+        print(f'{label:>18}: {total_mb / elapsed:6.2f} MB/s, peak {peak / 2**20:6.1f} MB per page')
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
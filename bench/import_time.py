@@ -0,0 +1,69 @@
+# bench/import_time.py
+'''
+Import time gate for Arkestra modules which worker processes load at startup
+
+For each module, runs `python -X importtime -c "import <module>"` in fresh interpreters, takes the best
+cumulative time of several runs, & checks it against a budget. Also checks that heavy optional dependencies,
+which these modules import lazily on first use, weren't imported. Exits non-zero on any regression, so it can
+gate CI. Modules whose own (required) dependencies aren't installed are skipped.
+
+Usage:
+    python import_time.py
+    python import_time.py --runs=10 --budget_scale=2   # e.g. on a slow CI runner
+'''
+import re
+import sys
+import subprocess
+
+import fire
+
+# module -> (budget in ms, heavy dependencies which must not be imported with it)
+BUDGETS = {
+    'arkestra.components.website': (200, ['playwright', 'playwright_stealth', 'aiohttp', 'httpx', 'markdownify',
+                                          'bs4', 'selectolax']),
+    'arkestra.metrics.textdiff_dataviz': (150, ['seaborn', 'matplotlib', 'pandas', 'plotly', 'numpy']),
+}
+
+IMPORTTIME_PAT = re.compile(r'import time:\s+\d+ \|\s+(\d+) \| (\S+)')
+
+
+def import_ms(module):
+    '''Cumulative import time of module in a fresh interpreter, in ms, or None if it can't be imported'''
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        return None
+    for line in proc.stderr.splitlines():
+        m = IMPORTTIME_PAT.match(line)
+        if m and m.group(2) == module:
+            return int(m.group(1)) / 1000
+    return None
+
+
+def eager_imports(module, heavy):
+    '''Which of the heavy modules importing module pulls in'''
+    code = f'import sys, {module}; print(",".join(m for m in {heavy!r} if m in sys.modules))'
+    proc = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    return [m for m in proc.stdout.strip().split(',') if m]
+
+
+def main(runs=5, budget_scale=1.0):
+    failed = False
+    for module, (budget, heavy) in BUDGETS.items():
+        times = [import_ms(module) for _ in range(runs)]
+        if None in times:
+            print(f'{module}: SKIPPED (not importable here)')
+            continue
+        best = min(times)
+        limit = budget * budget_scale
+        eager = eager_imports(module, heavy)
+        ok = best <= limit and not eager
+        failed = failed or not ok
+        print(f'{module}: {best:.1f} ms (budget {limit:.0f} ms){"" if ok else "  FAIL"}')
+        if eager:
+            print(f'    imported eagerly: {", ".join(eager)}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
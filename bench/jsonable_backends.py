@@ -0,0 +1,66 @@
+# bench/jsonable_backends.py
+'''
+Compare `jsonable` save/load throughput (MB/s of uncompressed JSON) for each installed serialization backend,
+with & without compression
+
+Uses a synthetic artifact shaped like scraped-page records (nested dicts, text, numbers). Backends are
+whichever of orjson, msgspec & the stdlib are installed; zstd rows need zstandard.
+
+Usage:
+    python jsonable_backends.py
+    python jsonable_backends.py --records=200000 --repeat=5
+'''
+import time
+import random
+import string
+import tempfile
+from pathlib import Path
+
+import fire
+
+from arkestra.components.fileio import jsonable, BACKENDS, zstandard
+
+
+def make_records(count):
+    rnd = random.Random(42)
+    words = [''.join(rnd.choices(string.ascii_lowercase, k=rnd.randint(2, 10))) for _ in range(2000)]
+    return [{
+        'id': i,
+        'url': f'https://example.com/{rnd.choice(words)}/{i}',
+        'title': ' '.join(rnd.choices(words, k=8)),
+        'text': ' '.join(rnd.choices(words, k=200)),
+        'score': rnd.random(),
+        'tags': rnd.choices(words, k=5),
+        'meta': {'status': 200, 'fetched': True, 'lang': 'en'},
+    } for i in range(count)]
+
+
+def best_time(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(records=50000, repeat=3):
+    data = make_records(records)
+    suffixes = ['.json', '.jsonl', '.json.gz'] + (['.json.zst'] if zstandard else [])
+    print(f'{"backend":>8} {"file":>10} {"save MB/s":>10} {"load MB/s":>10} {"size MB":>9}')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        raw_size = None
+        for suffix in suffixes:
+            for name in BACKENDS:
+                artifact = jsonable(Path(tmpdir) / f'bench{suffix}', backend=name)
+                save_time = best_time(lambda: artifact.save(data), repeat)
+                load_time = best_time(artifact.load, repeat)
+                if raw_size is None:
+                    raw_size = artifact.full_path.stat().st_size / 1e6  # Uncompressed reference size
+                size = artifact.full_path.stat().st_size / 1e6
+                print(f'{name:>8} {suffix:>10} {raw_size / save_time:>10.1f} {raw_size / load_time:>10.1f} '
+                      f'{size:>9.1f}')
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
@@ -0,0 +1,81 @@
+# bench/load_pages_throughput.py
+'''
+Compare page fetch throughput (pages/sec) of a one-URL-at-a-time loop, with a fresh aiohttp session per page
+(how `load_page_aiohttp` used to be called for crawls), against the `load_pages` bulk loader
+
+Runs against a local aiohttp stand-in server which serves synthetic HTML pages after a simulated delay, and
+fails a fraction of requests with 503 to exercise retries. The stand-in is a single host, so by default the
+per-host politeness limit is lifted; pass e.g. --rate=50 to see it take effect.
+
+Usage:
+    python load_pages_throughput.py
+    python load_pages_throughput.py --pages=2000 --concurrency=100 --delay=0.05 --error_rate=0.05
+'''
+import time
+import random
+import asyncio
+
+import fire
+import aiohttp
+from aiohttp import web
+
+from arkestra.components.website import load_pages, http_pool
+
+
+def make_app(delay, error_rate, page_size):
+    rnd = random.Random(42)
+    body = ('<html><body>' + '<p>lorem ipsum dolor sit amet</p>' * (page_size // 30) + '</body></html>').encode()
+
+    async def page(request):
+        await asyncio.sleep(delay)
+        if rnd.random() < error_rate:
+            return web.Response(status=503, headers={'Retry-After': '0'})
+        return web.Response(body=body, content_type='text/html')
+
+    app = web.Application()
+    app.router.add_get('/page/{n}', page)
+    return app
+
+
+async def async_main(pages, concurrency, delay, error_rate, page_size, rate, baseline_pages):
+    runner = web.AppRunner(make_app(delay, error_rate, page_size), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    urls = [f'http://127.0.0.1:{port}/page/{n}' for n in range(pages)]
+
+    # Baseline: sequential, new session (so new connection) per page, no retries
+    baseline_urls = urls[:baseline_pages]
+    start = time.perf_counter()
+    ok = 0
+    for url in baseline_urls:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url) as resp:
+                await resp.read()
+                ok += resp.status == 200
+    elapsed = time.perf_counter() - start
+    print(f'{"sequential, fresh session":>28}: {ok}/{len(baseline_urls)} ok in {elapsed:.2f}s'
+          f' -> {len(baseline_urls) / elapsed:,.1f} pages/sec')
+
+    http_pool.limit_per_host = concurrency  # Everything goes to the one stand-in host
+    start = time.perf_counter()
+    ok = retried = 0
+    async for result in load_pages(urls, concurrency=concurrency, per_host_rate=rate, per_host_burst=concurrency,
+                                   backoff=0.01):
+        ok += result.error is None
+        retried += result.attempts > 1
+    elapsed = time.perf_counter() - start
+    print(f'{f"load_pages ({concurrency})":>28}: {ok}/{pages} ok ({retried} retried) in {elapsed:.2f}s'
+          f' -> {pages / elapsed:,.1f} pages/sec')
+
+    await http_pool.close()
+    await runner.cleanup()
+
+
+def main(pages=1000, concurrency=50, delay=0.02, error_rate=0.02, page_size=20000, rate=None, baseline_pages=200):
+    asyncio.run(async_main(pages, concurrency, delay, error_rate, page_size, rate, baseline_pages))
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
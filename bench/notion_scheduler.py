@@ -0,0 +1,136 @@
+# bench/notion_scheduler.py
+'''
+Exercise the Notion request scheduler (`arkestra.components.prompt.notion.request_scheduler`) against a local
+stand-in for the Notion API which, like Notion, allows an average of 3 requests/sec & answers anything over
+with 429 & a Retry-After header. It also fails a fraction of requests with 503.
+
+Several loaders sync their DBs at once at background priority, then, part way through, one more loader does a
+startup-critical load. Compares:
+* unthrottled: requests go straight out, no retries (how `pages()` used to behave)
+* scheduled, FIFO: the shared scheduler, but the critical load at the same priority as the rest
+* scheduled: the shared scheduler, critical load at critical priority
+
+Usage:
+    python notion_scheduler.py
+    python notion_scheduler.py --loaders=8 --pages_per_db=500 --error_rate=0.05
+'''
+import time
+import random
+import asyncio
+
+import fire
+import httpx
+from aiohttp import web
+
+from arkestra.components.prompt import notion
+from arkestra.components.prompt.notion import (notion_loom_loader, request_scheduler, PRIORITY_CRITICAL,
+                                               PRIORITY_BACKGROUND)
+
+EDITED = '2026-01-01T00:00:00.000Z'
+
+
+class mock_notion:
+    '''Stand-in Notion API: DB retrieve & query endpoints, rate limited by a token bucket'''
+    def __init__(self, pages_per_db, error_rate, rate=3.0, burst=3):
+        self.pages_per_db = pages_per_db
+        self.error_rate = error_rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.rnd = random.Random(42)
+        self.counts = {'ok': 0, 429: 0, 503: 0}
+
+    def limited(self):
+        '''Response to send instead of serving the request, if any'''
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            self.counts[429] += 1
+            retry_after = (1 - self.tokens) / self.rate
+            return web.json_response({'object': 'error', 'code': 'rate_limited'}, status=429,
+                                     headers={'Retry-After': f'{retry_after:.2f}'})
+        self.tokens -= 1
+        if self.rnd.random() < self.error_rate:
+            self.counts[503] += 1
+            return web.json_response({'object': 'error', 'code': 'service_unavailable'}, status=503)
+        self.counts['ok'] += 1
+        return None
+
+    async def database(self, request):
+        return self.limited() or web.json_response(
+            {'object': 'database', 'id': request.match_info['id'], 'last_edited_time': EDITED})
+
+    async def query(self, request):
+        resp = self.limited()
+        if resp:
+            return resp
+        db_id = request.match_info['id']
+        body = await request.json()
+        start = int(body.get('start_cursor') or 0)
+        end = min(start + body['page_size'], self.pages_per_db)
+        results = [{
+            'object': 'page', 'id': f'{db_id}-{i}', 'last_edited_time': EDITED,
+            'properties': {
+                'Name': {'title': [{'plain_text': f'prompt_{i}'}]},
+                'Prompt': {'rich_text': [{'text': {'content': f'Prompt {i} about {{topic}}'}}]},
+                'Markers': {'rich_text': [{'plain_text': 'topic'}]},
+            }} for i in range(start, end)]
+        more = end < self.pages_per_db
+        return web.json_response({'object': 'list', 'results': results, 'has_more': more,
+                                  'next_cursor': str(end) if more else None})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/v1/databases/{id}', self.database)
+        app.router.add_post('/v1/databases/{id}/query', self.query)
+        return app
+
+
+async def run(label, scheduler, critical_priority, loaders, pages_per_db, error_rate, critical_delay):
+    server = mock_notion(pages_per_db, error_rate)
+    runner = web.AppRunner(server.app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    notion.NOTION_API = f'http://127.0.0.1:{port}/v1'
+
+    async with httpx.AsyncClient() as client:
+        def loader(db_id):
+            return notion_loom_loader(db_id, 'token', 'Name', 'Prompt', 'Markers', cache_dir=None, client=client,
+                                      scheduler=scheduler)
+
+        async def timed(db_id, priority):
+            start = time.perf_counter()
+            try:
+                loom = await loader(db_id).sync(priority=priority)
+                return time.perf_counter() - start, len(loom) == pages_per_db
+            except RuntimeError:  # The module's error for a failed request
+                return time.perf_counter() - start, False
+
+        start = time.perf_counter()
+        background = [asyncio.create_task(timed(f'db{n}', PRIORITY_BACKGROUND)) for n in range(loaders)]
+        await asyncio.sleep(critical_delay)
+        critical_time, critical_ok = await timed('critical', critical_priority)
+        results = await asyncio.gather(*background)
+        elapsed = time.perf_counter() - start
+    await runner.cleanup()
+
+    ok = sum(good for _, good in results) + critical_ok
+    print(f'{label:>17}: {ok}/{loaders + 1} DBs loaded in {elapsed:5.2f}s; critical load'
+          f' {"ok" if critical_ok else "FAILED"} in {critical_time:5.2f}s;'
+          f' server saw {server.counts["ok"]} ok, {server.counts[429]} x 429, {server.counts[503]} x 503')
+
+
+def main(loaders=4, pages_per_db=300, error_rate=0.02, critical_delay=0.5):
+    opts = (loaders, pages_per_db, error_rate, critical_delay)
+    unthrottled = request_scheduler(rate=1e9, burst=1e9, retries=0)
+    asyncio.run(run('unthrottled', unthrottled, PRIORITY_CRITICAL, *opts))
+    asyncio.run(run('scheduled, FIFO', request_scheduler(), PRIORITY_BACKGROUND, *opts))
+    asyncio.run(run('scheduled', request_scheduler(), PRIORITY_CRITICAL, *opts))
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
@@ -0,0 +1,60 @@
+# bench/obj_schema_validation.py
+'''
+Compare validation throughput (objects/sec) for LLM-style JSON outputs:
+
+* baseline: `json.loads` then `pyd_mod(**data)`, as `obj_schema.validate_json` used to do
+* validate_json on raw bytes, via the cached TypeAdapter
+* validate_many over the whole batch
+
+Usage:
+    python obj_schema_validation.py
+    python obj_schema_validation.py --count=200000
+'''
+import json
+import time
+import random
+
+import fire
+from pydantic import BaseModel
+
+from arkestra.components.obj_schema import validate_json, validate_many
+
+
+class research_step(BaseModel):
+    query: str
+    rationale: str
+    priority: int
+
+
+class research_plan(BaseModel):
+    topic: str
+    research_steps: list[research_step]
+    confidence: float
+
+
+def make_payloads(count):
+    rnd = random.Random(42)
+    return [json.dumps({
+        'topic': f'topic {i}',
+        'research_steps': [{'query': f'q{i}-{j}', 'rationale': 'because ' * 5, 'priority': j}
+                           for j in range(rnd.randint(2, 6))],
+        'confidence': rnd.random(),
+    }).encode('utf-8') for i in range(count)]
+
+
+def timed(label, count, func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f'{label:>28}: {count / elapsed:>10,.0f} objects/sec')
+
+
+def main(count=50000):
+    payloads = make_payloads(count)
+    timed('json.loads + model(**data)', count, lambda: [research_plan(**json.loads(p)) for p in payloads])
+    timed('validate_json (raw bytes)', count, lambda: [validate_json(p, research_plan) for p in payloads])
+    timed('validate_many', count, lambda: validate_many(payloads, research_plan))
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
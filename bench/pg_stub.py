@@ -0,0 +1,81 @@
+# bench/pg_stub.py
+'''
+Minimal in-process stand-in for an asyncpg connection pool, for benchmarking job managers without a PostgreSQL server
+
+Each call which would be a network round trip to PostgreSQL sleeps for `latency` seconds, and `executemany`
+additionally pays `per_row` seconds per row, as a rough model of asyncpg's pipelined batch execution.
+The stand-in doesn't parse SQL; it only keeps enough state to hand out sequential IDs, and reports the job table
+as not yet existing.
+'''
+import asyncio
+import itertools
+
+from arkestra.jobs.pg_manager import JOB_TABLE_INFO_SQL
+
+
+class stub_transaction:
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def __aenter__(self):
+        await self.conn.round_trip()  # BEGIN
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.conn.round_trip()  # COMMIT/ROLLBACK
+
+
+class stub_connection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def round_trip(self, rows=0):
+        self.pool.round_trips += 1
+        await asyncio.sleep(self.pool.latency + rows * self.pool.per_row)
+
+    def transaction(self):
+        return stub_transaction(self)
+
+    async def execute(self, sql, *args):
+        await self.round_trip(1)
+
+    async def executemany(self, sql, args):
+        args = list(args)
+        await self.round_trip(len(args))
+
+    async def fetchrow(self, sql, *args):
+        await self.round_trip(1)
+        if sql == JOB_TABLE_INFO_SQL:
+            return {'exists': False, 'partitioned': False, 'json_type': None}
+        return {'id': next(self.pool.ids)}
+
+    async def fetch(self, sql, count=1, *args):
+        await self.round_trip(count)
+        return [{'id': next(self.pool.ids)} for _ in range(count)]
+
+
+class stub_acquire:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def __aenter__(self):
+        await self.pool.sem.acquire()
+        return stub_connection(self.pool)
+
+    async def __aexit__(self, *exc):
+        self.pool.sem.release()
+
+
+class stub_pool:
+    '''
+    Connection pool stand-in; `size` caps concurrent connections, as with a real pool
+    '''
+    def __init__(self, size=10, latency=0.0005, per_row=0.000005):
+        self.latency = latency
+        self.per_row = per_row
+        self.sem = asyncio.Semaphore(size)
+        self.ids = itertools.count(1)
+        self.round_trips = 0
+
+    def acquire(self):
+        return stub_acquire(self)
@@ -0,0 +1,40 @@
+# cookbook/web_scrape/extract_text/main.py
+import fire
+
+import httpx
+import tiktoken
+
+from toolio import load_or_connect, response_text
+
+from arkestra.components.prompt import load_loom
+from arkestra.components.website import extract_text
+
+LANG = load_loom('lang.toml')
+
+
+async def async_main(url, model='mlx-community/Mistral-Nemo-Instruct-2407-4bit', max_token_count=7000):
+    llm = load_or_connect(model)
+    with open('product.schema.json') as fp:
+        schema = fp.read()
+
+    async with httpx.AsyncClient() as client:
+        resp = await client.get(url)
+        text = extract_text(resp.content)
+
+    encoding = tiktoken.get_encoding("cl100k_base")  # Token encoding
+    tokens = encoding.encode(text)  # Encode text into tokens
+    token_count = len(tokens)
+    print(token_count)
+
+    if token_count > max_token_count:
+        print(f'Input text {token_count} tokens is larger than the set maximum.')
+        return
+
+    msgs = [{'role': 'user', 'content': LANG['product_extract'].format(webpage_text=text)}]
+    print('Handing page over to the LLM for analysis')
+    rt = await response_text(llm.complete(msgs, json_schema=schema, max_tokens=2048))
+    print(rt)
+
+
+if __name__ == '__main__':
+    fire.Fire(async_main)
@@ -5,25 +5,687 @@
 '''
 Common components for data pipelines & orchestration
 '''
+import io
+import os
+import gzip
 import json
-# from pathlib import Path
+import math
+import mmap
+import time
+import hashlib
+import tempfile
+from array import array
+from pathlib import Path
 
-# TODO: JSON streamer alternatives
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+JSON_LINES_SUFFIXES = ('.jsonl', '.ndjson')
+COMPRESSION_SUFFIXES = {'.gz': 'gzip', '.zst': 'zstd'}
+ENDS_ITEMSIZE = array('Q').itemsize  # record_store index entry size
+CHUNK_SIZE = 1 << 16  # Characters to read at a time when streaming
+JSON_WHITESPACE = ' \t\n\r'
+JSON_DELIMITERS = ',]' + JSON_WHITESPACE
+
+
+class json_backend:
+    '''
+    JSON serialization backend. dumps returns UTF-8 bytes; loads accepts bytes or str
+    '''
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+def _non_finite(obj):
+    '''True if obj has a NaN or infinite float anywhere in it'''
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_non_finite(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_non_finite(v) for v in obj)
+    return False
+
+
+def _orjson_dumps(obj):
+    # Non-str keys are stringified, as by the stdlib. Fall back to the stdlib for anything else orjson rejects
+    # (e.g. integers beyond 64 bits), so switching backends never changes what can be saved
+    try:
+        data = orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    except TypeError:
+        return _stdlib_dumps(obj)
+    # orjson writes NaN & Infinity as null. Only look for them if there's a null they might have become
+    if b'null' in data and _non_finite(obj):
+        return _stdlib_dumps(obj)
+    return data
+
+
+def _orjson_loads(data):
+    # orjson rejects the NaN & Infinity the stdlib writes
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return json.loads(data)
+
+
+def _msgspec_dumps(obj):
+    try:
+        data = msgspec.json.encode(obj)
+    except TypeError:
+        return _stdlib_dumps(obj)
+    if b'null' in data and _non_finite(obj):
+        return _stdlib_dumps(obj)
+    return data
+
+
+def _msgspec_loads(data):
+    try:
+        return msgspec.json.decode(data)
+    except msgspec.DecodeError:
+        return json.loads(data)
+
+
+BACKENDS = {'json': json_backend('json', _stdlib_dumps, json.loads)}
+if msgspec is not None:
+    BACKENDS['msgspec'] = json_backend('msgspec', _msgspec_dumps, _msgspec_loads)
+if orjson is not None:
+    BACKENDS['orjson'] = json_backend('orjson', _orjson_dumps, _orjson_loads)
+# Fastest available first
+DEFAULT_BACKEND = BACKENDS.get('orjson') or BACKENDS.get('msgspec') or BACKENDS['json']
+
+
+def get_backend(backend=None):
+    '''
+    Resolve a backend name ('orjson', 'msgspec' or 'json') or object; None means the fastest installed
+    '''
+    if backend is None:
+        return DEFAULT_BACKEND
+    if isinstance(backend, json_backend):
+        return backend
+    try:
+        return BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f'JSON backend {backend!r} unknown or not installed. Available: {list(BACKENDS)}')
 
 
 class jsonable:
     '''
     On-disk file which can be read or written as JSON
+
+    Besides loading or saving whole objects, the file can be streamed, keeping memory bounded regardless of file
+    size. It's treated as a sequence of records: either items of a top-level JSON array, or, in JSON Lines mode,
+    one JSON value per line. JSON Lines mode is the default for .jsonl & .ndjson files, or set it with `lines`.
+
+    Serialization uses the fastest installed backend (orjson, then msgspec, then the stdlib) unless `backend`
+    says otherwise. Files ending .gz or .zst (e.g. pages.jsonl.zst) are gzip or zstd compressed (the latter
+    requires zstandard). Saves write to a temp file & then rename it into place, so a crash mid-write never
+    leaves a truncated artifact.
+
+    >>> from arkestra.components.fileio import jsonable
+    >>> artifact = jsonable(Path('pages.jsonl'), jobid=jobid)
+    >>> artifact.save_iter({'url': u, 'md': md} for u, md in scraped())
+    >>> artifact.append({'url': url, 'md': md})
+    >>> for page in artifact.iter_items():
+    ...     print(page['url'])
     '''
-    def __init__(self, full_path, jobid=None):
+    def __init__(self, full_path, jobid=None, lines=None, backend=None):
         self.jobid = jobid
-        self.full_path = full_path
+        self.full_path = Path(full_path)
+        suffixes = self.full_path.suffixes
+        self.compression = COMPRESSION_SUFFIXES.get(suffixes[-1]) if suffixes else None
+        if self.compression:
+            suffixes = suffixes[:-1]
+        if lines is None:
+            lines = bool(suffixes) and suffixes[-1] in JSON_LINES_SUFFIXES
+        self.lines = lines
+        self.backend = get_backend(backend)
 
     def load(self):
-        with self.full_path.open() as fp:
-            obj = json.load(fp)
+        '''
+        Load the whole file. In JSON Lines mode, returns the list of records
+        '''
+        if self.lines:
+            return list(self.iter_items())
+        with open_compressed(self.full_path, 'rb', self.compression) as fp:
+            obj = self.backend.loads(fp.read())
         return obj
 
     def save(self, obj):
-        with self.full_path.open('w') as fp:
-            obj = json.dump(obj, fp)
+        '''
+        Save a whole object. In JSON Lines mode, obj must be a sequence of records
+        '''
+        if self.lines:
+            self.save_iter(obj)
+            return
+        with atomic_writer(self.full_path, self.compression) as fp:
+            fp.write(self.backend.dumps(obj))
+
+    def iter_items(self):
+        '''
+        Lazily yield each record: each item of the top-level array, or each line in JSON Lines mode
+        '''
+        with open_compressed(self.full_path, 'rb', self.compression) as fp:
+            if self.lines:
+                loads = self.backend.loads
+                for line in fp:
+                    if line.strip():
+                        yield loads(line)
+            else:
+                yield from iter_json_array(io.TextIOWrapper(fp, encoding='utf-8'))
+
+    def save_iter(self, items):
+        '''
+        Write records from any iterable (e.g. a generator) as they're produced, replacing the file
+        '''
+        dumps = self.backend.dumps
+        with atomic_writer(self.full_path, self.compression) as fp:
+            if self.lines:
+                for item in items:
+                    fp.write(dumps(item))
+                    fp.write(b'\n')
+                return
+            fp.write(b'[')
+            sep = b''
+            for item in items:
+                fp.write(sep)
+                fp.write(dumps(item))
+                sep = b','
+            fp.write(b']')
+
+    def append(self, record):
+        '''
+        Add a record at the end of the file, without rewriting the rest (a new file is created if needed).
+        Compressed files can only be appended to in JSON Lines mode
+        '''
+        if self.lines:
+            with open_compressed(self.full_path, 'ab', self.compression) as fp:
+                fp.write(self.backend.dumps(record) + b'\n')
+            return
+        if not self.full_path.exists() or self.full_path.stat().st_size == 0:
+            self.save_iter([record])
+            return
+        if self.compression:
+            raise ValueError('Appending to a compressed JSON array isn\'t supported; use JSON Lines')
+        with self.full_path.open('r+b') as fp:
+            # Find the array's closing bracket & whatever precedes it, scanning back past whitespace
+            close_pos = _prev_non_whitespace(fp, fp.seek(0, os.SEEK_END))
+            if close_pos is None or _byte_at(fp, close_pos) != b']':
+                raise ValueError(f'{self.full_path} doesn\'t end with a JSON array')
+            before = _prev_non_whitespace(fp, close_pos)
+            empty = before is not None and _byte_at(fp, before) == b'['
+            fp.seek(close_pos)
+            fp.truncate()
+            fp.write((b'' if empty else b',') + self.backend.dumps(record) + b']')
+
+
+class record_store:
+    '''
+    JSON Lines file plus an offset index, for random access to individual records or slices without parsing the
+    rest of the file. Reads go through `mmap`, so seeking to record N costs the same however large the file.
+
+    The index lives alongside the data, at the same path plus `.idx`, as one native-endian uint64 per record: the
+    offset just past its end. An existing JSON Lines file without an index can be indexed with `reindex`.
+
+    >>> from arkestra.components.fileio import record_store
+    >>> store = record_store('embeddings.jsonl')
+    >>> store.extend({'chunk': c, 'vec': v} for c, v in embedded())
+    >>> store[1_234_567]
+    >>> store[1000:1010]
+    '''
+    def __init__(self, full_path, jobid=None, backend=None):
+        self.jobid = jobid
+        self.full_path = Path(full_path)
+        self.index_path = self.full_path.with_name(self.full_path.name + '.idx')
+        self.backend = get_backend(backend)
+        self._data_map = None
+        self._index_map = None
+        self._ends = None
+
+    def append(self, record):
+        self.extend([record])
+
+    def extend(self, records):
+        '''
+        Append records from any iterable, updating the index as it goes
+        '''
+        self.close()  # Drop the maps, which no longer cover the whole file
+        dumps = self.backend.dumps
+        ends = array('Q')
+        with open(self.full_path, 'ab') as data_fp, open(self.index_path, 'ab') as index_fp:
+            offset = data_fp.tell()
+            for record in records:
+                line = dumps(record) + b'\n'
+                data_fp.write(line)
+                offset += len(line)
+                ends.append(offset)
+                if len(ends) >= 4096:
+                    # Data first, so the index never points past what's been written
+                    data_fp.flush()
+                    ends.tofile(index_fp)
+                    ends = array('Q')
+            data_fp.flush()
+            ends.tofile(index_fp)
+
+    def reindex(self):
+        '''
+        (Re)build the index by scanning the data file
+        '''
+        self.close()
+        ends = array('Q')
+        offset = 0
+        with open(self.full_path, 'rb') as fp:
+            for line in fp:
+                offset += len(line)
+                if line.strip():
+                    ends.append(offset)
+        with atomic_writer(self.index_path) as fp:
+            ends.tofile(fp)
+
+    def _open(self):
+        if self._ends is not None:
+            return
+        data_size = self.full_path.stat().st_size if self.full_path.exists() else 0
+        index_size = self.index_path.stat().st_size if self.index_path.exists() else 0
+        if not data_size or not index_size:
+            self._ends = ()
+            return
+        with open(self.full_path, 'rb') as fp:
+            self._data_map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(self.index_path, 'rb') as fp:
+            self._index_map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        count = index_size // ENDS_ITEMSIZE
+        ends = memoryview(self._index_map)[:count * ENDS_ITEMSIZE].cast('Q')
+        # Ignore index entries past the data, e.g. from a crash mid-write
+        while count and ends[count - 1] > data_size:
+            count -= 1
+        self._ends = ends[:count]
+
+    def close(self):
+        '''
+        Release the memory maps. They're reopened as needed
+        '''
+        if isinstance(self._ends, memoryview):
+            self._ends.release()
+        self._ends = None
+        for m in (self._data_map, self._index_map):
+            if m is not None:
+                m.close()
+        self._data_map = self._index_map = None
+
+    def __len__(self):
+        self._open()
+        return len(self._ends)
+
+    def _record_bytes(self, n):
+        start = self._ends[n - 1] if n else 0
+        return self._data_map[start:self._ends[n]]
+
+    def __getitem__(self, key):
+        self._open()
+        if isinstance(key, slice):
+            return [self.backend.loads(self._record_bytes(n)) for n in range(*key.indices(len(self._ends)))]
+        if key < 0:
+            key += len(self._ends)
+        if not 0 <= key < len(self._ends):
+            raise IndexError('record index out of range')
+        return self.backend.loads(self._record_bytes(key))
+
+    def __iter__(self):
+        self._open()
+        loads = self.backend.loads
+        for n in range(len(self._ends)):
+            yield loads(self._record_bytes(n))
+
+
+class artifact_cache:
+    '''
+    Content-addressed on-disk cache of pipeline stage outputs, so re-running a pipeline can skip stages (scraping,
+    embedding, etc.) whose inputs haven't changed
+
+    An artifact's key is a hash of the stage name, its params & the keys (or content hashes) of its upstream
+    artifacts, so a change anywhere upstream changes every key downstream. If max_bytes is set, the least
+    recently used artifacts are evicted to keep the cache within it. Artifacts are stored via `jsonable`, so
+    writes are atomic & the backend & compression options apply (e.g. compression='zstd').
+
+    >>> from arkestra.components.fileio import artifact_cache
+    >>> cache = artifact_cache('/var/cache/pipeline', max_bytes=10 * 2**30)
+    >>> pages, pages_key = cache.cached('scrape', {'urls': urls}, lambda: scrape(urls), jobid=jobid)
+    >>> vecs, _ = cache.cached('embed', {'model': model}, lambda: embed(pages), upstream=[pages_key])
+    '''
+    def __init__(self, root, max_bytes=None, backend=None, compression=None):
+        self.root = Path(root).expanduser()
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.backend = backend
+        self.suffix = '.json' + {None: '', 'gzip': '.gz', 'zstd': '.zst'}[compression]
+        self._total_bytes = None  # Computed on first need
+
+    def key(self, stage, params=None, upstream=()):
+        '''
+        Cache key for the output of stage run with params (JSON-able) on the given upstream artifact keys/hashes
+        '''
+        h = hashlib.sha256()
+        h.update(json.dumps([stage, params, list(upstream)], sort_keys=True, separators=(',', ':'),
+                            default=str).encode('utf-8'))
+        return h.hexdigest()
+
+    def path(self, key):
+        # Fan out into subdirectories, to keep directories small
+        return self.root / key[:2] / (key + self.suffix)
+
+    def _meta_path(self, key):
+        return self.root / key[:2] / (key + '.meta.json')
+
+    def _paths(self, key):
+        return self.path(key), self._meta_path(key)
+
+    def get(self, key, default=None):
+        '''
+        Cached artifact for key, or default if absent. Counts as a use, for eviction purposes
+        '''
+        fpath = self.path(key)
+        try:
+            obj = jsonable(fpath, backend=self.backend).load()
+        except FileNotFoundError:
+            return default
+        try:
+            os.utime(fpath)
+        except FileNotFoundError:
+            pass  # Evicted by another process meanwhile; we already have the content
+        return obj
+
+    def __contains__(self, key):
+        return self.path(key).exists()
+
+    def info(self, key):
+        '''
+        Metadata recorded with the artifact (stage, jobid & creation time), or None if absent
+        '''
+        try:
+            return jsonable(self._meta_path(key), backend='json').load()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, obj, stage=None, jobid=None):
+        '''
+        Store an artifact under key, recording the stage & ID of the job which produced it
+        '''
+        fpath = self.path(key)
+        fpath.parent.mkdir(exist_ok=True)
+        old_size = total_size(self._paths(key))
+        jsonable(fpath, jobid=jobid, backend=self.backend).save(obj)
+        jsonable(self._meta_path(key), backend='json').save({'stage': stage, 'jobid': jobid, 'created': time.time()})
+        if self._total_bytes is not None:
+            self._total_bytes += total_size(self._paths(key)) - old_size
+        self.evict()
+
+    def cached(self, stage, params, compute, upstream=(), jobid=None):
+        '''
+        Return (artifact, key) for stage, calling compute() to produce & cache the artifact only on a miss
+        '''
+        key = self.key(stage, params, upstream)
+        obj = self.get(key, _MISSING)
+        if obj is _MISSING:
+            obj = compute()
+            self.put(key, obj, stage=stage, jobid=jobid)
+        return obj, key
+
+    def evict(self):
+        '''
+        Remove least recently used artifacts until the cache is within max_bytes
+        '''
+        if self.max_bytes is None:
+            return
+        if self._total_bytes is None:
+            self._total_bytes = sum(size for _, _, size in lru_entries(self.root, self.suffix, self._paths))
+        if self._total_bytes > self.max_bytes:
+            self._total_bytes = evict_lru(self.root, self.suffix, self._paths, self.max_bytes)
+
+
+def lru_entries(root, suffix, paths):
+    '''
+    Scan a cache directory laid out as root/<fan-out subdir>/<key><suffix>, each entry possibly with sidecar
+    files (e.g. <key>.meta.json). paths(key) gives all of an entry's files, the one ending in suffix first; its
+    mtime marks the entry's last use. Returns [(last use, key, total size of the entry's files)], least recently
+    used first. Sidecars are never taken for entries, even if they also end in suffix
+    '''
+    entries = []
+    for fpath in root.glob('*/*' + suffix):
+        if fpath.name.endswith('.meta.json') or fpath.name.startswith('.'):  # Sidecar or in-progress write
+            continue
+        key = fpath.name[:-len(suffix)]
+        try:
+            mtime = fpath.stat().st_mtime
+        except FileNotFoundError:
+            continue  # Removed by another process meanwhile
+        entries.append((mtime, key, total_size(paths(key))))
+    entries.sort()
+    return entries
+
+
+def evict_lru(root, suffix, paths, max_bytes):
+    '''
+    Remove least recently used entries of a cache directory (laid out as for `lru_entries`) until it's within
+    max_bytes. Rescans the directory, since other processes may share it. Returns the total size remaining
+    '''
+    entries = lru_entries(root, suffix, paths)
+    total = sum(size for _, _, size in entries)
+    for _, key, size in entries:
+        if total <= max_bytes:
+            break
+        for fpath in paths(key):
+            try:
+                fpath.unlink()
+            except FileNotFoundError:
+                pass
+        total -= size
+    return total
+
+
+def total_size(fpaths):
+    '''
+    Combined size of the files which exist among fpaths
+    '''
+    size = 0
+    for fpath in fpaths:
+        try:
+            size += fpath.stat().st_size
+        except FileNotFoundError:
+            pass
+    return size
+
+
+def file_hash(fpath, chunk_size=1 << 20):
+    '''
+    SHA-256 hex digest of a file's contents, e.g. for an upstream artifact produced outside the cache
+    '''
+    h = hashlib.sha256()
+    with open(fpath, 'rb') as fp:
+        while chunk := fp.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+_MISSING = object()
+
+
+def open_compressed(fpath, mode, compression=None):
+    '''
+    Open a file in binary mode ('rb', 'wb' or 'ab'), (de)compressing transparently if compression is
+    'gzip' or 'zstd'
+    '''
+    if compression is None:
+        return open(fpath, mode)
+    if compression == 'gzip':
+        return gzip.open(fpath, mode)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError('Requires zstandard. Possible fix: `pip install zstandard`')
+        raw = open(fpath, mode)
+        if mode == 'rb':
+            # Appends add frames, so read across them. Buffer for line iteration
+            return io.BufferedReader(
+                zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True))
+        return zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+    raise ValueError(f'Unknown compression {compression!r}')
+
+
+class atomic_writer:
+    '''
+    Context manager for writing a file via a temp file in the same directory, renamed over the target only
+    once fully written & synced. On error the target is untouched & the temp file removed
+    '''
+    def __init__(self, fpath, compression=None):
+        self.fpath = Path(fpath)
+        self.compression = compression
+
+    def __enter__(self):
+        fd, self.tmp_path = tempfile.mkstemp(dir=self.fpath.parent, prefix=f'.{self.fpath.name}.', suffix='.tmp')
+        self.raw = os.fdopen(fd, 'wb')
+        if self.compression == 'gzip':
+            self.fp = gzip.GzipFile(fileobj=self.raw, mode='wb')
+        elif self.compression == 'zstd':
+            if zstandard is None:
+                self.raw.close()
+                os.unlink(self.tmp_path)
+                raise ImportError('Requires zstandard. Possible fix: `pip install zstandard`')
+            self.fp = zstandard.ZstdCompressor().stream_writer(self.raw, closefd=False)
+        else:
+            self.fp = self.raw
+        return self.fp
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self.fp is not self.raw:
+                self.fp.close()  # Flushes the compressor; leaves raw open
+            if exc_type is None:
+                self.raw.flush()
+                os.fsync(self.raw.fileno())
+        finally:
+            self.raw.close()
+        if exc_type is None:
+            # mkstemp creates files private to the user; give the artifact the permissions a plain open() would
+            try:
+                mode = self.fpath.stat().st_mode & 0o777
+            except FileNotFoundError:
+                mode = 0o666 & ~_current_umask()
+            os.chmod(self.tmp_path, mode)
+            os.replace(self.tmp_path, self.fpath)
+        else:
+            os.unlink(self.tmp_path)
+        return False
+
+
+def _current_umask():
+    '''
+    The process umask, read when needed rather than cached, since it can change
+    '''
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except OSError:
+        pass
+    # Elsewhere there's no way to read it without setting it
+    mask = os.umask(0o22)
+    os.umask(mask)
+    return mask
+
+
+def iter_json_array(fp, chunk_size=CHUNK_SIZE):
+    '''
+    Lazily yield the items of a top-level JSON array read from a text file-like object.
+    Only the item being parsed (plus a chunk) is held in memory at a time
+    '''
+    decoder = json.JSONDecoder()
+    buf, pos, eof = '', 0, False
+    state = 'start'  # then 'first' (just after '['), 'value' (just after ','), 'after_value'
+    read_size = chunk_size
+    while True:
+        while pos < len(buf) and buf[pos] in JSON_WHITESPACE:
+            pos += 1
+        if pos == len(buf):
+            if eof:
+                raise ValueError('Unexpected end of JSON array')
+            chunk = fp.read(read_size)
+            eof = not chunk
+            buf, pos = chunk, 0
+            continue
+
+        c = buf[pos]
+        if state == 'start':
+            if c != '[':
+                raise ValueError('Top-level JSON value isn\'t an array')
+            pos += 1
+            state = 'first'
+            continue
+        if state == 'after_value' or (state == 'first' and c == ']'):
+            if c == ']':
+                return
+            if c != ',':
+                raise ValueError(f'Expected "," or "]" in JSON array, got {c!r}')
+            pos += 1
+            state = 'value'
+            continue
+
+        try:
+            obj, end = decoder.raw_decode(buf, pos)
+            # A value cut off by the end of the buffer (e.g. a number) might continue in the next chunk, so only
+            # trust it once it's followed by a delimiter
+            complete = eof or (end < len(buf) and buf[end] in JSON_DELIMITERS)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            complete = False
+        if not complete:
+            chunk = fp.read(read_size)
+            eof = not chunk
+            buf, pos = buf[pos:] + chunk, 0
+            # Grow reads for big items, so re-parsing them stays linear overall
+            read_size = max(read_size, len(buf))
+            continue
+        yield obj
+        pos = end
+        state = 'after_value'
+        read_size = chunk_size
+        if pos > chunk_size:
+            buf, pos = buf[pos:], 0
+
+
+def _byte_at(fp, offset):
+    fp.seek(offset)
+    return fp.read(1)
+
+
+def _prev_non_whitespace(fp, end):
+    '''
+    Offset of the last non-whitespace byte before offset end, or None
+    '''
+    while end > 0:
+        start = max(0, end - 4096)
+        fp.seek(start)
+        block = fp.read(end - start)
+        stripped = block.rstrip(JSON_WHITESPACE.encode('ascii'))
+        if stripped:
+            return start + len(stripped) - 1
+        end = start
+    return None
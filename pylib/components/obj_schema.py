@@ -5,17 +5,257 @@
 '''
 Common components for object schema (basically Pydantic)
 '''
-# from pathlib import Path
+import json
+import types
+import typing
+import collections.abc
+from functools import lru_cache
 
-from pydantic import ValidationError
+from pydantic import TypeAdapter, ValidationError
+
+JSON_WHITESPACE = ' \t\n\r'
+LIST_TYPES = (list, collections.abc.Sequence, collections.abc.MutableSequence)
+
+
+@lru_cache(maxsize=None)
+def type_adapter(pyd_mod):
+    '''
+    Compiled validator for a Pydantic model (or any type Pydantic supports), built once per type & reused
+    '''
+    return TypeAdapter(pyd_mod)
 
 
 def validate_json(data, pyd_mod):
     '''
     Validate a Python object structure (presumably deserialized fromJSON) & convert to a provided Pydantic model
+
+    data can also be raw JSON (str or bytes), which is parsed & validated in one pass, skipping the
+    intermediate dict
+    '''
+    adapter = type_adapter(pyd_mod)
+    if isinstance(data, (str, bytes, bytearray)):
+        return adapter.validate_json(data)
+    return adapter.validate_python(data)
+
+
+def validate_many(payloads, pyd_mod):
+    '''
+    Validate each of an iterable (e.g. a list or generator) of payloads, raw JSON or deserialized, against a
+    Pydantic model. Returns (successes, failures): successes as a list of (index, model instance),
+    failures as a list of (index, structured errors, as from ValidationError.errors())
+
+    >>> from arkestra.components.obj_schema import validate_many
+    >>> ok, bad = validate_many(llm_outputs, research_plan)
+    >>> for i, errors in bad:
+    ...     print(i, errors[0]['loc'], errors[0]['msg'])
+    '''
+    adapter = type_adapter(pyd_mod)
+    successes = []
+    failures = []
+    for i, data in enumerate(payloads):
+        try:
+            if isinstance(data, (str, bytes, bytearray)):
+                successes.append((i, adapter.validate_json(data)))
+            else:
+                successes.append((i, adapter.validate_python(data)))
+        except ValidationError as e:
+            failures.append((i, e.errors(include_url=False)))
+    return successes, failures
+
+
+def _list_item_type(annotation):
+    '''
+    Item type of a list annotation, e.g. list[X], Sequence[X], Optional[list[X]] or list[X] | None -> X.
+    Any for an unparameterized list; None if the annotation isn't a list
+    '''
+    origin = typing.get_origin(annotation)
+    if origin is typing.Annotated:
+        return _list_item_type(typing.get_args(annotation)[0])
+    if origin in (typing.Union, types.UnionType):
+        options = [a for a in typing.get_args(annotation) if a is not type(None)]
+        return _list_item_type(options[0]) if len(options) == 1 else None
+    if annotation in LIST_TYPES:
+        return typing.Any
+    if origin in LIST_TYPES:
+        return typing.get_args(annotation)[0]
+    if origin is tuple:
+        args = typing.get_args(annotation)
+        if len(args) == 2 and args[1] is Ellipsis:  # tuple[X, ...]
+            return args[0]
+    return None
+
+
+class _frame:
+    '''An open JSON object or array, while scanning'''
+    __slots__ = ('kind', 'expect_key', 'key')
+
+    def __init__(self, kind):
+        self.kind = kind  # '{' or '['
+        self.expect_key = kind == '{'
+        self.key = None  # Key of the member value currently being scanned, for objects
+
+
+class incremental_validator:
     '''
-    try:
-        validated_data = pyd_mod(**data)
-        return validated_data
-    except ValidationError as e:
-        raise e
+    Incremental JSON parser & validator for streamed LLM structured output
+
+    Feed it text chunks (e.g. tokens) as they arrive. Each item of the list field named by stream_field is
+    validated as soon as it closes & returned from `feed`, so work can start on e.g. the first research step while
+    the LLM is still generating the rest. An item failing validation raises ValidationError right away, so the
+    generation can be aborted early. `close` validates the complete object against the whole model.
+    Any text before the JSON starts or after it ends (e.g. Markdown code fences) is ignored.
+
+    Each chunk is scanned once, & only the text of the root JSON value is kept (for `close`), so the cost is
+    linear in the length of the stream however it's chunked.
+
+    >>> from arkestra.components.obj_schema import incremental_validator
+    >>> validator = incremental_validator(research_plan, 'research_steps')
+    >>> async for step in validator.aiter_items(llm_token_stream):
+    ...     asyncio.create_task(run_step(step))
+    >>> plan = validator.result
+    '''
+    def __init__(self, pyd_mod, stream_field=None, item_type=None):
+        self.pyd_mod = pyd_mod
+        self.stream_field = stream_field
+        self.item_adapter = None
+        if stream_field:
+            if item_type is None:
+                annotation = pyd_mod.model_fields[stream_field].annotation
+                item_type = _list_item_type(annotation)
+                if item_type is None:
+                    raise ValueError(f'Field {stream_field!r} of {pyd_mod.__name__} isn\'t a list ({annotation}); '
+                                     'pass item_type')
+            self.item_adapter = type_adapter(item_type)
+        self.result = None
+        self._root_chunks = []  # Text of the root JSON value, so far
+        self._started = False
+        self._done = False  # Root value closed
+        self._stack = []
+        self._target = None  # frame of the stream_field list, once open
+        self._in_string = False
+        self._escape = False
+        self._capture = None  # Earlier chunks' pieces of the top-level key or stream_field item being scanned
+        self._capture_key = False
+        self._cap = None  # Where the capture starts in the current chunk
+
+    @property
+    def text(self):
+        '''
+        Text of the JSON value scanned so far
+        '''
+        return ''.join(self._root_chunks)
+
+    def feed(self, chunk):
+        '''
+        Scan the next chunk of text, returning a list of the stream_field items completed by it, validated
+        '''
+        if self._done:
+            return []  # Trailing text
+        stack = self._stack
+        emitted = []
+        root_start = 0 if self._started else None
+        root_end = len(chunk)
+        self._cap = None if self._capture is None else 0
+        i = 0
+        while i < len(chunk):
+            c = chunk[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == '\\':
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._capture_key and self._cap is not None:
+                        stack[-1].key = json.loads(self._take(chunk, i + 1))
+            elif not self._started:
+                if c in '{[':
+                    self._started = True
+                    root_start = i
+                    continue  # Rescan as the root value
+            elif c == '"':
+                self._in_string = True
+                if stack[-1].kind == '{' and stack[-1].expect_key:
+                    if len(stack) == 1:  # Only top-level keys are needed, to find stream_field
+                        self._start_capture(i, key=True)
+                else:
+                    self._value_start(i)
+            elif c in '{[':
+                self._value_start(i)
+                frame = _frame(c)
+                if (c == '[' and len(stack) == 1 and stack[0].kind == '{' and self.stream_field
+                        and stack[0].key == self.stream_field):
+                    self._target = frame
+                stack.append(frame)
+            elif c in '}]':
+                if stack[-1] is self._target and self._cap is not None:
+                    emitted.append(self._emit(self._take(chunk, i)))  # Scalar item
+                stack.pop()
+                if stack and stack[-1] is self._target and self._cap is not None:
+                    emitted.append(self._emit(self._take(chunk, i + 1)))  # Object or array item
+                if not stack:
+                    self._done = True
+                    root_end = i + 1
+                    break
+            elif c == ':':
+                stack[-1].expect_key = False
+            elif c == ',':
+                if stack[-1] is self._target and self._cap is not None:
+                    emitted.append(self._emit(self._take(chunk, i)))  # Scalar item
+                elif stack[-1].kind == '{':
+                    stack[-1].expect_key = True
+            elif c not in JSON_WHITESPACE:
+                self._value_start(i)  # Number, true, false or null
+            i += 1
+        if root_start is not None:
+            self._root_chunks.append(chunk[root_start:root_end])
+        if self._cap is not None:  # Key or item continues into the next chunk
+            self._capture.append(chunk[self._cap:])
+        return emitted
+
+    def _start_capture(self, i, key=False):
+        self._capture = []
+        self._capture_key = key
+        self._cap = i
+
+    def _take(self, chunk, end):
+        '''Complete text of the capture, ending at end in the current chunk'''
+        self._capture.append(chunk[self._cap:end])
+        raw = ''.join(self._capture)
+        self._capture = self._cap = None
+        return raw
+
+    def _value_start(self, i):
+        if self._stack and self._stack[-1] is self._target and self._cap is None:
+            self._start_capture(i)
+
+    def _emit(self, raw):
+        return self.item_adapter.validate_json(raw)
+
+    def close(self):
+        '''
+        Validate the complete object against the model, returning the model instance (also set as self.result)
+        '''
+        if not self._started:
+            raise ValueError('No JSON object found in the stream')
+        self.result = type_adapter(self.pyd_mod).validate_json(self.text)
+        return self.result
+
+    def iter_items(self, chunks):
+        '''
+        Feed from an iterable of text chunks, yielding validated stream_field items as they complete,
+        then close
+        '''
+        for chunk in chunks:
+            yield from self.feed(chunk)
+        self.close()
+
+    async def aiter_items(self, chunks):
+        '''
+        Feed from an async iterable of text chunks, yielding validated stream_field items as they complete,
+        then close, so the full model is available as self.result
+        '''
+        async for chunk in chunks:
+            for item in self.feed(chunk):
+                yield item
+        self.close()
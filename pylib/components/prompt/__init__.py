@@ -5,14 +5,34 @@
 '''
 Common components for prompt loading, assembly & handling
 '''
+import os
+import time
+import marshal
+import hashlib
+import threading
 from pathlib import Path
+from functools import lru_cache
+from collections.abc import Mapping
 
 from ogbujipt import word_loom
+from ogbujipt.word_loom import T
+
+# Default location for precompiled looms, with load_loom(..., precompiled=True)
+PRECOMPILED_LOOM_DIR = Path('~/.cache/arkestra/loom').expanduser()
+PACKED_LOOM_VERSION = 1  # Bump if the packed layout changes
+
+_loom_cache = {}  # resolved path -> ((mtime_ns, size), loom)
+_loom_cache_lock = threading.Lock()
 
 
 # FIXME: Replace with utiloori.filepath.obj_file_path_parent
+@lru_cache(maxsize=256)
 def obj_file_path_parent(obj):
-    '''Cross-platform Python trick to get the path to a file containing a given object'''
+    '''
+    Cross-platform Python trick to get the path to a file containing a given object
+
+    Cached, since inspect.getsourcefile is slow & objects don't move files while a process runs
+    '''
     import inspect
     # Should already be an absolute path
     # from os.path import abspath
@@ -20,21 +40,179 @@ def obj_file_path_parent(obj):
     return Path(inspect.getsourcefile(obj)).parent
 
 
-def load_loom(fpath, relobj=None):
+def load_loom(fpath, relobj=None, cache=True, precompiled=None):
     '''
     Load a Word Loom file (e.g for prompts) which are relative to an object
 
     fpath (str or Path) - path to Word Loom file
     relobj - Python object to use as base location for relative fpath, or more precisely the directory containing
         the file from which obj was loaded. Useful for loading Word Loom files included in Python packages
+    cache - keep the parsed loom in a process-wide cache, keyed by resolved path (symlinks are followed afresh on
+        each call) & checked against the file's modification time & size, so repeat loads cost a stat or two &
+        a dict copy. Each call returns its own dict, so callers can modify it without affecting each other
+    precompiled - directory (or True for PRECOMPILED_LOOM_DIR) in which to keep a precompiled (marshalled) form
+        of the loom, for fast cold starts of new processes. Only looms of plain values can be precompiled;
+        others (e.g. with TOML dates in metadata) are just parsed
+
+    >>> from arkestra.components.prompt import load_loom
+    >>> LANG = load_loom('lang.toml', relobj=some_module_function)  # Cheap enough to call per request
     '''
+    fpath = _loom_path(fpath, relobj)
+    if not cache:
+        return _parse_loom(fpath)
+    return dict(_cached_loom(fpath, precompiled)[1])
+
+
+def _loom_path(fpath, relobj):
     if isinstance(fpath, str):
         fpath = Path(fpath)
     if relobj:
         workingdir = obj_file_path_parent(relobj)
         fpath = workingdir / fpath
+    return fpath
+
+
+def _cached_loom(fpath, precompiled=None):
+    '''
+    (stamp, loom) for fpath from the process-wide cache, (re)loading it if the file has changed. The loom is the
+    cached dict itself, so mustn't be modified
+    '''
+    path = os.path.realpath(fpath)
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _loom_cache.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached
+
+    with _loom_cache_lock:
+        cached = _loom_cache.get(path)  # Another thread may have just loaded it
+        if cached is not None and cached[0] == stamp:
+            return cached
+        loom = None
+        if precompiled:
+            precompiled_path = _precompiled_path(path, precompiled)
+            loom = _read_precompiled(precompiled_path, path, stamp)
+        if loom is None:
+            loom = _parse_loom(path)
+            if precompiled:
+                _write_precompiled(precompiled_path, path, stamp, loom)
+        cached = _loom_cache[path] = (stamp, loom)
+    return cached
+
+
+def clear_loom_cache():
+    '''
+    Empty the process-wide loom cache (precompiled files on disk are left alone)
+    '''
+    with _loom_cache_lock:
+        _loom_cache.clear()
 
+
+def _parse_loom(fpath):
     with open(fpath, mode='rb') as fp:
         loom = word_loom.load(fp)
-
     return loom
+
+
+def pack_loom(loom, header=None):
+    '''
+    Serialize a loom to bytes (via marshal, which is much faster to load than TOML is to parse), along with
+    an optional header of plain values. Raises ValueError if the loom has values marshal can't handle
+    '''
+    items = [(key, str(item), item.lang, item.altlang, item.meta, item.markers) for key, item in loom.items()]
+    return marshal.dumps((PACKED_LOOM_VERSION, header, items))
+
+
+def unpack_loom(data):
+    '''
+    Inverse of pack_loom: returns (loom, header). Raises ValueError if data isn't a packed loom of this version
+    '''
+    try:
+        version, header, items = marshal.loads(data)
+    except (EOFError, TypeError, ValueError):
+        raise ValueError('Not a packed loom')
+    if version != PACKED_LOOM_VERSION:
+        raise ValueError(f'Packed loom version {version}; expected {PACKED_LOOM_VERSION}')
+    loom = {key: T(text, lang, altlang=altlang, meta=meta, markers=markers)
+            for key, text, lang, altlang, meta, markers in items}
+    return loom, header
+
+
+def _precompiled_path(path, precompiled):
+    pdir = PRECOMPILED_LOOM_DIR if precompiled is True else Path(precompiled).expanduser()
+    return pdir / (hashlib.sha256(path.encode('utf-8')).hexdigest()[:32] + '.loom')
+
+
+def _read_precompiled(precompiled_path, path, stamp):
+    try:
+        with open(precompiled_path, 'rb') as fp:
+            loom, header = unpack_loom(fp.read())
+    except (FileNotFoundError, ValueError):
+        return None
+    # Stale if the source has changed since
+    return loom if header == (path, *stamp) else None
+
+
+def _write_precompiled(precompiled_path, path, stamp, loom):
+    from arkestra.components.fileio import atomic_writer
+    try:
+        data = pack_loom(loom, (path, *stamp))
+    except ValueError:
+        return  # e.g. datetime values in metadata
+    try:
+        precompiled_path.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_writer(precompiled_path) as fp:
+            fp.write(data)
+    except OSError:
+        pass  # Precompiling is only an optimization, e.g. the cache dir may be read-only
+
+
+class loom_watcher(Mapping):
+    '''
+    Live, read-only view of a Word Loom file for long-running servers, reloaded when the file changes. Polls the
+    file's modification time on access, at most once every interval seconds, so edits to prompts take effect
+    without a restart. Pass on_change to be called with the new loom after each reload
+
+    >>> from arkestra.components.prompt import loom_watcher
+    >>> LANG = loom_watcher('lang.toml', relobj=some_module_function, interval=5)
+    >>> prompt = LANG['summarize'].format(text=text)
+    '''
+    def __init__(self, fpath, relobj=None, interval=2.0, on_change=None, precompiled=None):
+        self.fpath = fpath
+        self.relobj = relobj
+        self.interval = interval
+        self.on_change = on_change
+        self.precompiled = precompiled
+        # Shares the cached loom, since this view is read-only; reloads are spotted by the file's stamp changing
+        self._stamp, self.loom = _cached_loom(_loom_path(fpath, relobj), precompiled)
+        self._checked = time.monotonic()
+
+    def refresh(self):
+        '''
+        Reload now if the file has changed. Returns True if it was reloaded
+        '''
+        self._checked = time.monotonic()
+        stamp, loom = _cached_loom(_loom_path(self.fpath, self.relobj), self.precompiled)
+        if stamp == self._stamp:
+            return False
+        self._stamp, self.loom = stamp, loom
+        if self.on_change is not None:
+            self.on_change(loom)
+        return True
+
+    def _current(self):
+        if time.monotonic() - self._checked >= self.interval:
+            try:
+                self.refresh()
+            except (OSError, ValueError):
+                pass  # e.g. mid-save by an editor, or a TOML syntax error; keep serving the last good loom
+        return self.loom
+
+    def __getitem__(self, key):
+        return self._current()[key]
+
+    def __iter__(self):
+        return iter(self._current())
+
+    def __len__(self):
+        return len(self._current())
@@ -9,98 +9,408 @@ Resources:
 * https://developers.notion.com/docs/create-a-notion-integration
 '''
 # import os
-import json
-import httpx
+import time
+import heapq
+import logging
+import random
+import asyncio
+import hashlib
+import itertools
+from pathlib import Path
+from datetime import datetime, timezone, timedelta
+
+from arkestra.components.website import http_pool
+from arkestra.components.prompt import PRECOMPILED_LOOM_DIR, pack_loom, unpack_loom
 
 # from ogbujipt import word_loom
 from ogbujipt.word_loom import T
 
+logger = logging.getLogger(__name__)
+
 # NOTION_TOKEN = os.environ.get('NOTION_TOKEN')
 NOTION_VERSION = '2022-06-28'  # See: https://developers.notion.com/reference/post-database-query
 PAGES_PER_REQ = 100  # Max number of pages to get per HTTP request
+NOTION_API = 'https://api.notion.com/v1'
+# Notion rounds last_edited_time down to the minute, so incremental syncs look back a little further than that
+SYNC_OVERLAP = timedelta(minutes=2)
+NOTION_RATE = 3.0  # Requests/sec. Notion's documented average limit, per integration
+RETRY_STATUSES = (409, 429, 500, 502, 503, 504)  # 409 is Notion's conflict_error, also worth retrying
+
+# Request priorities for the scheduler; lower goes first
+PRIORITY_CRITICAL = 0  # e.g. loading prompts a service needs to start
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2  # e.g. background refreshes
+
+
+class shared_priority:
+    '''
+    Request priority which can be raised while requests using it are queued, e.g. when a caller starts waiting on
+    a sync begun in the background. Pass it wherever a priority is taken
+
+    >>> prio = shared_priority(PRIORITY_BACKGROUND)
+    >>> task = asyncio.create_task(notion_scheduler.request(client, 'GET', url, priority=prio))
+    >>> prio.raise_to(PRIORITY_CRITICAL)  # Queued & later requests now go at critical priority
+    '''
+    def __init__(self, value=PRIORITY_NORMAL):
+        self.value = value
+
+    def raise_to(self, value):
+        '''
+        Raise to value, if that's higher (numerically lower) than the current priority
+        '''
+        self.value = min(self.value, value)
+
+    def __repr__(self):
+        return f'shared_priority({self.value})'
+
+
+def _priority_value(priority):
+    return priority.value if isinstance(priority, shared_priority) else priority
+
+
+class request_scheduler:
+    '''
+    Rate limiting scheduler for Notion API requests, shared by everything in a process which calls Notion (by
+    default via `notion_scheduler`), so bursts from several loaders don't run into Notion's limits
+
+    Requests wait for a token from a token bucket (rate per second, in bursts of up to burst), & are let through
+    in priority order, so startup-critical fetches overtake background ones. A priority is a number, or a
+    `shared_priority`, which can be raised while its requests wait. A 429 response pauses all requests
+    for its Retry-After period, then the request is retried; other transient failures (5xx, 409 conflicts,
+    connection errors) are retried after jittered exponential backoff, up to retries times
+
+    >>> from arkestra.components.prompt.notion import notion_scheduler, PRIORITY_CRITICAL
+    >>> resp = await notion_scheduler.request(client, 'GET', url, priority=PRIORITY_CRITICAL, headers=headers)
+    '''
+    def __init__(self, rate=NOTION_RATE, burst=3, retries=5, backoff=0.5, max_backoff=30.0):
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0  # monotonic time, after a 429
+        self._waiters = []  # Heap of [priority value, sequence, future, priority]
+        self._seq = itertools.count()
+        self._dispatcher = None
+        self._loop = None
+
+    async def request(self, client, method, url, priority=PRIORITY_NORMAL, **kwargs):
+        '''
+        Make an HTTP request with an httpx client once the schedule allows, retrying as needed. Returns the
+        response, which may still be an error if retries ran out
+        '''
+        import httpx
+        attempt = 0
+        while True:
+            await self._acquire(priority)
+            attempt += 1
+            try:
+                resp = await client.request(method, url, **kwargs)
+            except httpx.TransportError:
+                if attempt > self.retries:
+                    raise
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+            if resp.status_code not in RETRY_STATUSES or attempt > self.retries:
+                return resp
+            if resp.status_code == 429:
+                retry_after = resp.headers.get('Retry-After', '')
+                delay = float(retry_after) if retry_after.replace('.', '', 1).isdigit() else self._backoff(attempt)
+                # Pause everyone, not just this request; the limit is shared
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            else:
+                await asyncio.sleep(self._backoff(attempt))
+
+    def _backoff(self, attempt):
+        # "Full jitter": spreads out retries from concurrent requests
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    async def _acquire(self, priority):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:  # e.g. a new asyncio.run; futures & tasks can't cross loops
+            self._loop = loop
+            self._waiters = []
+            self._dispatcher = None
+        fut = loop.create_future()
+        heapq.heappush(self._waiters, [_priority_value(priority), next(self._seq), fut, priority])
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = loop.create_task(self._dispatch())
+        await fut
+
+    async def _dispatch(self):
+        '''Grant tokens to waiters, highest priority first, while there are any'''
+        while self._waiters:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            self._reprioritize()
+            _, _, fut, _ = heapq.heappop(self._waiters)
+            if not fut.done():  # Skip cancelled waiters
+                self.tokens -= 1
+                fut.set_result(None)
+
+    def _reprioritize(self):
+        '''Reorder waiters whose shared_priority has been raised since they queued'''
+        changed = False
+        for waiter in self._waiters:
+            if waiter[3].__class__ is shared_priority and waiter[0] != waiter[3].value:
+                waiter[0] = waiter[3].value
+                changed = True
+        if changed:
+            heapq.heapify(self._waiters)
+
+
+# Default, process-wide scheduler
+notion_scheduler = request_scheduler()
 
 
 class notion_loom_loader:
     '''
+    Load language info (e.g. prompts) from a Word Loom-like Notion DB, with one page per item
+
+    The loom can be cached on disk, in cache_dir (True for a notion directory under PRECOMPILED_LOOM_DIR), along
+    with the DB's last_edited_time & when it was last synced. Later loads only fetch the pages edited since,
+    merging them into the cached loom, unless the DB itself (e.g. its schema) has changed, which triggers a full
+    fetch. Pages deleted (archived) in Notion only drop out on a full fetch: `await loader.sync(full=True)`.
+
+    Concurrent loads & syncs share one sync: callers arriving while one is in flight wait for it rather than
+    starting another (a full sync waits, then runs, unless the one in flight is full too). With wait=False, a
+    load returns the cached loom (if any) at once, syncing in the background, so service startup doesn't wait on
+    Notion; `loader.loom` is updated when the sync is done, & failures are logged. Requests go through the
+    scheduler (default `notion_scheduler`): a waited-for load at critical priority, a background one at
+    background priority. A caller waiting on an in-flight sync raises its priority to the caller's own, so a
+    critical load never queues behind a background sync's priority.
+
     >>> from arkestra.components.prompt.notion import notion_loom_loader
-    >>> nl_loader = notion_loom_loader()
-    >>> loom = nl_loader.load()
+    >>> nl_loader = notion_loom_loader(DB_ID, TOKEN, 'Name', 'Prompt', 'Markers')
+    >>> loom = await nl_loader.load()
     '''
-    def __init__(self, db_id, notion_token, prompt_id_field, prompt_text_field, params_field):
+    def __init__(self, db_id, notion_token, prompt_id_field, prompt_text_field, params_field, cache_dir=None,
+                 client=None, scheduler=None):
         self.db_id = db_id
         self.notion_token = notion_token
         self.prompt_id_field = prompt_id_field
         self.prompt_text_field = prompt_text_field
         self.params_field = params_field
+        self.cache_dir = PRECOMPILED_LOOM_DIR / 'notion' if cache_dir is True else cache_dir
+        self.client = client
+        self.scheduler = scheduler
+        self.loom = None
+        self.sync_task = None  # Sync in flight, or last done
+        self._sync_full = False  # Whether sync_task is a full sync
+        self._sync_priority = None  # shared_priority of sync_task's requests
+        self._page_keys = {}  # Notion page ID -> loom key, to apply edits & renames on incremental sync
+        self._db_edited = None  # DB's last_edited_time at last sync
+        self._synced = None  # Start time of last sync, as ISO 8601
 
-    async def load(self):
+    async def load(self, wait=True):
         '''
         Load language info (e.g for prompts) from a Word Loom-like Notion DB
 
-        fpath (str or Path) - path to Word Loom file
-        relobj - Python object to use as base location for relative fpath, or more precisely the directory containing
-            the file from which obj was loaded. Useful for loading Word Loom files included in Python packages
+        wait - if False & there's a cached loom, return it right away & sync in the background
+        '''
+        if self.loom is None:
+            self._read_cache()
+        if not wait and self.loom is not None:
+            if self._in_flight() is None:
+                self._start_sync(False, PRIORITY_BACKGROUND)
+            return self.loom
+        return await self.sync(priority=PRIORITY_CRITICAL)
 
+    async def sync(self, full=False, priority=PRIORITY_NORMAL):
         '''
-        loom = {}
-        async for page in pages(self.db_id, self.notion_token):
-            # assert page['object'] == 'page'
-            page_id = page['id']
-            # url = props['URL']['title'][0]['text']['content']
-            # title = props['Title']['rich_text'][0]['text']['content']
-            # published = props['Published']['date']['start']
-            # published = datetime.fromisoformat(published)
-            props = page['properties']
-            try:
-                prompt_id = props[self.prompt_id_field]
-            except KeyError:
-                raise ValueError(f'The prompt ID field name provided doesn\'t match a Notion page property')
-            try:
-                prompt_text = props[self.prompt_text_field]
-            except KeyError:
-                raise ValueError(f'The prompt text field name provided doesn\'t match a Notion page property')
-            try:
-                params = props[self.params_field]
-            except KeyError:
-                raise ValueError(f'The params field provided doesn\'t match a Notion page property')
-            params = params['rich_text'][0]['plain_text'] if params['rich_text'] else ''
-            params = [ p.strip() for p in params.split(',') ]
-            prompt_id = prompt_id['title'][0]['plain_text']
-            # rich_text or plain_text?
-            loom[prompt_id] = T(prompt_text['rich_text'][0]['text']['content'], 'en', meta=None, markers=params)
+        Bring the loom up to date with Notion, fetching only pages edited since the last sync unless full is True
+        or the DB has changed. Returns the loom
+        '''
+        while (task := self._in_flight()) is not None:
+            self._sync_priority.raise_to(_priority_value(priority))
+            if self._sync_full or not full:
+                # Shielded, so a cancelled caller doesn't cancel the sync other callers are waiting on
+                return await asyncio.shield(task)
+            await asyncio.wait([task])  # Then run the full sync asked for; this one's outcome isn't ours
+        return await asyncio.shield(self._start_sync(full, priority))
+
+    def _in_flight(self):
+        task = self.sync_task
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            return None
+        return task
+
+    def _start_sync(self, full, priority):
+        self._sync_full = full
+        self._sync_priority = shared_priority(_priority_value(priority))
+        # Held in sync_task until the next sync, so the task can't be garbage collected mid-flight
+        self.sync_task = asyncio.create_task(self._sync(full, self._sync_priority))
+        self.sync_task.add_done_callback(self._log_sync_failure)
+        return self.sync_task
+
+    def _log_sync_failure(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Sync of Notion DB %s failed', self.db_id, exc_info=task.exception())
+
+    async def _sync(self, full, priority):
+        fetch_opts = {'client': self.client, 'scheduler': self.scheduler, 'priority': priority}
+        started = datetime.now(tz=timezone.utc)
+        db = await database(self.db_id, self.notion_token, **fetch_opts)
+        db_edited = db.get('last_edited_time')
+        incremental = not full and self.loom is not None and self._synced and db_edited == self._db_edited
+        if incremental:
+            since = datetime.fromisoformat(self._synced) - SYNC_OVERLAP
+            loom, page_keys = dict(self.loom), dict(self._page_keys)
+        else:
+            since = None
+            loom, page_keys = {}, {}
+
+        changed = 0
+        async for page in pages(self.db_id, self.notion_token, edited_since=since, **fetch_opts):
+            key, item = self._page_item(page)
+            old_key = page_keys.get(page['id'])
+            if old_key is not None and old_key != key:
+                loom.pop(old_key, None)  # Renamed
+            loom[key] = item
+            page_keys[page['id']] = key
+            changed += 1
+
+        if not incremental or changed:
+            self.loom = loom  # Replaced, not mutated, so readers never see a partial update
+        self._page_keys = page_keys
+        self._db_edited = db_edited
+        self._synced = started.isoformat()
+        self._write_cache()
+        return self.loom
+
+    def _page_item(self, page):
+        '''
+        (prompt ID, language item) from a Notion DB page
+        '''
+        # assert page['object'] == 'page'
+        # url = props['URL']['title'][0]['text']['content']
+        # title = props['Title']['rich_text'][0]['text']['content']
+        # published = props['Published']['date']['start']
+        # published = datetime.fromisoformat(published)
+        props = page['properties']
+        try:
+            prompt_id = props[self.prompt_id_field]
+        except KeyError:
+            raise ValueError(f'The prompt ID field name provided doesn\'t match a Notion page property')
+        try:
+            prompt_text = props[self.prompt_text_field]
+        except KeyError:
+            raise ValueError(f'The prompt text field name provided doesn\'t match a Notion page property')
+        try:
+            params = props[self.params_field]
+        except KeyError:
+            raise ValueError(f'The params field provided doesn\'t match a Notion page property')
+        params = params['rich_text'][0]['plain_text'] if params['rich_text'] else ''
+        params = [ p.strip() for p in params.split(',') if p.strip() ]
+        prompt_id = prompt_id['title'][0]['plain_text']
+        # rich_text or plain_text?
+        return prompt_id, T(prompt_text['rich_text'][0]['text']['content'], 'en', meta=None, markers=params)
+
+    def _cache_path(self):
+        return Path(self.cache_dir).expanduser() / (hashlib.sha256(self.db_id.encode('utf-8')).hexdigest()[:32]
+                                                    + '.loom')
+
+    def _read_cache(self):
+        if self.cache_dir is None:
+            return
+        try:
+            with open(self._cache_path(), 'rb') as fp:
+                loom, header = unpack_loom(fp.read())
+        except (FileNotFoundError, ValueError):
+            return
+        if not _valid_cache_header(header, self.db_id):
+            return  # e.g. written by another version, or for a DB whose ID hashes the same; treat as a miss
+        self.loom = loom
+        self._page_keys = header['page_keys']
+        self._db_edited = header['db_edited']
+        self._synced = header['synced']
+
+    def _write_cache(self):
+        if self.cache_dir is None:
+            return
+        from arkestra.components.fileio import atomic_writer
+        header = {'db_id': self.db_id, 'page_keys': self._page_keys, 'db_edited': self._db_edited,
+                  'synced': self._synced, 'written': time.time()}
+        fpath = self._cache_path()
+        try:
+            fpath.parent.mkdir(parents=True, exist_ok=True)
+            with atomic_writer(fpath) as fp:
+                fp.write(pack_loom(self.loom, header))
+        except OSError:
+            pass  # The cache is only an optimization
+
+
+def _valid_cache_header(header, db_id):
+    return (isinstance(header, dict) and header.get('db_id') == db_id
+            and isinstance(header.get('page_keys'), dict)
+            and all(isinstance(header.get(k), (str, type(None))) for k in ('db_edited', 'synced')))
+
 
-        return loom
+def _headers(notion_token):
+    return {'Authorization': f'Bearer {notion_token}', 'Content-Type': 'application/json',
+            'Notion-Version': NOTION_VERSION}
 
 
-async def pages(db_id, notion_token, limit=None):
+async def database(db_id, notion_token, client=None, scheduler=None, priority=PRIORITY_NORMAL):
+    '''
+    Retrieve a DB's metadata (title, properties schema, last_edited_time, etc.)
+    '''
+    client = client or http_pool.httpx_client()
+    scheduler = scheduler or notion_scheduler
+    resp = await scheduler.request(client, 'GET', f'{NOTION_API}/databases/{db_id}', priority=priority,
+                                   headers=_headers(notion_token))
+    data = resp.json()
+    if data.get('object') != 'database':
+        raise RuntimeError(f'Unexpected response: {resp.content}')
+    return data
+
+
+async def pages(db_id, notion_token, limit=None, client=None, edited_since=None, scheduler=None,
+                priority=PRIORITY_NORMAL):
     '''
     Retrieve & yield all DB pages, or up to the limit, if given
 
+    Uses the shared, pooled httpx client from `arkestra.components.website.http_pool` unless one is passed in,
+    & the shared `notion_scheduler` for rate limiting & retries unless another `request_scheduler` is.
+    edited_since (datetime) - only pages last edited at or after this time
+
     >>> from arkestra.components.prompt.notion import pages
     >>> async for p in pages(DB_ID, TOKEN):
     ...     print(p)
     ...     break
     '''
-    url = f'https://api.notion.com/v1/databases/{db_id}/query'
-    payload = json.dumps({'page_size': PAGES_PER_REQ})
-    headers = {'Authorization': f'Bearer {notion_token}', 'Content-Type': 'application/json',
-                'Notion-Version': NOTION_VERSION}
-
-    async with httpx.AsyncClient() as client:
-        yield_count = 0
-        has_more = True
-        start_cursor = None
-        while (not limit or yield_count <= limit) and has_more:
-            if start_cursor:
-                payload['start_cursor'] = start_cursor
-            resp = await client.post(url, data=payload, headers=headers)
-            # print('Pulling: ', resp.url, 'with payload', payload)
-            data = resp.json()
-            if 'results' not in data:
-                raise RuntimeError(f'Unexpected response: {resp.content}')
-            has_more = data.get('has_more', False)
-            if has_more:
-                start_cursor = data['next_cursor']
-
-            for result in data['results']:
-                yield result
+    url = f'{NOTION_API}/databases/{db_id}/query'
+    payload = {'page_size': PAGES_PER_REQ if not limit else min(limit, PAGES_PER_REQ)}
+    if edited_since is not None:
+        payload['filter'] = {'timestamp': 'last_edited_time',
+                             'last_edited_time': {'on_or_after': edited_since.isoformat()}}
+    headers = _headers(notion_token)
+
+    client = client or http_pool.httpx_client()
+    scheduler = scheduler or notion_scheduler
+    yield_count = 0
+    has_more = True
+    while has_more:
+        resp = await scheduler.request(client, 'POST', url, priority=priority, json=payload, headers=headers)
+        # print('Pulling: ', resp.url, 'with payload', payload)
+        data = resp.json()
+        if 'results' not in data:
+            raise RuntimeError(f'Unexpected response: {resp.content}')
+        has_more = data.get('has_more', False)
+        if has_more:
+            payload['start_cursor'] = data['next_cursor']
+
+        for result in data['results']:
+            yield result
+            yield_count += 1
+            if limit and yield_count >= limit:
+                return
@@ -0,0 +1,173 @@
+# SPDX-FileCopyrightText: 2024-present Oori Data <info@oori.dev>
+#
+# SPDX-License-Identifier: Apache-2.0
+# arkestra.components.prompt.template
+'''
+Precompiled prompt templates
+
+Word Loom prompts (e.g. from `load_loom` or `notion_loom_loader`) are `str.format` templates. Rendering with
+`str.format` re-parses the whole template on every call; `prompt_template` parses it once into a list of literal
+& field segments, so rendering is just lookups & a join. Parameters are checked against the loom item's declared
+markers, & `render_many` renders whole batches (e.g. a dataframe's rows) with the lookups resolved once.
+
+>>> from arkestra.components.prompt import load_loom
+>>> from arkestra.components.prompt.template import compile_template
+>>> LANG = load_loom('lang.toml')
+>>> extract = compile_template(LANG['product_extract'])
+>>> prompt = extract.render(webpage_text=text)
+>>> prompts = list(extract.render_many(df))  # pandas DataFrame, or any iterable of dicts
+'''
+import string
+import warnings
+from functools import lru_cache
+
+_formatter = string.Formatter()
+
+
+def _str(value):
+    return value if value.__class__ is str else format(value)
+
+
+def _field_name(field):
+    '''Parameter name of a replacement field, e.g. item for item.title or item[0]'''
+    if field == '' or field.isdigit():
+        raise ValueError(f'Positional field {{{field}}} in template; prompt templates take named fields')
+    return field.split('.', 1)[0].split('[', 1)[0]
+
+
+class prompt_template:
+    '''
+    A prompt template, parsed once
+
+    text - template text, in str.format syntax (e.g. a Word Loom language item)
+    markers - names of the parameters the template is declared to take; by default the text's markers attribute,
+        if a language item. Fields in the text but not declared raise ValueError if strict, else warn
+    strict - also reject parameters passed to render which aren't markers (e.g. typos)
+    '''
+    def __init__(self, text, markers=None, strict=False):
+        if markers is None:
+            markers = getattr(text, 'markers', None)
+        self.text = str(text)
+        self.strict = strict
+        segments = []
+        fields = []
+        for literal, field, spec, conversion in _formatter.parse(self.text):
+            if literal:
+                segments.append(literal)
+            if field is None:
+                continue
+            name = _field_name(field)
+            if name not in fields:
+                fields.append(name)
+            # Fields nested in the format spec, e.g. width in {x:{width}}, are parameters too
+            for _, spec_field, _, _ in _formatter.parse(spec) if spec else ():
+                if spec_field is not None and _field_name(spec_field) not in fields:
+                    fields.append(_field_name(spec_field))
+            if name == field and not spec and not conversion:
+                segments.append((name, None))  # Fast path: plain {name}
+            else:
+                # e.g. {price:.2f} or {item.title!r}; rendered via str.format of just this field
+                segments.append((name, '{' + field + ('!' + conversion if conversion else '')
+                                 + (':' + spec if spec else '') + '}'))
+        self.segments = segments
+        self.fields = tuple(fields)
+        self.markers = tuple(markers) if markers else self.fields
+        undeclared = [f for f in self.fields if f not in self.markers]
+        if undeclared:
+            msg = f'Template fields not declared as markers: {", ".join(undeclared)}'
+            if strict:
+                raise ValueError(msg)
+            warnings.warn(msg)
+
+    def __repr__(self):
+        return f'prompt_template({self.text[:40]!r}..., fields={self.fields!r})'
+
+    def check(self, params):
+        '''
+        Raise ValueError if params (a mapping) lacks any of the template's fields, or, if strict, has unknown ones
+        '''
+        missing = [f for f in self.fields if f not in params]
+        if missing:
+            raise ValueError(f'Missing prompt parameters: {", ".join(missing)}')
+        if self.strict:
+            unknown = [k for k in params if k not in self.markers]
+            if unknown:
+                raise ValueError(f'Unknown prompt parameters: {", ".join(unknown)}')
+
+    def render(self, params=None, /, **kwargs):
+        '''
+        Render with parameters from a mapping and/or keyword args. The mapping is positional-only, so a template
+        field can be named params
+        '''
+        if params is None:
+            params = kwargs
+        elif kwargs:
+            params = {**params, **kwargs}
+        if self.strict:
+            self.check(params)
+        try:
+            return ''.join([seg if seg.__class__ is str else self._field(seg, params) for seg in self.segments])
+        except KeyError:
+            self.check(params)  # Raises a clearer error
+            raise
+
+    __call__ = render
+
+    @staticmethod
+    def _field(seg, params):
+        name, fmt = seg
+        if fmt is None:
+            return _str(params[name])
+        return fmt.format_map(params)
+
+    def render_many(self, rows, columns=None):
+        '''
+        Render for each of a batch of rows, yielding prompts in order. rows can be a pandas (or similar) DataFrame,
+        an iterable of mappings, or an iterable of tuples with column names given in columns. Parameters are
+        checked once, against the first row (or the columns)
+        '''
+        if hasattr(rows, 'itertuples') and hasattr(rows, 'columns'):  # DataFrame-like
+            columns = list(rows.columns)
+            rows = rows.itertuples(index=False, name=None)
+        if columns is None:
+            checked = False
+            for row in rows:
+                if not checked:
+                    self.check(row)
+                    checked = True
+                yield self.render(row)
+            return
+
+        # Tuple rows: resolve each plain field to its column position once
+        columns = list(columns)
+        self.check(dict.fromkeys(columns))
+        positions = [seg if seg.__class__ is str or seg[1] is not None else columns.index(seg[0])
+                     for seg in self.segments]
+        if any(seg.__class__ is tuple for seg in positions):  # Formatted fields need a mapping
+            for row in rows:
+                yield self.render(dict(zip(columns, row)))
+            return
+        for row in rows:
+            yield ''.join([p if p.__class__ is str else _str(row[p]) for p in positions])
+
+
+@lru_cache(maxsize=1024)
+def _compile(text, markers, strict):
+    return prompt_template(text, markers or None, strict)
+
+
+def compile_template(item, markers=None, strict=False):
+    '''
+    Compiled `prompt_template` for a language item (or plain str), cached, so it can be called per request
+    without re-parsing. markers defaults to the item's own
+    '''
+    if markers is None:
+        markers = getattr(item, 'markers', None)
+    return _compile(str(item), tuple(markers) if markers else (), strict)
+
+
+def compile_loom(loom, strict=False):
+    '''
+    Compile every item of a loom, returning a dict of the same keys to `prompt_template`s
+    '''
+    return {key: compile_template(item, strict=strict) for key, item in loom.items()}
@@ -5,16 +5,207 @@
 '''
 Maagement & orchestration of data pipeline jobs
 '''
+import json
+import time
+import sqlite3
 from uuid import uuid4
+from pathlib import Path
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from datetime import datetime, timezone
+
+# Job status values
+PENDING = 'pending'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+SQLITE_SUFFIXES = ('.sqlite', '.sqlite3', '.db')
+
+
+@dataclass
+class job_info:
+    '''State of a job tracked by the in-memory manager'''
+    jobid: str
+    operation: str
+    params: dict | None = None
+    metadata: dict | None = None
+    status: str = RUNNING
+    job_start: datetime | None = None
+    job_end: datetime | None = None
+    result: object = None
+
+    def to_dict(self):
+        d = asdict(self)
+        for k in ('job_start', 'job_end'):
+            d[k] = d[k].isoformat() if d[k] else None
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        d = dict(d)
+        for k in ('job_start', 'job_end'):
+            d[k] = datetime.fromisoformat(d[k]) if d[k] else None
+        return cls(**d)
+
 
 class manager:
     '''
     In-memory job manager
     Recommended to switch to a persistent job manager (on disk, in DB, etc.)
+
+    `new` & `complete` are coroutines, as with the other job managers, so they're interchangeable.
+    To keep memory flat in long-running services, set max_jobs to evict the least recently used jobs beyond that
+    number, and/or ttl to evict jobs not accessed for that many seconds. Evicted jobs are lost unless spill is
+    given: a path to a SQLite DB (by extension .sqlite, .sqlite3 or .db) or else an append-only JSON Lines file,
+    to which evicted jobs are written, & from which `get` & `complete` recover them.
+
+    >>> from arkestra.jobs import manager
+    >>> jm = manager(max_jobs=10000, ttl=3600, spill='jobs-archive.sqlite')
+    >>> jobid = await jm.new('scrape', {'url': url})
+    >>> await jm.complete(jobid, True, {'length': 1234})
+    >>> jm.by_status('running')
+    []
     '''
-    def __init__(self):
-        self.jobs = {}
+    def __init__(self, max_jobs=None, ttl=None, spill=None):
+        self.jobs = OrderedDict()  # jobid -> job_info, least recently used first
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self._touched = {}  # jobid -> monotonic time of last access
+        self._by_status = {}  # status -> insertion-ordered dict (i.e. set) of jobids
+        if spill is not None:
+            spill = Path(spill)
+            spill = sqlite_spill(spill) if spill.suffix in SQLITE_SUFFIXES else jsonl_spill(spill)
+        self.spill = spill
 
     def new_jobid(self):
         return str(uuid4())
 
+    async def new(self, operation: str, params: dict | None = None, metadata: dict | None = None):
+        '''
+        Start tracking a new, running job. Returns its ID
+        '''
+        job = job_info(self.new_jobid(), operation, params or {}, metadata or {}, RUNNING,
+                       job_start=datetime.now(tz=timezone.utc))
+        self._add(job)
+        return job.jobid
+
+    async def complete(self, jobid, success, completion_info, metrics=None):
+        '''
+        Record the end of a job, with its result. metrics, if given (e.g. from
+        `arkestra.jobs.instrument.job_metrics.as_metadata`), goes in the job's metadata under the `metrics` key
+        '''
+        job = self.get(jobid)
+        if job is None:
+            raise KeyError(jobid)
+        if metrics is not None:
+            job.metadata['metrics'] = metrics
+        self._set_status(job, SUCCEEDED if success else FAILED)
+        job.job_end = datetime.now(tz=timezone.utc)
+        job.result = completion_info
+
+    def get(self, jobid):
+        '''
+        Retrieve a job's state, or None if unknown. Counts as an access, for eviction purposes
+        '''
+        job = self.jobs.get(jobid)
+        if job is not None:
+            self.jobs.move_to_end(jobid)
+            self._touched[jobid] = time.monotonic()
+            return job
+        if self.spill is not None:
+            job = self.spill.get(jobid)
+            if job is not None:
+                self._add(job)
+        return job
+
+    def by_status(self, status):
+        '''
+        List the in-memory jobs with the given status (e.g. 'running'), oldest first
+        '''
+        return [self.jobs[jobid] for jobid in self._by_status.get(status, ())]
+
+    def count(self, status):
+        '''
+        Number of in-memory jobs with the given status
+        '''
+        return len(self._by_status.get(status, ()))
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def evict(self):
+        '''
+        Evict expired jobs, then least recently used ones beyond max_jobs. Runs automatically on each new job
+        '''
+        if self.ttl is not None:
+            cutoff = time.monotonic() - self.ttl
+            # Least recently used are first, so stop at the first one still fresh
+            while self.jobs and self._touched[next(iter(self.jobs))] < cutoff:
+                self._evict_one()
+        if self.max_jobs is not None:
+            while len(self.jobs) > self.max_jobs:
+                self._evict_one()
+
+    def _add(self, job):
+        self.jobs[job.jobid] = job
+        self._touched[job.jobid] = time.monotonic()
+        self._by_status.setdefault(job.status, {})[job.jobid] = None
+        self.evict()
+
+    def _evict_one(self):
+        jobid, job = self.jobs.popitem(last=False)
+        del self._touched[jobid]
+        del self._by_status[job.status][jobid]
+        if self.spill is not None:
+            self.spill.write(job)
+
+    def _set_status(self, job, status):
+        del self._by_status[job.status][job.jobid]
+        job.status = status
+        self._by_status.setdefault(status, {})[job.jobid] = None
+
+
+class jsonl_spill:
+    '''
+    Append-only JSON Lines archive of evicted jobs. Lookups scan the file (latest record wins),
+    so this suits jobs which are rarely looked up after eviction
+    '''
+    def __init__(self, fpath):
+        self.fpath = Path(fpath)
+
+    def write(self, job):
+        with self.fpath.open('a') as fp:
+            fp.write(json.dumps(job.to_dict(), default=str) + '\n')
+
+    def get(self, jobid):
+        if not self.fpath.exists():
+            return None
+        found = None
+        with self.fpath.open() as fp:
+            for line in fp:
+                # Cheap substring check before parsing
+                if jobid in line:
+                    record = json.loads(line)
+                    if record['jobid'] == jobid:
+                        found = record
+        return job_info.from_dict(found) if found else None
+
+
+class sqlite_spill:
+    '''
+    SQLite archive of evicted jobs, indexed by job ID
+    '''
+    def __init__(self, fpath):
+        self.conn = sqlite3.connect(fpath)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS spilled_jobs (jobid TEXT PRIMARY KEY, job TEXT)')
+        self.conn.commit()
+
+    def write(self, job):
+        self.conn.execute('INSERT OR REPLACE INTO spilled_jobs (jobid, job) VALUES (?, ?)',
+                          (job.jobid, json.dumps(job.to_dict(), default=str)))
+        self.conn.commit()
+
+    def get(self, jobid):
+        row = self.conn.execute('SELECT job FROM spilled_jobs WHERE jobid = ?', (jobid,)).fetchone()
+        return job_info.from_dict(json.loads(row[0])) if row else None
@@ -0,0 +1,267 @@
+# SPDX-FileCopyrightText: 2024-present Oori Data <info@oori.dev>
+#
+# SPDX-License-Identifier: Apache-2.0
+# arkestra.jobs.instrument
+'''
+Job-level timing & resource instrumentation, per pipeline stage
+
+Wrap each stage of a job in `job_metrics.stage` (or decorate the stage function with `instrumented`) to capture
+wall time, CPU time & peak RSS, plus bytes fetched & LLM token counts reported by the code running in the stage.
+Pass `as_metadata()` to a job manager's `complete` to store the figures in the job's metadata, and use a
+`metrics_registry` to aggregate them across jobs for export as Prometheus text or OpenMetrics.
+
+>>> from arkestra.jobs.instrument import job_metrics, metrics_registry, serve_metrics, count_bytes
+>>> registry = metrics_registry()
+>>> serve_metrics(registry, port=9464)
+>>> jm_metrics = job_metrics(registry)
+>>> with jm_metrics.stage('fetch'):
+...     content = await load_page_aiohttp(url)
+...     count_bytes(len(content))
+>>> with jm_metrics.stage('summarize'):
+...     resp = await llm(prompt)
+...     count_tokens(resp.usage.prompt_tokens, resp.usage.completion_tokens)
+>>> await jm.complete(jobid, True, result, metrics=jm_metrics.as_metadata())
+
+CPU time & peak RSS are process-wide, so with concurrent jobs in one process they show the load during the stage,
+not just the stage's own share.
+'''
+import sys
+import time
+import inspect
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import resource
+except ImportError:  # e.g. Windows
+    resource = None
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+_current_job = contextvars.ContextVar('arkestra_current_job', default=None)
+_current_stage = contextvars.ContextVar('arkestra_current_stage', default=None)
+
+
+def peak_rss_bytes():
+    '''
+    Peak resident set size of this process so far, or None where unavailable
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB; macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class stage_stats:
+    '''Measurements for one stage of a job'''
+    def __init__(self):
+        self.calls = 0
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_rss_bytes = None
+        self.bytes_fetched = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+    def merge(self, other):
+        '''
+        Add another set of measurements into this one. Peak RSS takes the latest reading
+        '''
+        for attr in ('calls', 'wall_seconds', 'cpu_seconds', 'bytes_fetched', 'prompt_tokens', 'completion_tokens'):
+            setattr(self, attr, getattr(self, attr) + getattr(other, attr))
+        if other.peak_rss_bytes is not None:
+            self.peak_rss_bytes = other.peak_rss_bytes
+
+
+class job_metrics:
+    '''
+    Per-job collection of stage measurements. Stages of the same name accumulate.
+    If a registry is given, each finished stage is also added to it, labelled with the pipeline_version
+    '''
+    def __init__(self, registry=None, pipeline_version=None):
+        self.registry = registry
+        self.pipeline_version = pipeline_version
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        Context manager measuring a pipeline stage. `count_bytes` & `count_tokens` calls within it
+        (including from nested coroutines & functions) are attributed to it
+        '''
+        run = stage_stats()  # This run only; merged into the job's totals for the stage at the end
+        job_token = _current_job.set(self)
+        stage_token = _current_stage.set(run)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield run
+        finally:
+            run.calls = 1
+            run.wall_seconds = time.perf_counter() - wall_start
+            run.cpu_seconds = time.process_time() - cpu_start
+            run.peak_rss_bytes = peak_rss_bytes()
+            _current_stage.reset(stage_token)
+            _current_job.reset(job_token)
+            self.stages.setdefault(name, stage_stats()).merge(run)
+            if self.registry is not None:
+                self.registry.observe(name, run, self.pipeline_version)
+
+    def as_metadata(self):
+        '''
+        Stage measurements as a JSON-ready dict, e.g. for the metrics arg of a job manager's complete
+        '''
+        return {name: stats.as_dict() for name, stats in self.stages.items()}
+
+
+def count_bytes(n):
+    '''
+    Attribute n bytes fetched to the current stage, if any
+    '''
+    stats = _current_stage.get()
+    if stats is not None:
+        stats.bytes_fetched += n
+
+
+def count_tokens(prompt=0, completion=0):
+    '''
+    Attribute LLM token usage to the current stage, if any
+    '''
+    stats = _current_stage.get()
+    if stats is not None:
+        stats.prompt_tokens += prompt
+        stats.completion_tokens += completion
+
+
+def current_job_metrics():
+    '''
+    The job_metrics of the innermost enclosing stage, or None
+    '''
+    return _current_job.get()
+
+
+def instrumented(name=None):
+    '''
+    Decorator running a function (sync or async) as a stage of the current job, i.e. the job whose stage
+    encloses the call. Outside of any job it just runs the function. The stage name defaults to the function's
+
+    >>> @instrumented()
+    ... async def embed(chunks): ...
+    '''
+    def decorator(func):
+        stage_name = name or func.__name__
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                jm = _current_job.get()
+                if jm is None:
+                    return await func(*args, **kwargs)
+                with jm.stage(stage_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            jm = _current_job.get()
+            if jm is None:
+                return func(*args, **kwargs)
+            with jm.stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# (metric name, type, help, stage_stats attribute)
+REGISTRY_METRICS = [
+    ('arkestra_stage_calls', 'counter', 'Pipeline stage executions', 'calls'),
+    ('arkestra_stage_wall_seconds', 'counter', 'Wall clock time spent in pipeline stages', 'wall_seconds'),
+    ('arkestra_stage_cpu_seconds', 'counter', 'Process CPU time elapsed during pipeline stages', 'cpu_seconds'),
+    ('arkestra_stage_bytes_fetched', 'counter', 'Bytes fetched by pipeline stages', 'bytes_fetched'),
+    ('arkestra_stage_prompt_tokens', 'counter', 'LLM prompt tokens used by pipeline stages', 'prompt_tokens'),
+    ('arkestra_stage_completion_tokens', 'counter', 'LLM completion tokens used by pipeline stages',
+     'completion_tokens'),
+]
+
+
+class metrics_registry:
+    '''
+    Process-level aggregate of stage measurements across jobs, thread-safe.
+    Totals are keyed by (pipeline_version, stage)
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {}  # (pipeline_version, stage) -> {attribute: total}
+
+    def observe(self, stage, stats, pipeline_version=None):
+        '''
+        Add the measurements of a finished stage run
+        '''
+        with self._lock:
+            key = (pipeline_version or '', stage)
+            totals = self._totals.setdefault(key, {attr: 0 for _, _, _, attr in REGISTRY_METRICS})
+            for _, _, _, attr in REGISTRY_METRICS:
+                totals[attr] += getattr(stats, attr)
+
+    def render(self, openmetrics=False):
+        '''
+        Current totals in Prometheus text exposition format, or OpenMetrics if requested
+        '''
+        with self._lock:
+            totals = {k: dict(v) for k, v in self._totals.items()}
+        lines = []
+        for metric, mtype, help_text, attr in REGISTRY_METRICS:
+            # Counter samples are suffixed _total in both formats, but only OpenMetrics drops it from the family name
+            sample = f'{metric}_total'
+            family = metric if openmetrics else sample
+            lines.append(f'# HELP {family} {help_text}')
+            lines.append(f'# TYPE {family} {mtype}')
+            for (pipeline_version, stage), values in sorted(totals.items()):
+                labels = f'pipeline_version="{_escape_label(pipeline_version)}",stage="{_escape_label(stage)}"'
+                lines.append(f'{sample}{{{labels}}} {values[attr]}')
+        rss = peak_rss_bytes()
+        if rss is not None:
+            lines.append('# HELP arkestra_process_peak_rss_bytes Peak resident set size of the process')
+            lines.append('# TYPE arkestra_process_peak_rss_bytes gauge')
+            lines.append(f'arkestra_process_peak_rss_bytes {rss}')
+        if openmetrics:
+            lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def serve_metrics(registry, port=9464, host='127.0.0.1'):
+    '''
+    Serve the registry at http://host:port/metrics from a daemon thread. Responds with OpenMetrics if the
+    scraper asks for it in its Accept header, else Prometheus text. Returns the server; call its shutdown()
+    method to stop it
+    '''
+    class metrics_handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+            body = registry.render(openmetrics=openmetrics).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', OPENMETRICS_CONTENT_TYPE if openmetrics else PROMETHEUS_CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes are frequent; keep them out of stderr
+
+    server = ThreadingHTTPServer((host, port), metrics_handler)
+    threading.Thread(target=server.serve_forever, name='arkestra-metrics', daemon=True).start()
+    return server
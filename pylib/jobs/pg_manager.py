@@ -6,8 +6,12 @@
 Maagement & orchestration of data pipeline jobs
 '''
 import json
+import asyncio
+import logging
 from uuid import uuid4
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
 
 # https://www.postgresqltutorial.com/postgresql-tutorial/postgresql-identity-column/
 CREATE_JOB_TABLE = '''-- Create a table to hold jobs info
@@ -23,6 +27,80 @@ CREATE TABLE IF NOT EXISTS {table_name} (
 )
 '''
 
+# Time-partitioned variant, opted into via `partition_interval`. Partitioning requires the partition key in the
+# primary key, hence (id, job_start); id leads, so lookups by id alone still use it. A default partition catches
+# any rows outside the managed ranges
+CREATE_PARTITIONED_JOB_TABLE = '''-- Create a time-partitioned table to hold jobs info
+CREATE TABLE IF NOT EXISTS {table_name} (
+    id BIGSERIAL,
+    job_start TIMESTAMP WITH TIME ZONE NOT NULL,  -- timestamp of job start; partition key
+    job_end TIMESTAMP WITH TIME ZONE,       -- timestamp of job end (successful or not)
+    success BOOL,                           -- did the job succeed?
+    request JSONB,                          -- job request params JSON
+    response JSONB,                         -- job response JSON
+    pipeline_version TEXT,                  -- Version indicator for the pipeline which ran the job
+    metadata JSONB,                         -- Any additional metadata
+    PRIMARY KEY (id, job_start)
+) PARTITION BY RANGE (job_start);
+CREATE TABLE IF NOT EXISTS {table_name}_default PARTITION OF {table_name} DEFAULT;
+CREATE INDEX IF NOT EXISTS {index_prefix}_start_id_idx ON {table_name} (job_start, id);
+CREATE INDEX IF NOT EXISTS {index_prefix}_version_start_idx ON {table_name} (pipeline_version, job_start);
+CREATE INDEX IF NOT EXISTS {index_prefix}_incomplete_idx ON {table_name} (job_start) WHERE job_end IS NULL;
+'''
+
+CREATE_JOB_PARTITION = '''
+CREATE TABLE IF NOT EXISTS {partition_name} PARTITION OF {table_name} FOR VALUES FROM ('{start}') TO ('{end}')
+'''
+
+# Rows already in the default partition for a new partition's range (e.g. if maintenance fell behind) would block
+# creating it, so they're moved into it, created standalone & then attached
+DEFAULT_HAS_ROWS_SQL = '''
+SELECT EXISTS (SELECT 1 FROM {default_name} WHERE job_start >= $1 AND job_start < $2)
+'''
+
+CREATE_JOB_PARTITION_FROM_DEFAULT = '''
+CREATE TABLE {partition_name} (LIKE {table_name} INCLUDING DEFAULTS INCLUDING CONSTRAINTS);
+WITH moved AS (DELETE FROM {default_name} WHERE job_start >= '{start}' AND job_start < '{end}' RETURNING *)
+INSERT INTO {partition_name} SELECT * FROM moved;
+ALTER TABLE {table_name} ATTACH PARTITION {partition_name} FOR VALUES FROM ('{start}') TO ('{end}');
+'''
+
+# Whether the table exists & is partitioned, & the type of its JSON columns
+JOB_TABLE_INFO_SQL = '''
+SELECT to_regclass($1) IS NOT NULL AS exists,
+    EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass($1)) AS partitioned,
+    (SELECT upper(format_type(atttypid, atttypmod)) FROM pg_attribute
+        WHERE attrelid = to_regclass($1) AND attname = 'metadata') AS json_type
+'''
+
+PARTITION_EXISTS_SQL = '''
+SELECT to_regclass($1) IS NOT NULL
+'''
+
+LIST_JOB_PARTITIONS_SQL = '''
+SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = $1::text::regclass
+'''
+
+DETACH_JOB_PARTITION = '''
+ALTER TABLE {table_name} DETACH PARTITION {partition_name}
+'''
+
+PARTITION_INTERVALS = ('day', 'week', 'month')
+
+JOB_COLUMNS = 'id, job_start, job_end, success, request, response, pipeline_version, metadata'
+
+JOB_GET_SQL = '''
+SELECT {columns} FROM {table_name} WHERE id=$1
+'''
+
+# Keyset pagination on (job_start, id), so each page costs the same however deep into the results it is
+JOB_QUERY_SQL = '''
+SELECT {columns} FROM {table_name}
+WHERE {where}
+ORDER BY job_start {direction}, id {direction}
+LIMIT {limit}
+'''
+
 JOB_INSERT_SQL= '''
 INSERT INTO {table_name} (job_start, request, pipeline_version, metadata)
 VALUES ($1, $2, $3, $4) RETURNING id
@@ -32,27 +110,162 @@ JOB_COMPLETE_SQL= '''
 UPDATE {table_name} SET job_end=$2, success=$3, response=$4 WHERE id=$1
 '''
 
+# Also merges instrumentation (see arkestra.jobs.instrument) into metadata, under the `metrics` key
+JOB_COMPLETE_METRICS_SQL = '''
+UPDATE {table_name} SET job_end=$2, success=$3, response=$4,
+    metadata=(COALESCE(metadata::jsonb, '{{}}'::jsonb) || jsonb_build_object('metrics', $5::text::jsonb))::{json_type}
+WHERE id=$1
+'''
+
+# Batched mode reserves IDs from the table's sequence up front, so each buffered caller gets its ID without relying
+# on the row order of a multi-row RETURNING
+JOB_RESERVE_IDS_SQL = '''
+SELECT nextval(pg_get_serial_sequence('{table_name}', 'id')) AS id FROM generate_series(1, $1)
+'''
+
+JOB_BATCH_INSERT_SQL = '''
+INSERT INTO {table_name} (id, job_start, request, pipeline_version, metadata)
+OVERRIDING SYSTEM VALUE VALUES ($1, $2, $3, $4, $5)
+'''
+
 
 class pg_manager:
     '''
     PostgreSQL job manager
+
+    By default each `new` & `complete` call is its own round trip. Set `batch_size` to opt into buffered mode,
+    where calls are coalesced & written with `executemany`, flushed once `batch_size` calls are pending or
+    `flush_interval` seconds after the first pending call, whichever comes first. Callers still just await
+    `new` for the job ID. If a batch fails, its calls are retried one at a time, so a bad row only fails its own
+    caller. Call `flush` (or `close`) before shutdown so nothing is left in the buffer.
+
+    >>> from arkestra.jobs.pg_manager import pg_manager
+    >>> jm = pg_manager('jobs', pipeline_version='1.0', batch_size=200, flush_interval=0.05)
+    >>> await jm.async_init(pool)
+    >>> jobid = await jm.new('scrape', {'url': url})
+
+    Set `partition_interval` ('day', 'week' or 'month') to create the table partitioned by `job_start`, with
+    JSONB columns, a primary key & indexes for the common lookups (by pipeline version & time, and incomplete
+    jobs). Partitions are created `partitions_ahead` intervals in advance. If `retention` (a timedelta) is given,
+    `maintain_partitions` detaches partitions which ended before that cutoff (& drops them if `drop_detached`).
+    Run it periodically, e.g. via `start_maintenance`. Partitioning applies only when the table is first created;
+    an existing, unpartitioned table is left as is (with a logged warning), & partition maintenance is then off.
+
+    >>> jm = pg_manager('jobs', partition_interval='month', retention=timedelta(days=90))
+    >>> await jm.async_init(pool)
+    >>> jm.start_maintenance(every=3600)
     '''
-    def __init__(self, table_name, pipeline_version=None, stringify_json=False):
+    def __init__(self, table_name, pipeline_version=None, stringify_json=False, batch_size=0, flush_interval=0.05,
+                 partition_interval=None, partitions_ahead=2, retention=None, drop_detached=False):
         self.table_name = table_name
         # In most cases the pipeline version os const for the instance
         self.pipeline_version = pipeline_version
         self.stringify_json = stringify_json  # set to True of the DB doesn't have the JSON extension data type
         self.jobs = {}
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending_new = []  # (job_start, request, pipeline_version, metadata, future)
+        self._pending_complete = []  # (id, job_end, success, response, metrics, future)
+        self._flush_timer = None
+        self._flush_task = None  # Background flush, at most one at a time
+        self._flush_lock = asyncio.Lock()
+        if partition_interval not in (None,) + PARTITION_INTERVALS:
+            raise ValueError(f'partition_interval must be one of {PARTITION_INTERVALS}, not {partition_interval!r}')
+        self.partition_interval = partition_interval
+        self.partitions_ahead = partitions_ahead
+        self.retention = retention
+        self.drop_detached = drop_detached
+        self.json_type = 'JSONB' if partition_interval else 'JSON'
+        self._maintenance_task = None
 
     def new_jobid(self):
         return str(uuid4())
 
     async def async_init(self, pool):
         self.pool = pool
-        # Create job table if it doesn't yet exist
         async with pool.acquire() as conn:
+            info = await conn.fetchrow(JOB_TABLE_INFO_SQL, self.table_name)
+            if self.partition_interval and info['exists'] and not info['partitioned']:
+                logger.warning('Job table %s already exists, unpartitioned, so partition_interval is ignored',
+                               self.table_name)
+                self.partition_interval = None
+            # Create job table if it doesn't yet exist
             async with conn.transaction():
-                await conn.execute(CREATE_JOB_TABLE.format(table_name=self.table_name))
+                if self.partition_interval:
+                    await conn.execute(CREATE_PARTITIONED_JOB_TABLE.format(
+                        table_name=self.table_name, index_prefix=self.table_name.rpartition('.')[2]))
+                else:
+                    await conn.execute(CREATE_JOB_TABLE.format(table_name=self.table_name))
+            if info['exists']:
+                self.json_type = info['json_type'] or self.json_type  # Whatever the table was created with
+        if self.partition_interval:
+            await self.maintain_partitions()
+
+    def _partition_name(self, start):
+        return f'{self.table_name}_p{start:%Y%m%d}'
+
+    async def maintain_partitions(self, now=None):
+        '''
+        Create partitions for the current & upcoming intervals, then apply retention, if any.
+        Returns the list of names of partitions detached (always empty if the table isn't partitioned)
+        '''
+        if not self.partition_interval:
+            return []
+        now = now or datetime.now(tz=timezone.utc)
+        start = partition_floor(now, self.partition_interval)
+        detached = []
+        default_name = f'{self.table_name}_default'
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                for _ in range(self.partitions_ahead + 1):
+                    end = next_partition_start(start, self.partition_interval)
+                    partition_name = self._partition_name(start)
+                    if not await conn.fetchval(PARTITION_EXISTS_SQL, partition_name):
+                        sql = CREATE_JOB_PARTITION
+                        if await conn.fetchval(DEFAULT_HAS_ROWS_SQL.format(default_name=default_name), start, end):
+                            sql = CREATE_JOB_PARTITION_FROM_DEFAULT
+                        await conn.execute(sql.format(
+                            table_name=self.table_name, partition_name=partition_name, default_name=default_name,
+                            start=start.isoformat(), end=end.isoformat()))
+                    start = end
+
+            if self.retention is None:
+                return detached
+            cutoff = now - self.retention
+            schema_prefix = self.table_name.rpartition('.')[0]
+            schema_prefix = schema_prefix + '.' if schema_prefix else ''
+            name_prefix = self.table_name.rpartition('.')[2] + '_p'
+            for row in await conn.fetch(LIST_JOB_PARTITIONS_SQL, self.table_name):
+                relname = row['relname']
+                suffix = relname[len(name_prefix):]
+                if not relname.startswith(name_prefix) or len(suffix) != 8 or not suffix.isdigit():
+                    continue  # Default partition, or not one of ours
+                part_start = datetime.strptime(suffix, '%Y%m%d').replace(tzinfo=timezone.utc)
+                if next_partition_start(part_start, self.partition_interval) <= cutoff:
+                    partition_name = schema_prefix + relname
+                    async with conn.transaction():
+                        await conn.execute(DETACH_JOB_PARTITION.format(
+                            table_name=self.table_name, partition_name=partition_name))
+                        if self.drop_detached:
+                            await conn.execute(f'DROP TABLE {partition_name}')
+                    detached.append(partition_name)
+        return detached
+
+    def start_maintenance(self, every=3600):
+        '''
+        Launch a background task running `maintain_partitions` every `every` seconds. Returns the task
+        '''
+        async def maintenance_loop():
+            while True:
+                await asyncio.sleep(every)
+                try:
+                    await self.maintain_partitions()
+                except Exception:
+                    # e.g. the DB was briefly unreachable; try again next time round
+                    logger.exception('Partition maintenance of job table %s failed', self.table_name)
+
+        self._maintenance_task = asyncio.ensure_future(maintenance_loop())
+        return self._maintenance_task
 
     async def new(self, operation: str, params: dict | None = None, metadata: dict | None = None):
         params = params or {}
@@ -62,6 +275,8 @@ class pg_manager:
             metadata = json.dumps(metadata)
         start_ts = datetime.now(tz=timezone.utc)
         # metadata = metadata or {}  # Eh! Null is fine
+        if self.batch_size:
+            return await self._enqueue(self._pending_new, (start_ts, params, self.pipeline_version, metadata))
         async with self.pool.acquire() as conn:
             async with conn.transaction():
                 row = await conn.fetchrow(
@@ -69,12 +284,245 @@ class pg_manager:
                     start_ts, params, self.pipeline_version, metadata)
         return row['id']
 
-    async def complete(self, jobid, success, completion_info):
+    async def complete(self, jobid, success, completion_info, metrics=None):
+        '''
+        Record the end of a job. metrics, if given (e.g. from `arkestra.jobs.instrument.job_metrics.as_metadata`),
+        is stored in the job's metadata under the `metrics` key
+        '''
         end_ts = datetime.now(tz=timezone.utc)
         if self.stringify_json:
             completion_info = json.dumps(completion_info)
+        if metrics is not None:
+            metrics = json.dumps(metrics)
+        if self.batch_size:
+            await self._enqueue(self._pending_complete, (jobid, end_ts, success, completion_info, metrics))
+            return
         async with self.pool.acquire() as conn:
             async with conn.transaction():
-                await conn.execute(
-                    JOB_COMPLETE_SQL.format(table_name=self.table_name),
-                    jobid, end_ts, success, completion_info)
+                await self._complete_row(conn, jobid, end_ts, success, completion_info, metrics)
+
+    async def _complete_row(self, conn, jobid, end_ts, success, completion_info, metrics):
+        if metrics is None:
+            await conn.execute(
+                JOB_COMPLETE_SQL.format(table_name=self.table_name),
+                jobid, end_ts, success, completion_info)
+        else:
+            await conn.execute(
+                JOB_COMPLETE_METRICS_SQL.format(table_name=self.table_name, json_type=self.json_type),
+                jobid, end_ts, success, completion_info, metrics)
+
+    async def get(self, jobid):
+        '''
+        Retrieve a single job record by ID, or None if there is no such job
+        '''
+        async with self.pool.acquire() as conn:
+            return await conn.fetchrow(JOB_GET_SQL.format(columns=JOB_COLUMNS, table_name=self.table_name), jobid)
+
+    async def query(self, since=None, until=None, success=None, pipeline_version=None, incomplete=None,
+                    request_contains=None, metadata_contains=None, descending=False, page_size=1000):
+        '''
+        Retrieve job records matching all the given criteria, as an async generator, ordered by start time
+
+        since, until - datetimes bounding job start (since inclusive, until exclusive)
+        success - if not None, only jobs whose success flag matches
+        pipeline_version - if not None, only jobs run by this pipeline version
+        incomplete - if True, only jobs not yet completed; if False, only completed jobs
+        request_contains, metadata_contains - dicts which the job's request or metadata must contain
+            (JSONB containment, i.e. `@>`)
+        descending - newest jobs first
+        page_size - rows per keyset page. Each page is fetched in one short query, & the connection returned to
+            the pool before its rows are yielded, so memory use stays flat however many rows match, & a caller
+            which stops iterating early holds no connection
+
+        >>> async for job in jm.query(since=yesterday, success=False):
+        ...     print(job['id'], job['response'])
+        '''
+        where = []
+        args = []
+
+        def add_clause(clause, *values):
+            for v in values:
+                args.append(v)
+                clause = clause.replace('?', f'${len(args)}', 1)
+            where.append(clause)
+
+        if since is not None:
+            add_clause('job_start >= ?', since)
+        if until is not None:
+            add_clause('job_start < ?', until)
+        if success is not None:
+            add_clause('success = ?', success)
+        if pipeline_version is not None:
+            add_clause('pipeline_version = ?', pipeline_version)
+        if incomplete is not None:
+            where.append('job_end IS NULL' if incomplete else 'job_end IS NOT NULL')
+        if request_contains is not None:
+            add_clause('request::jsonb @> ?::text::jsonb', json.dumps(request_contains))
+        if metadata_contains is not None:
+            add_clause('metadata::jsonb @> ?::text::jsonb', json.dumps(metadata_contains))
+
+        direction = 'DESC' if descending else 'ASC'
+        keyset_op = '<' if descending else '>'
+        base_where, base_args = where, args
+        last_key = None
+        while True:
+            where, args = list(base_where), list(base_args)
+            if last_key is not None:
+                add_clause(f'(job_start, id) {keyset_op} (?, ?)', *last_key)
+            sql = JOB_QUERY_SQL.format(columns=JOB_COLUMNS, table_name=self.table_name,
+                                       where=' AND '.join(where) or 'TRUE', direction=direction, limit=page_size)
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch(sql, *args)
+            for row in rows:
+                yield row
+            if len(rows) < page_size:
+                break
+            last_key = (rows[-1]['job_start'], rows[-1]['id'])
+
+    async def _enqueue(self, pending, record):
+        '''
+        Add a call to the buffer & wait for the flush which writes it
+        '''
+        fut = asyncio.get_running_loop().create_future()
+        pending.append((*record, fut))
+        if len(self._pending_new) + len(self._pending_complete) >= self.batch_size:
+            self._start_flush()
+        elif self._flush_timer is None and not self._flushing():
+            self._flush_timer = asyncio.get_running_loop().call_later(self.flush_interval, self._start_flush)
+        return await fut
+
+    def _flushing(self):
+        return self._flush_task is not None and not self._flush_task.done()
+
+    def _start_flush(self):
+        '''
+        Start a background flush, unless one is already running (it picks up whatever is pending when it's done)
+        '''
+        self._cancel_flush_timer()
+        if self._flushing():
+            return
+        self._flush_task = asyncio.ensure_future(self._flush_pending())
+        self._flush_task.add_done_callback(_log_flush_failure)
+
+    async def _flush_pending(self):
+        while self._pending_new or self._pending_complete:
+            await self.flush()
+
+    def _cancel_flush_timer(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+    async def flush(self):
+        '''
+        Write all buffered `new` & `complete` calls, resolving their futures. A no-op in unbuffered mode
+        '''
+        async with self._flush_lock:
+            self._cancel_flush_timer()
+            # Swap buffers out first, so calls made while we're writing start a new batch
+            new_batch, self._pending_new = self._pending_new, []
+            complete_batch, self._pending_complete = self._pending_complete, []
+            if not new_batch and not complete_batch:
+                return
+            try:
+                async with self.pool.acquire() as conn:
+                    async with conn.transaction():
+                        ids = []
+                        if new_batch:
+                            rows = await conn.fetch(
+                                JOB_RESERVE_IDS_SQL.format(table_name=self.table_name), len(new_batch))
+                            ids = [row['id'] for row in rows]
+                            await conn.executemany(
+                                JOB_BATCH_INSERT_SQL.format(table_name=self.table_name),
+                                [(jid, *rec[:-1]) for jid, rec in zip(ids, new_batch)])
+                        # Inserts go first, in case any completions refer to jobs in the same batch
+                        plain = [rec[:4] for rec in complete_batch if rec[4] is None]
+                        with_metrics = [rec[:5] for rec in complete_batch if rec[4] is not None]
+                        if plain:
+                            await conn.executemany(JOB_COMPLETE_SQL.format(table_name=self.table_name), plain)
+                        if with_metrics:
+                            await conn.executemany(
+                                JOB_COMPLETE_METRICS_SQL.format(table_name=self.table_name, json_type=self.json_type),
+                                with_metrics)
+            except Exception:
+                await self._write_each(new_batch, complete_batch)
+                return
+            for jid, rec in zip(ids, new_batch):
+                _resolve(rec[-1], jid)
+            for rec in complete_batch:
+                _resolve(rec[-1], None)
+
+    async def _write_each(self, new_batch, complete_batch):
+        '''
+        Write the calls of a failed batch one at a time, each in its own transaction, so only the bad ones fail
+        '''
+        try:
+            async with self.pool.acquire() as conn:
+                for rec in new_batch:
+                    try:
+                        async with conn.transaction():
+                            jid = await conn.fetchval(JOB_INSERT_SQL.format(table_name=self.table_name), *rec[:-1])
+                    except Exception as e:
+                        _resolve(rec[-1], exc=e)
+                    else:
+                        _resolve(rec[-1], jid)
+                for rec in complete_batch:
+                    try:
+                        async with conn.transaction():
+                            await self._complete_row(conn, *rec[:-1])
+                    except Exception as e:
+                        _resolve(rec[-1], exc=e)
+                    else:
+                        _resolve(rec[-1], None)
+        except Exception as e:  # e.g. the DB is unreachable
+            for rec in new_batch + complete_batch:
+                _resolve(rec[-1], exc=e)
+
+    async def close(self):
+        '''
+        Flush any buffered calls & stop partition maintenance. The pool itself belongs to the caller, so is left open
+        '''
+        if self._maintenance_task is not None:
+            self._maintenance_task.cancel()
+            self._maintenance_task = None
+        if self._flushing():
+            await asyncio.wait([self._flush_task])
+        await self.flush()
+
+
+def _resolve(fut, result=None, exc=None):
+    if fut.done():  # e.g. the caller was cancelled
+        return
+    if exc is not None:
+        fut.set_exception(exc)
+    else:
+        fut.set_result(result)
+
+
+def _log_flush_failure(task):
+    # Failed writes are reported to their callers; this catches anything else, which would otherwise go unseen
+    if not task.cancelled() and task.exception() is not None:
+        logger.error('Job batch flush failed', exc_info=task.exception())
+
+
+def partition_floor(ts, interval):
+    '''
+    Start (UTC midnight) of the partition interval containing timestamp ts
+    '''
+    ts = ts.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    if interval == 'week':
+        return ts - timedelta(days=ts.weekday())
+    if interval == 'month':
+        return ts.replace(day=1)
+    return ts
+
+
+def next_partition_start(start, interval):
+    '''
+    Start of the partition interval following the one which begins at start
+    '''
+    if interval == 'week':
+        return start + timedelta(weeks=1)
+    if interval == 'month':
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return start + timedelta(days=1)
@@ -0,0 +1,272 @@
+# SPDX-FileCopyrightText: 2024-present Oori Data <info@oori.dev>
+#
+# SPDX-License-Identifier: Apache-2.0
+# arkestra.jobs.pg_queue
+'''
+Durable work queue on top of the PostgreSQL job table
+
+Workers claim pending jobs with `SELECT … FOR UPDATE SKIP LOCKED`, so any number of worker processes, on any
+number of nodes, can drain the same table without blocking each other. A claimed job carries a lease which the
+worker extends by heartbeat; if the worker dies, the lease lapses & the job becomes claimable again, up to its
+maximum number of attempts. Enqueueing sends a NOTIFY, so idle workers wake up immediately rather than polling.
+'''
+import json
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from arkestra.jobs import PENDING
+from arkestra.jobs.pg_manager import pg_manager
+
+logger = logging.getLogger(__name__)
+
+# Jobs logged with plain `new` have NULL status, so are never claimed
+ADD_QUEUE_COLUMNS = '''-- Add work queue columns to the job table
+ALTER TABLE {table_name}
+    ADD COLUMN IF NOT EXISTS operation TEXT,                    -- operation requested of the worker
+    ADD COLUMN IF NOT EXISTS status TEXT,                       -- pending, running, succeeded or failed
+    ADD COLUMN IF NOT EXISTS attempts INT NOT NULL DEFAULT 0,   -- number of times the job has been claimed
+    ADD COLUMN IF NOT EXISTS max_attempts INT NOT NULL DEFAULT 1,
+    ADD COLUMN IF NOT EXISTS available_at TIMESTAMP WITH TIME ZONE,   -- earliest time it can be (re)claimed
+    ADD COLUMN IF NOT EXISTS lease_expires TIMESTAMP WITH TIME ZONE,  -- when a running job's claim lapses
+    ADD COLUMN IF NOT EXISTS worker_id TEXT;                    -- worker holding (or last holding) the job
+CREATE INDEX IF NOT EXISTS {index_prefix}_claimable_idx ON {table_name} (available_at, id)
+    WHERE status IN ('pending', 'running');
+'''
+
+QUEUE_INSERT_SQL = '''
+INSERT INTO {table_name} (job_start, operation, request, pipeline_version, metadata, status, max_attempts, available_at)
+VALUES ($1, $2, $3, $4, $5, 'pending', $6, $1) RETURNING id
+'''
+
+NOTIFY_SQL = '''
+SELECT pg_notify($1, '')
+'''
+
+# Running jobs whose lease has lapsed are claimable again, as long as they have attempts left
+QUEUE_CLAIM_SQL = '''
+UPDATE {table_name} SET status='running', attempts=attempts + 1, worker_id=$1,
+    lease_expires=now() + make_interval(secs => $2)
+WHERE id IN (
+    SELECT id FROM {table_name}
+    WHERE ((status='pending' AND available_at <= now()) OR (status='running' AND lease_expires < now()))
+        AND attempts < max_attempts
+    ORDER BY available_at, id
+    LIMIT $3
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING id, operation, request, metadata, attempts, max_attempts
+'''
+
+QUEUE_HEARTBEAT_SQL = '''
+UPDATE {table_name} SET lease_expires=now() + make_interval(secs => $3)
+WHERE id=$1 AND worker_id=$2 AND status='running'
+'''
+
+# Failures with attempts left go back to pending, after the retry delay. Only a running job can be completed, & only
+# by the worker holding it, if given, so one whose lease lapsed can't overwrite a job since claimed by another.
+# Jobs logged with plain `new` (NULL status) are completed as with `pg_manager.complete`, then marked succeeded or
+# failed. SET expressions see the row's prior status
+QUEUE_COMPLETE_SQL = '''
+UPDATE {table_name} SET
+    status=CASE WHEN $3 THEN 'succeeded' WHEN status='running' AND attempts < max_attempts THEN 'pending'
+        ELSE 'failed' END,
+    job_end=CASE WHEN $3 OR status IS NULL OR attempts >= max_attempts THEN $2::timestamptz END,
+    available_at=CASE WHEN NOT $3 AND status='running' AND attempts < max_attempts
+        THEN $2::timestamptz + make_interval(secs => $5) ELSE available_at END,
+    success=$3, response=$4, lease_expires=NULL,
+    metadata=CASE WHEN $6::text IS NULL THEN metadata
+        ELSE (COALESCE(metadata::jsonb, '{{}}'::jsonb) || jsonb_build_object('metrics', $6::text::jsonb))::{json_type}
+    END
+WHERE id=$1 AND (status='running' OR status IS NULL) AND ($7::text IS NULL OR worker_id=$7)
+RETURNING status
+'''
+
+# Lapsed leases on jobs with no attempts left are never reclaimed, so mark them failed
+QUEUE_REAP_SQL = '''
+UPDATE {table_name} SET status='failed', success=FALSE, job_end=now(), lease_expires=NULL
+WHERE status='running' AND lease_expires < now() AND attempts >= max_attempts
+'''
+
+
+class pg_queue(pg_manager):
+    '''
+    PostgreSQL job manager which also works as a durable queue
+
+    Producers `enqueue` jobs; workers either `claim` them directly (then `heartbeat` & `complete`), or just run
+    the `work` loop with a handler coroutine. The queue columns are added to the job table if missing, so an
+    existing job log table can be upgraded in place.
+
+    >>> from arkestra.jobs.pg_queue import pg_queue
+    >>> q = pg_queue('jobs', pipeline_version='1.0')
+    >>> await q.async_init(pool)
+    >>> await q.enqueue('scrape', {'url': url}, max_attempts=3)
+    >>> # Elsewhere, in any number of worker processes:
+    >>> async def handler(job):
+    ...     return {'content': await load_page_markdown(json.loads(job['request'])['url'])}
+    >>> await q.work(handler, concurrency=4)
+    '''
+    def __init__(self, table_name, pipeline_version=None, stringify_json=False, lease=30, max_attempts=3,
+                 retry_delay=5, **kwargs):
+        if kwargs.get('batch_size'):
+            raise ValueError('Buffered mode doesn\'t apply to queue operations; leave batch_size unset')
+        super().__init__(table_name, pipeline_version=pipeline_version, stringify_json=stringify_json, **kwargs)
+        self.lease = lease  # seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay  # seconds
+        self.channel = self.table_name.replace('.', '_') + '_queue'
+
+    async def async_init(self, pool):
+        await super().async_init(pool)
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(ADD_QUEUE_COLUMNS.format(
+                    table_name=self.table_name, index_prefix=self.table_name.rpartition('.')[2]))
+
+    async def enqueue(self, operation: str, params: dict | None = None, metadata: dict | None = None,
+                      max_attempts: int | None = None):
+        '''
+        Add a pending job to the queue, waking up any idle workers. Returns the job ID
+        '''
+        params = params or {}
+        metadata = metadata or {}
+        if self.stringify_json:
+            params = json.dumps(params)
+            metadata = json.dumps(metadata)
+        max_attempts = max_attempts or self.max_attempts
+        start_ts = datetime.now(tz=timezone.utc)
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                row = await conn.fetchrow(
+                    QUEUE_INSERT_SQL.format(table_name=self.table_name),
+                    start_ts, operation, params, self.pipeline_version, metadata, max_attempts)
+                # Delivered on commit
+                await conn.execute(NOTIFY_SQL, self.channel)
+        return row['id']
+
+    async def claim(self, worker_id, limit=1, lease=None):
+        '''
+        Claim up to limit claimable jobs for worker_id, leasing them for lease seconds. Returns the claimed records
+        (id, operation, request, metadata, attempts, max_attempts), possibly empty
+        '''
+        lease = lease or self.lease
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                return await conn.fetch(
+                    QUEUE_CLAIM_SQL.format(table_name=self.table_name), worker_id, lease, limit)
+
+    async def heartbeat(self, jobid, worker_id, lease=None):
+        '''
+        Extend worker_id's lease on a running job. Returns False if the worker no longer holds the job
+        (e.g. the lease lapsed & another worker claimed it)
+        '''
+        lease = lease or self.lease
+        async with self.pool.acquire() as conn:
+            status = await conn.execute(
+                QUEUE_HEARTBEAT_SQL.format(table_name=self.table_name), jobid, worker_id, lease)
+        return status != 'UPDATE 0'
+
+    async def complete(self, jobid, success, completion_info, metrics=None, retry_delay=None, worker_id=None):
+        '''
+        Record the outcome of a claimed job. A failed job with attempts left is requeued after retry_delay
+        seconds. metrics is stored in the job's metadata, as with `pg_manager.complete`. Jobs logged with plain
+        `new` can also be completed, without worker_id; they're never requeued.
+        Returns the job's resulting status, or None if nothing was updated: the job isn't running (or a plain
+        `new` job), or worker_id was given & no longer holds it (e.g. its lease lapsed & another worker claimed
+        the job)
+        '''
+        end_ts = datetime.now(tz=timezone.utc)
+        if self.stringify_json:
+            completion_info = json.dumps(completion_info)
+        if metrics is not None:
+            metrics = json.dumps(metrics)
+        retry_delay = self.retry_delay if retry_delay is None else retry_delay
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                status = await conn.fetchval(
+                    QUEUE_COMPLETE_SQL.format(table_name=self.table_name, json_type=self.json_type),
+                    jobid, end_ts, success, completion_info, retry_delay, metrics, worker_id)
+                if status == PENDING:
+                    await conn.execute(NOTIFY_SQL, self.channel)
+        if status is None:
+            logger.warning('Job %s not completed: not running%s', jobid,
+                           f' or no longer held by worker {worker_id}' if worker_id else '')
+        return status
+
+    async def reap(self):
+        '''
+        Mark as failed any running jobs whose lease lapsed with no attempts left
+        '''
+        async with self.pool.acquire() as conn:
+            await conn.execute(QUEUE_REAP_SQL.format(table_name=self.table_name))
+
+    async def work(self, handler, worker_id=None, concurrency=1, poll_interval=30, stop=None):
+        '''
+        Run a worker loop, claiming & handling jobs until the stop event (an asyncio.Event) is set, or the task
+        is cancelled
+
+        handler - coroutine function taking the claimed job record & returning the completion info. If it raises,
+            the job is completed as failed, with the error as completion info
+        concurrency - maximum jobs handled at once by this worker
+        poll_interval - seconds to wait between claim attempts when idle & no notification arrives. Covers
+            retries coming due & lapsed leases, which don't send notifications
+        '''
+        worker_id = worker_id or self.new_jobid()
+        stop = stop or asyncio.Event()
+        wakeup = asyncio.Event()
+        slots = asyncio.Semaphore(concurrency)
+        in_flight = set()
+
+        def on_notify(*args):
+            wakeup.set()
+
+        async def run_job(job):
+            heartbeat_task = asyncio.ensure_future(self._keep_alive(job['id'], worker_id))
+            try:
+                try:
+                    result = await handler(job)
+                    success = True
+                except Exception as e:
+                    result, success = {'error': repr(e)}, False
+            finally:
+                heartbeat_task.cancel()
+            try:
+                await self.complete(job['id'], success, result, worker_id=worker_id)
+            finally:
+                slots.release()
+
+        async with self.pool.acquire() as listen_conn:
+            await listen_conn.add_listener(self.channel, on_notify)
+            try:
+                while not stop.is_set():
+                    await slots.acquire()
+                    if stop.is_set():  # Set while waiting for a slot; don't claim another job
+                        slots.release()
+                        break
+                    # Clear before claiming, so a notification arriving mid-claim isn't lost
+                    wakeup.clear()
+                    jobs = await self.claim(worker_id)
+                    if not jobs:
+                        slots.release()
+                        await self.reap()
+                        waiters = [asyncio.ensure_future(wakeup.wait()), asyncio.ensure_future(stop.wait())]
+                        await asyncio.wait(waiters, timeout=poll_interval, return_when=asyncio.FIRST_COMPLETED)
+                        for w in waiters:
+                            w.cancel()
+                        continue
+                    task = asyncio.ensure_future(run_job(jobs[0]))
+                    in_flight.add(task)
+                    task.add_done_callback(in_flight.discard)
+                if in_flight:
+                    await asyncio.wait(in_flight)
+            finally:
+                await listen_conn.remove_listener(self.channel, on_notify)
+
+    async def _keep_alive(self, jobid, worker_id):
+        '''
+        Heartbeat a running job at a third of the lease period, so a single missed beat doesn't lose it
+        '''
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            if not await self.heartbeat(jobid, worker_id):
+                return
@@ -0,0 +1,280 @@
+# SPDX-FileCopyrightText: 2024-present Oori Data <info@oori.dev>
+#
+# SPDX-License-Identifier: Apache-2.0
+# arkestra.jobs.sqlite_manager
+'''
+SQLite job manager, for durable job tracking where PostgreSQL isn't available (edge boxes, tests, etc.)
+
+Mirrors the `pg_manager` API. The DB runs in WAL mode, and all writes go through a dedicated writer thread which
+commits whatever has queued up since its last commit as one transaction (group commit), so throughput isn't
+bounded by one fsync per job.
+'''
+import json
+import queue
+import asyncio
+import sqlite3
+import threading
+from uuid import uuid4
+from datetime import datetime, timezone
+
+CREATE_JOB_TABLE = '''-- Create a table to hold jobs info
+CREATE TABLE IF NOT EXISTS {table_name} (
+    id INTEGER PRIMARY KEY,
+    job_start TEXT,             -- ISO 8601 UTC timestamp of job start
+    job_end TEXT,               -- ISO 8601 UTC timestamp of job end (successful or not)
+    success INTEGER,            -- did the job succeed?
+    request TEXT,               -- job request params JSON
+    response TEXT,              -- job response JSON
+    pipeline_version TEXT,      -- Version indicator for the pipeline which ran the job
+    metadata TEXT               -- Any additional metadata JSON
+);
+CREATE INDEX IF NOT EXISTS {table_name}_start_id_idx ON {table_name} (job_start, id);
+CREATE INDEX IF NOT EXISTS {table_name}_version_start_idx ON {table_name} (pipeline_version, job_start);
+CREATE INDEX IF NOT EXISTS {table_name}_incomplete_idx ON {table_name} (job_start) WHERE job_end IS NULL;
+'''
+
+JOB_INSERT_SQL = '''
+INSERT INTO {table_name} (job_start, request, pipeline_version, metadata) VALUES (?, ?, ?, ?)
+'''
+
+JOB_COMPLETE_SQL = '''
+UPDATE {table_name} SET job_end=?, success=?, response=? WHERE id=?
+'''
+
+# Also merges instrumentation (see arkestra.jobs.instrument) into metadata, under the `metrics` key
+JOB_COMPLETE_METRICS_SQL = '''
+UPDATE {table_name} SET job_end=?, success=?, response=?,
+    metadata=json_set(COALESCE(metadata, '{{}}'), '$.metrics', json(?))
+WHERE id=?
+'''
+
+JOB_COLUMNS = ('id', 'job_start', 'job_end', 'success', 'request', 'response', 'pipeline_version', 'metadata')
+
+JOB_GET_SQL = '''
+SELECT {columns} FROM {table_name} WHERE id=?
+'''
+
+JOB_QUERY_SQL = '''
+SELECT {columns} FROM {table_name}
+WHERE {where}
+ORDER BY job_start {direction}, id {direction}
+LIMIT {limit}
+'''
+
+
+class sqlite_manager:
+    '''
+    SQLite job manager
+
+    >>> from arkestra.jobs.sqlite_manager import sqlite_manager
+    >>> jm = sqlite_manager('jobs.db', 'jobs', pipeline_version='1.0')
+    >>> await jm.async_init()
+    >>> jobid = await jm.new('scrape', {'url': url})
+    >>> await jm.complete(jobid, True, {'length': 1234})
+    >>> await jm.close()
+
+    Job records are returned as dicts, with JSON columns decoded & timestamps as datetimes.
+    max_batch caps the number of writes per group commit.
+    '''
+    def __init__(self, db_path, table_name='jobs', pipeline_version=None, max_batch=1000):
+        self.db_path = str(db_path)
+        self.table_name = table_name
+        # In most cases the pipeline version os const for the instance
+        self.pipeline_version = pipeline_version
+        self.max_batch = max_batch
+        self._writes = queue.Queue()
+        self._writer = None
+        self._read_conn = None
+        self._read_lock = threading.Lock()
+
+    def new_jobid(self):
+        return str(uuid4())
+
+    async def async_init(self):
+        '''
+        Create the job table if it doesn't yet exist, & start the writer thread
+        '''
+        def init():
+            conn = sqlite3.connect(self.db_path)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(CREATE_JOB_TABLE.format(table_name=self.table_name))
+            conn.close()
+            self._read_conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._read_conn.row_factory = sqlite3.Row
+
+        await asyncio.to_thread(init)
+        self._writer = threading.Thread(target=self._write_loop, name=f'{self.table_name}-writer', daemon=True)
+        self._writer.start()
+
+    async def new(self, operation: str, params: dict | None = None, metadata: dict | None = None):
+        params = params or {}
+        metadata = metadata or {}
+        start_ts = datetime.now(tz=timezone.utc)
+        return await self._write(JOB_INSERT_SQL.format(table_name=self.table_name),
+                                 (start_ts.isoformat(), json.dumps(params), self.pipeline_version,
+                                  json.dumps(metadata)))
+
+    async def complete(self, jobid, success, completion_info, metrics=None):
+        end_ts = datetime.now(tz=timezone.utc)
+        if metrics is None:
+            await self._write(JOB_COMPLETE_SQL.format(table_name=self.table_name),
+                              (end_ts.isoformat(), success, json.dumps(completion_info), jobid))
+        else:
+            await self._write(JOB_COMPLETE_METRICS_SQL.format(table_name=self.table_name),
+                              (end_ts.isoformat(), success, json.dumps(completion_info), json.dumps(metrics), jobid))
+
+    async def flush(self):
+        '''
+        Wait until all writes queued so far are committed
+        '''
+        await self._write(None, None)
+
+    async def close(self):
+        '''
+        Commit outstanding writes, then stop the writer thread & close the DB
+        '''
+        if self._writer is None:
+            return
+        await self.flush()
+        self._writes.put(None)
+        await asyncio.to_thread(self._writer.join)
+        self._writer = None
+        self._read_conn.close()
+
+    def _write(self, sql, args):
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._writes.put((sql, args, loop, fut))
+        return fut
+
+    def _write_loop(self):
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        # Durable across application crashes; in WAL mode only a power loss can drop the latest commits
+        conn.execute('PRAGMA synchronous=NORMAL')
+        while True:
+            item = self._writes.get()
+            if item is None:
+                break
+            batch = [item]
+            # Group commit: take whatever else has queued up meanwhile
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._writes.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._writes.put(None)  # Handle the stop after this batch
+                    break
+                batch.append(item)
+
+            try:
+                self._commit(conn, batch)
+            except Exception:
+                # Retry one by one, so a single bad write only fails its own caller
+                for item in batch:
+                    try:
+                        self._commit(conn, [item])
+                    except Exception as e:
+                        item[2].call_soon_threadsafe(_set_future, item[3], None, e)
+        conn.close()
+
+    def _commit(self, conn, batch):
+        '''
+        Run a batch of writes in one transaction, then resolve their futures
+        '''
+        results = []
+        try:
+            conn.execute('BEGIN')
+            for sql, args, _, _ in batch:
+                if sql is None:  # flush barrier
+                    results.append(None)
+                    continue
+                cur = conn.execute(sql, args)
+                results.append(cur.lastrowid)
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        for (_, _, loop, fut), result in zip(batch, results):
+            loop.call_soon_threadsafe(_set_future, fut, result, None)
+
+    async def get(self, jobid):
+        '''
+        Retrieve a single job record by ID, or None if there is no such job
+        '''
+        rows = await asyncio.to_thread(
+            self._read, JOB_GET_SQL.format(columns=', '.join(JOB_COLUMNS), table_name=self.table_name), (jobid,))
+        return rows[0] if rows else None
+
+    async def query(self, since=None, until=None, success=None, pipeline_version=None, incomplete=None,
+                    request_contains=None, metadata_contains=None, descending=False, page_size=1000):
+        '''
+        Retrieve job records matching all the given criteria, as an async generator, ordered by start time.
+        Same criteria as `pg_manager.query`, except that request_contains & metadata_contains only match
+        top-level keys (by equality of their JSON values). Pages are keyset-paginated on (job_start, id)
+        '''
+        where = []
+        args = []
+        if since is not None:
+            where.append('job_start >= ?')
+            args.append(since.astimezone(timezone.utc).isoformat())
+        if until is not None:
+            where.append('job_start < ?')
+            args.append(until.astimezone(timezone.utc).isoformat())
+        if success is not None:
+            where.append('success = ?')
+            args.append(success)
+        if pipeline_version is not None:
+            where.append('pipeline_version = ?')
+            args.append(pipeline_version)
+        if incomplete is not None:
+            where.append('job_end IS NULL' if incomplete else 'job_end IS NOT NULL')
+        for column, contains in (('request', request_contains), ('metadata', metadata_contains)):
+            for k, v in (contains or {}).items():
+                where.append(f'json_extract({column}, ?) = json_extract(?, \'$\')')
+                args.extend([f'$."{k}"', json.dumps(v)])
+
+        direction = 'DESC' if descending else 'ASC'
+        keyset_op = '<' if descending else '>'
+        last_key = None
+        while True:
+            page_where, page_args = list(where), list(args)
+            if last_key is not None:
+                page_where.append(f'(job_start, id) {keyset_op} (?, ?)')
+                page_args.extend(last_key)
+            sql = JOB_QUERY_SQL.format(columns=', '.join(JOB_COLUMNS), table_name=self.table_name,
+                                       where=' AND '.join(page_where) or '1', direction=direction, limit=page_size)
+            rows = await asyncio.to_thread(self._read, sql, page_args)
+            for row in rows:
+                yield row
+            if len(rows) < page_size:
+                break
+            last_key = (rows[-1]['job_start'].isoformat(), rows[-1]['id'])
+
+    def _read(self, sql, args):
+        with self._read_lock:
+            rows = self._read_conn.execute(sql, args).fetchall()
+        return [_decode_row(row) for row in rows]
+
+
+def _decode_row(row):
+    record = dict(row)
+    for k in ('job_start', 'job_end'):
+        if record[k]:
+            record[k] = datetime.fromisoformat(record[k])
+    for k in ('request', 'response', 'metadata'):
+        if record[k] is not None:
+            record[k] = json.loads(record[k])
+    if record['success'] is not None:
+        record['success'] = bool(record['success'])
+    return record
+
+
+def _set_future(fut, result, exc):
+    if fut.done():
+        return
+    if exc is not None:
+        fut.set_exception(exc)
+    else:
+        fut.set_result(result)
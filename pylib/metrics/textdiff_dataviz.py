@@ -9,20 +9,35 @@ Tools for metrics (AKA evaluations) for data & GenAI pipelines ops
 - Heatmap provides a clear overview of all similarities at once
 - HTML table is interactive and can be shared easily
 - Plotly 3D visualization allows for interactive exploration of the relationships
+
+The plotting libraries (seaborn, matplotlib, pandas, plotly, numpy) are slow to import, so each is imported
+within the function needing it, on first call
 '''
-import seaborn as sns
-import matplotlib.pyplot as plt
-import pandas as pd
-import plotly.graph_objects as go
-import numpy as np
+import importlib
+
 from utiloori.plaintext import truncate_text_middle
 
+# The names this module used to import eagerly, still available as attributes (e.g. `textdiff_dataviz.pd`), imported
+# on first access
+_LAZY_MODULES = {'sns': 'seaborn', 'plt': 'matplotlib.pyplot', 'pd': 'pandas', 'go': 'plotly.graph_objects',
+                 'np': 'numpy'}
+
+
+def __getattr__(name):
+    if name not in _LAZY_MODULES:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    return importlib.import_module(_LAZY_MODULES[name])
+
 
 def similarities_heatmap(reftexts, target_texts, similarities, model_name):
     '''
     Build a similarity heatmap using Seaborn/Matplotlib from texts being compared via some 0.0-1.0 normalized method
     (e.g. vector cosine similarity)
     '''
+    import pandas as pd
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+
     # Create a DataFrame for the heatmap
     df = pd.DataFrame(similarities, 
                      index=[f'Ref {i+1}: {text[:30]}...' for i, text in enumerate(reftexts)],
@@ -102,6 +117,9 @@ def plotly_3d_viz(reftexts, target_texts, similarities, model_name):
     Build a, interactive Plotly visualization from texts being compared via some 0.0-1.0 normalized method
     (e.g. vector cosine similarity)
     '''
+    import numpy as np
+    import plotly.graph_objects as go
+
     x = []
     y = []
     z = []
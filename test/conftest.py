@@ -0,0 +1,43 @@
+# test/conftest.py
+'''
+Shared fixtures
+
+PostgreSQL tests run against the server at the ARKESTRA_TEST_PG_DSN environment variable (e.g.
+postgresql://postgres@localhost/postgres), each in a scratch schema which is dropped afterward, and are skipped if
+it isn't set
+'''
+import os
+import json
+from uuid import uuid4
+
+import pytest
+import pytest_asyncio
+
+PG_DSN = os.environ.get('ARKESTRA_TEST_PG_DSN')
+
+
+async def _init_connection(conn):
+    # Job managers pass JSON columns as Python objects
+    for json_type in ('json', 'jsonb'):
+        await conn.set_type_codec(json_type, encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+
+@pytest_asyncio.fixture
+async def pg_pool():
+    asyncpg = pytest.importorskip('asyncpg')
+    if not PG_DSN:
+        pytest.skip('Set ARKESTRA_TEST_PG_DSN to run PostgreSQL tests')
+    pool = await asyncpg.create_pool(PG_DSN, min_size=1, max_size=4, init=_init_connection)
+    yield pool
+    await pool.close()
+
+
+@pytest_asyncio.fixture
+async def pg_schema(pg_pool):
+    '''Name of a scratch schema, dropped with its contents after the test'''
+    schema = f'arkestra_test_{uuid4().hex[:12]}'
+    async with pg_pool.acquire() as conn:
+        await conn.execute(f'CREATE SCHEMA {schema}')
+    yield schema
+    async with pg_pool.acquire() as conn:
+        await conn.execute(f'DROP SCHEMA {schema} CASCADE')
@@ -0,0 +1,178 @@
+# test/test_fileio.py
+import io
+import os
+import json
+from array import array
+
+import pytest
+
+from arkestra.components.fileio import jsonable, record_store, artifact_cache, iter_json_array, BACKENDS
+
+
+def test_jsonable_array_stream(tmp_path):
+    artifact = jsonable(tmp_path / 'pages.json')
+    records = [{'url': f'https://example.com/{i}', 'n': i} for i in range(100)]
+    artifact.save_iter(r for r in records)  # Any iterable, e.g. a generator
+    assert json.loads((tmp_path / 'pages.json').read_text()) == records
+    assert list(artifact.iter_items()) == records
+    assert artifact.load() == records
+
+
+def test_jsonable_lines(tmp_path):
+    artifact = jsonable(tmp_path / 'pages.jsonl')
+    assert artifact.lines
+    artifact.save([{'n': 1}, {'n': 2}])
+    artifact.append({'n': 3})
+    assert (tmp_path / 'pages.jsonl').read_text().count('\n') == 3
+    assert artifact.load() == [{'n': 1}, {'n': 2}, {'n': 3}]
+
+
+@pytest.mark.parametrize('initial', [None, '[]', '[1, 2]\n\n'])
+def test_jsonable_append_array(tmp_path, initial):
+    fpath = tmp_path / 'items.json'
+    if initial is not None:
+        fpath.write_text(initial)
+    artifact = jsonable(fpath)
+    artifact.append({'a': 'b'})
+    expected = (json.loads(initial) if initial else []) + [{'a': 'b'}]
+    assert json.loads(fpath.read_text()) == expected
+
+
+def test_jsonable_append_not_array(tmp_path):
+    fpath = tmp_path / 'obj.json'
+    fpath.write_text('{"a": 1}')
+    with pytest.raises(ValueError):
+        jsonable(fpath).append(2)
+
+
+def test_iter_json_array_across_chunks():
+    # Items (incl. numbers & strings) straddling chunk boundaries, & items far bigger than a chunk
+    items = [12345, 'x' * 50, {'nested': [1, 2, {'k': 'v,]'}]}, -0.5, True, None, list(range(40))]
+    text = ' [ ' + ' ,\n'.join(json.dumps(i) for i in items) + ' ] '
+    for chunk_size in (1, 3, 7, 1024):
+        assert list(iter_json_array(io.StringIO(text), chunk_size=chunk_size)) == items
+    assert list(iter_json_array(io.StringIO('[]'))) == []
+
+
+@pytest.mark.parametrize('text', ['{"a": 1}', '[1, 2', '[1 2]'])
+def test_iter_json_array_errors(text):
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.StringIO(text), chunk_size=2))
+
+
+@pytest.mark.parametrize('backend', list(BACKENDS))
+@pytest.mark.parametrize('suffix', ['.json', '.json.gz'])
+def test_backends_roundtrip(tmp_path, backend, suffix):
+    artifact = jsonable(tmp_path / ('data' + suffix), backend=backend)
+    obj = {1: 'a', 'big': 2**70, 'text': 'caf\u00e9'}  # Non-str key & int beyond 64 bits, as the stdlib allows
+    artifact.save(obj)
+    assert artifact.load() == {'1': 'a', 'big': 2**70, 'text': 'caf\u00e9'}
+
+
+
+@pytest.mark.parametrize('backend', list(BACKENDS))
+def test_backends_non_finite_floats(tmp_path, backend):
+    obj = {'nan': float('nan'), 'inf': [float('inf'), -float('inf')], 'none': None}
+    artifact = jsonable(tmp_path / 'data.json', backend=backend)
+    artifact.save(obj)
+    loaded = artifact.load()
+    assert loaded['nan'] != loaded['nan'] and loaded['inf'] == [float('inf'), -float('inf')]
+    assert loaded['none'] is None
+    # Written by the stdlib, as jsonable.save used to
+    (tmp_path / 'old.jsonl').write_text(json.dumps(obj) + '\n' + json.dumps([1.5]) + '\n')
+    records = jsonable(tmp_path / 'old.jsonl', backend=backend).load()
+    assert records[0]['inf'] == [float('inf'), -float('inf')] and records[1] == [1.5]
+
+def test_atomic_save_permissions(tmp_path):
+    fpath = tmp_path / 'data.json'
+    old_umask = os.umask(0o027)
+    try:
+        jsonable(fpath).save([1])
+        assert fpath.stat().st_mode & 0o777 == 0o640  # Umask read at write time
+        fpath.chmod(0o604)
+        jsonable(fpath).save([2])
+        assert fpath.stat().st_mode & 0o777 == 0o604  # Existing target's mode kept
+    finally:
+        os.umask(old_umask)
+    assert jsonable(fpath).load() == [2]
+    assert [p.name for p in tmp_path.iterdir()] == ['data.json']  # No temp files left
+
+
+def test_atomic_save_error_leaves_target(tmp_path):
+    fpath = tmp_path / 'data.json'
+    artifact = jsonable(fpath)
+    artifact.save([1, 2])
+
+    def failing():
+        yield 3
+        raise RuntimeError('mid-write')
+
+    with pytest.raises(RuntimeError):
+        artifact.save_iter(failing())
+    assert artifact.load() == [1, 2]
+    assert [p.name for p in tmp_path.iterdir()] == ['data.json']
+
+
+def test_record_store_random_access(tmp_path):
+    store = record_store(tmp_path / 'vecs.jsonl')
+    assert len(store) == 0
+    store.extend({'i': i, 'vec': [i, i / 2]} for i in range(5000))  # Spans index flushes
+    store.append({'i': 5000})
+    assert len(store) == 5001
+    assert store[1234] == {'i': 1234, 'vec': [1234, 617.0]}
+    assert store[-1] == {'i': 5000}
+    assert [r['i'] for r in store[10:13]] == [10, 11, 12]
+    assert [r['i'] for r in store][-3:] == [4998, 4999, 5000]
+    with pytest.raises(IndexError):
+        store[5001]
+    store.close()
+
+
+def test_record_store_reindex_and_torn_index(tmp_path):
+    fpath = tmp_path / 'data.jsonl'
+    fpath.write_text('{"a": 1}\n\n{"a": 2}\n')
+    store = record_store(fpath)
+    store.reindex()
+    assert list(store) == [{'a': 1}, {'a': 2}]
+    # Index entries past the end of the data (e.g. a crash mid-write) are ignored
+    with open(store.index_path, 'ab') as fp:
+        array('Q', [10**6]).tofile(fp)
+    store.close()
+    assert len(store) == 2
+    store.close()
+
+
+def test_artifact_cache_hits_and_upstream_keys(tmp_path):
+    cache = artifact_cache(tmp_path)
+    calls = []
+
+    def compute(value):
+        calls.append(value)
+        return value
+
+    pages, pages_key = cache.cached('scrape', {'urls': ['a']}, lambda: compute(['page']), jobid='j1')
+    again, again_key = cache.cached('scrape', {'urls': ['a']}, lambda: compute(['other']))
+    assert (pages, again, again_key, calls) == (['page'], ['page'], pages_key, [['page']])
+    assert cache.info(pages_key)['jobid'] == 'j1'
+    # A different upstream key changes the downstream key
+    assert cache.key('embed', {}, [pages_key]) != cache.key('embed', {}, ['other'])
+    assert cache.get('missing') is None
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_artifact_cache_evicts_lru(tmp_path, compression):
+    cache = artifact_cache(tmp_path, compression=compression)
+    keys = [cache.key('stage', i) for i in range(4)]
+    for n, key in enumerate(keys):
+        cache.put(key, 'x' * 1000)
+        os.utime(cache.path(key), (n, n))  # Oldest first
+    cache.get(keys[0])  # Now the most recently used
+    kept_size = sum(f.stat().st_size for k in (keys[0], keys[3]) for f in cache._paths(k))
+    cache.max_bytes = kept_size
+    cache.evict()
+    # Each artifact & its .meta.json sidecar are counted & evicted together, exactly once
+    assert [k in cache for k in keys] == [True, False, False, True]
+    assert all((cache.info(k) is not None) == (k in cache) for k in keys)
+    assert cache._total_bytes == kept_size
+    assert sorted(p.name for p in tmp_path.glob('*/*')) == sorted(
+        p.name for k in (keys[0], keys[3]) for p in cache._paths(k))
@@ -0,0 +1,79 @@
+# test/test_instrument.py
+import asyncio
+import urllib.request
+
+import pytest
+
+from arkestra.jobs.instrument import (job_metrics, metrics_registry, serve_metrics, count_bytes, count_tokens,
+                                      instrumented, current_job_metrics)
+
+
+def test_stage_measures_and_accumulates():
+    jm = job_metrics()
+    for _ in range(2):
+        with jm.stage('fetch'):
+            count_bytes(100)
+            sum(range(10000))
+    with jm.stage('summarize'):
+        count_tokens(prompt=10, completion=5)
+    count_bytes(999)  # Outside any stage: ignored
+    meta = jm.as_metadata()
+    assert meta['fetch']['calls'] == 2 and meta['fetch']['bytes_fetched'] == 200
+    assert meta['fetch']['wall_seconds'] > 0
+    assert meta['summarize']['prompt_tokens'] == 10 and meta['summarize']['completion_tokens'] == 5
+    assert meta['summarize']['bytes_fetched'] == 0
+
+
+@pytest.mark.asyncio
+async def test_attribution_across_tasks_and_decorator():
+    @instrumented()
+    async def embed(n):
+        count_tokens(prompt=n)
+        return current_job_metrics()
+
+    @instrumented('parse')
+    def parse():
+        count_bytes(7)
+
+    jobs = [job_metrics() for _ in range(2)]
+
+    async def run(jm, n):
+        with jm.stage('fetch'):
+            await asyncio.sleep(0.01)
+            count_bytes(n)
+            assert await embed(n) is jm
+            parse()
+
+    await asyncio.gather(run(jobs[0], 1), run(jobs[1], 2))
+    for jm, n in zip(jobs, (1, 2)):
+        meta = jm.as_metadata()
+        assert meta['fetch']['bytes_fetched'] == n  # Concurrent jobs don't mix
+        assert meta['embed']['prompt_tokens'] == n
+        assert meta['parse']['bytes_fetched'] == 7
+    assert await embed(3) is None  # No enclosing job: runs uninstrumented
+
+
+def test_registry_render_and_serve():
+    registry = metrics_registry()
+    jm = job_metrics(registry, pipeline_version='1"0')
+    with jm.stage('fetch'):
+        count_bytes(42)
+    prom = registry.render()
+    assert '# TYPE arkestra_stage_bytes_fetched_total counter' in prom
+    assert 'arkestra_stage_bytes_fetched_total{pipeline_version="1\\"0",stage="fetch"} 42' in prom
+    openmetrics = registry.render(openmetrics=True)
+    assert '# TYPE arkestra_stage_bytes_fetched counter' in openmetrics
+    assert openmetrics.endswith('# EOF\n')
+
+    server = serve_metrics(registry, port=0)
+    try:
+        url = f'http://127.0.0.1:{server.server_address[1]}/metrics'
+        with urllib.request.urlopen(url) as resp:
+            assert resp.headers['Content-Type'].startswith('text/plain')
+            assert b'stage="fetch"} 42' in resp.read()
+        req = urllib.request.Request(url, headers={'Accept': 'application/openmetrics-text'})
+        with urllib.request.urlopen(req) as resp:
+            assert resp.headers['Content-Type'].startswith('application/openmetrics-text')
+            assert resp.read().endswith(b'# EOF\n')
+    finally:
+        server.shutdown()
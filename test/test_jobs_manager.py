@@ -0,0 +1,62 @@
+# test/test_jobs_manager.py
+import time
+
+import pytest
+
+from arkestra.jobs import manager, RUNNING, SUCCEEDED, FAILED
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_new_complete_status():
+    jm = manager()
+    a = await jm.new('scrape', {'url': 'a'})
+    b = await jm.new('scrape', {'url': 'b'})
+    assert [j.jobid for j in jm.by_status(RUNNING)] == [a, b]
+    await jm.complete(a, True, {'length': 1}, metrics={'fetch': {'calls': 1}})
+    await jm.complete(b, False, {'error': 'x'})
+    assert jm.count(RUNNING) == 0
+    assert jm.count(SUCCEEDED) == 1 and jm.count(FAILED) == 1
+    job = jm.get(a)
+    assert job.result == {'length': 1} and job.metadata['metrics'] == {'fetch': {'calls': 1}}
+    assert job.job_end >= job.job_start
+    with pytest.raises(KeyError):
+        await jm.complete('nope', True, {})
+
+
+async def test_lru_eviction():
+    jm = manager(max_jobs=3)
+    ids = [await jm.new('op') for _ in range(3)]
+    jm.get(ids[0])  # Now most recently used
+    fourth = await jm.new('op')
+    assert len(jm) == 3
+    assert jm.get(ids[1]) is None  # Evicted, with no spill to recover from
+    assert {ids[0], ids[2], fourth} == set(jm.jobs)
+    assert jm.count(RUNNING) == 3
+
+
+async def test_ttl_eviction(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    jm = manager(ttl=10)
+    old = await jm.new('op')
+    now[0] += 5
+    recent = await jm.new('op')
+    now[0] += 6
+    jm.evict()
+    assert old not in jm.jobs and recent in jm.jobs
+
+
+@pytest.mark.parametrize('spill_name', ['spill.jsonl', 'spill.sqlite'])
+async def test_spill_recovers_evicted(tmp_path, spill_name):
+    jm = manager(max_jobs=1, spill=tmp_path / spill_name)
+    first = await jm.new('op', {'n': 1})
+    await jm.new('op', {'n': 2})  # Evicts the first to the spill
+    assert first not in jm.jobs
+    await jm.complete(first, True, {'done': True})  # Recovered from the spill
+    job = jm.get(first)
+    assert job.params == {'n': 1} and job.status == SUCCEEDED and job.result == {'done': True}
+    # Evicted again after the update; the spill has the latest state
+    await jm.new('op')
+    recovered = jm.get(first)
+    assert recovered.status == SUCCEEDED and recovered.job_end is not None
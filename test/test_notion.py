@@ -0,0 +1,272 @@
+# test/test_notion.py
+import time
+import asyncio
+import logging
+
+import pytest
+import pytest_asyncio
+
+pytest.importorskip('ogbujipt')
+pytest.importorskip('httpx')
+aiohttp = pytest.importorskip('aiohttp')
+import httpx  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+from arkestra.components.prompt import notion, pack_loom  # noqa: E402
+from arkestra.components.prompt.notion import (notion_loom_loader, request_scheduler, shared_priority,  # noqa: E402
+                                               PRIORITY_CRITICAL, PRIORITY_BACKGROUND)
+
+EDITED = '2026-01-01T00:00:00.000Z'
+
+
+class mock_notion:
+    '''Stand-in Notion API: DB retrieve & query endpoints over an editable list of prompt pages'''
+    def __init__(self, n_pages=3):
+        self.pages = {f'p{i}': (f'prompt_{i}', f'Prompt {i} about {{topic}}', EDITED) for i in range(n_pages)}
+        self.db_edited = EDITED
+        self.requests = []  # (kind, request body)
+        self.fail = False
+        self.delay = 0
+
+    async def database(self, request):
+        self.requests.append(('database', None))
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            return web.json_response({'object': 'error', 'code': 'internal_server_error'}, status=500)
+        return web.json_response({'object': 'database', 'id': request.match_info['id'],
+                                  'last_edited_time': self.db_edited})
+
+    async def query(self, request):
+        body = await request.json()
+        self.requests.append(('query', body))
+        since = body.get('filter', {}).get('last_edited_time', {}).get('on_or_after')
+        matching = [(pid, page) for pid, page in self.pages.items() if not since or page[2] >= since]
+        start = int(body.get('start_cursor') or 0)
+        end = min(start + body['page_size'], len(matching))
+        results = [{
+            'object': 'page', 'id': pid, 'last_edited_time': edited,
+            'properties': {
+                'Name': {'title': [{'plain_text': name}]},
+                'Prompt': {'rich_text': [{'text': {'content': text}}]},
+                'Markers': {'rich_text': [{'plain_text': 'topic'}]},
+            }} for pid, (name, text, edited) in matching[start:end]]
+        more = end < len(matching)
+        return web.json_response({'object': 'list', 'results': results, 'has_more': more,
+                                  'next_cursor': str(end) if more else None})
+
+
+@pytest_asyncio.fixture
+async def notion_api(monkeypatch):
+    api = mock_notion()
+    app = web.Application()
+    app.router.add_get('/v1/databases/{id}', api.database)
+    app.router.add_post('/v1/databases/{id}/query', api.query)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    monkeypatch.setattr(notion, 'NOTION_API', f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/v1')
+    monkeypatch.setattr(notion, 'PAGES_PER_REQ', 2)  # Exercise pagination
+    yield api
+    await runner.cleanup()
+
+
+@pytest_asyncio.fixture
+async def client():
+    async with httpx.AsyncClient() as client:
+        yield client
+
+
+def make_loader(client, **kwargs):
+    scheduler = kwargs.pop('scheduler', None) or request_scheduler(rate=1000, burst=100, backoff=0.01)
+    return notion_loom_loader('db1', 'token', 'Name', 'Prompt', 'Markers', client=client, scheduler=scheduler,
+                              **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_load_and_incremental_sync(notion_api, client):
+    loader = make_loader(client)
+    loom = await loader.load()
+    assert sorted(loom) == ['prompt_0', 'prompt_1', 'prompt_2']
+    assert loom['prompt_1'] == 'Prompt 1 about {topic}' and loom['prompt_1'].markers == ['topic']
+    # Rename one page & edit another; an incremental sync only asks for recent edits
+    notion_api.pages['p0'] = ('renamed', 'New text', '2099-01-01T00:00:00.000Z')  # After the last sync
+    notion_api.requests.clear()
+    loom = await loader.sync()
+    assert sorted(loom) == ['prompt_1', 'prompt_2', 'renamed']
+    assert 'filter' in notion_api.requests[1][1]
+    # A DB change (e.g. schema) means a full fetch, which also drops deleted pages
+    del notion_api.pages['p2']
+    notion_api.db_edited = '2026-06-02T00:00:00.000Z'
+    assert sorted(await loader.sync()) == ['prompt_1', 'renamed']
+
+
+@pytest.mark.asyncio
+async def test_concurrent_loads_share_one_sync(notion_api, client):
+    notion_api.delay = 0.05
+    loader = make_loader(client)
+    looms = await asyncio.gather(*(loader.load() for _ in range(3)), loader.sync())
+    assert all(loom is looms[0] for loom in looms)
+    assert [kind for kind, _ in notion_api.requests].count('database') == 1
+    # A full sync asked for mid-sync runs after the incremental one in flight
+    notion_api.requests.clear()
+    await asyncio.gather(loader.sync(), loader.sync(full=True))
+    assert [kind for kind, _ in notion_api.requests].count('database') == 2
+    assert all('filter' not in body for kind, body in notion_api.requests[-2:] if kind == 'query')
+
+
+@pytest.mark.asyncio
+async def test_background_sync_cached_and_logged(notion_api, client, tmp_path, caplog):
+    loader = make_loader(client, cache_dir=tmp_path)
+    await loader.load()
+    # A new loader (e.g. after a restart) starts from the disk cache, without waiting on Notion
+    notion_api.delay = 0.05
+    notion_api.fail = True
+    fresh = make_loader(client, cache_dir=tmp_path, scheduler=request_scheduler(rate=1000, burst=100, retries=0))
+    with caplog.at_level(logging.ERROR, logger='arkestra.components.prompt.notion'):
+        loom = await fresh.load(wait=False)
+        assert sorted(loom) == ['prompt_0', 'prompt_1', 'prompt_2'] and not fresh.sync_task.done()
+        await asyncio.wait([fresh.sync_task])
+    assert isinstance(fresh.sync_task.exception(), RuntimeError)
+    assert 'Sync of Notion DB db1 failed' in caplog.text
+    assert fresh.loom is loom  # Still serving the cached loom
+
+
+@pytest.mark.asyncio
+async def test_waiting_on_background_sync_raises_priority(notion_api, client, tmp_path):
+    await make_loader(client, cache_dir=tmp_path).load()
+    notion_api.delay = 0.05
+    loader = make_loader(client, cache_dir=tmp_path)
+    await loader.load(wait=False)
+    assert loader._sync_priority.value == PRIORITY_BACKGROUND
+    background = loader.sync_task
+    await loader.load()  # Waits on the same sync, now at critical priority
+    assert loader.sync_task is background and loader._sync_priority.value == PRIORITY_CRITICAL
+
+
+def test_cache_disabled_by_default(tmp_path, monkeypatch):
+    monkeypatch.setattr(notion, 'PRECOMPILED_LOOM_DIR', tmp_path)
+    loader = notion_loom_loader('db1', 'token', 'Name', 'Prompt', 'Markers')
+    assert loader.cache_dir is None
+    loader._write_cache()
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize('header', [None, ['db1'], {'db_id': 'db1'}, {'db_id': 'other', 'page_keys': {}},
+                                    {'db_id': 'db1', 'page_keys': [], 'db_edited': None, 'synced': None}])
+def test_bad_cache_header_is_a_miss(tmp_path, header):
+    loader = notion_loom_loader('db1', 'token', 'Name', 'Prompt', 'Markers', cache_dir=tmp_path)
+    fpath = loader._cache_path()
+    fpath.write_bytes(pack_loom({}, header))
+    loader._read_cache()
+    assert loader.loom is None
+
+
+@pytest.mark.asyncio
+async def test_shared_priority_reorders_queued_requests():
+    scheduler = request_scheduler(rate=50, burst=1)
+    order = []
+    boosted = shared_priority(PRIORITY_BACKGROUND)
+
+    async def acquire(name, priority):
+        await scheduler._acquire(priority)
+        order.append(name)
+
+    await scheduler._acquire(PRIORITY_CRITICAL)  # Use up the burst, so the rest queue
+    tasks = [asyncio.create_task(acquire(f'bg{n}', PRIORITY_BACKGROUND)) for n in range(3)]
+    tasks.append(asyncio.create_task(acquire('boosted', boosted)))
+    await asyncio.sleep(0)
+    boosted.raise_to(PRIORITY_CRITICAL)
+    await asyncio.gather(*tasks)
+    assert order[0] == 'boosted'
+
+
+@pytest_asyncio.fixture
+async def endpoint():
+    '''Local endpoint answering GET /{name} with the queued statuses (then 200), recording (name, arrival time)'''
+    arrivals = []
+    statuses = []
+
+    async def handler(request):
+        arrivals.append((request.match_info['name'], time.monotonic()))
+        status, headers = statuses.pop(0) if statuses else (200, {})
+        return web.json_response({'name': request.match_info['name']}, status=status, headers=headers)
+
+    app = web.Application()
+    app.router.add_get('/{name}', handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    base = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}'
+    yield base, arrivals, statuses
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_scheduler_429_pauses_everyone(endpoint, client):
+    base, arrivals, statuses = endpoint
+    scheduler = request_scheduler(rate=1000, burst=100)
+    statuses.append((429, {'Retry-After': '0.3'}))
+    first = asyncio.create_task(scheduler.request(client, 'GET', base + '/first'))
+    await asyncio.sleep(0.1)  # first has had its 429
+    second = await scheduler.request(client, 'GET', base + '/second')
+    assert (await first).status_code == 200 and second.status_code == 200
+    limited_at = arrivals[0][1]
+    assert sorted(name for name, _ in arrivals) == ['first', 'first', 'second']
+    # Nothing went out during the Retry-After pause, including requests which weren't rate limited themselves
+    assert all(t - limited_at >= 0.29 for _, t in arrivals[1:])
+
+
+@pytest.mark.asyncio
+async def test_scheduler_retries_then_gives_up(endpoint, client):
+    base, arrivals, statuses = endpoint
+    scheduler = request_scheduler(rate=1000, burst=100, retries=2, backoff=0.01)
+    statuses.extend([(503, {}), (409, {})])
+    assert (await scheduler.request(client, 'GET', base + '/flaky')).status_code == 200
+    assert len(arrivals) == 3
+    statuses.extend([(503, {})] * 3)
+    assert (await scheduler.request(client, 'GET', base + '/down')).status_code == 503  # Last response returned
+    assert len(arrivals) == 6
+    statuses.append((404, {}))
+    assert (await scheduler.request(client, 'GET', base + '/missing')).status_code == 404  # Not retried
+    assert len(arrivals) == 7
+    with pytest.raises(httpx.TransportError):  # Connection errors retried, then raised
+        await scheduler.request(client, 'GET', 'http://127.0.0.1:1/closed')
+
+
+@pytest.mark.asyncio
+async def test_scheduler_priority_order(endpoint, client):
+    base, arrivals, _ = endpoint
+    scheduler = request_scheduler(rate=20, burst=1)
+    await scheduler.request(client, 'GET', base + '/warmup')  # Uses up the burst, so the rest queue
+    background = [asyncio.create_task(scheduler.request(client, 'GET', f'{base}/bg{n}', priority=PRIORITY_BACKGROUND))
+                  for n in range(3)]
+    await asyncio.sleep(0)
+    critical = asyncio.create_task(scheduler.request(client, 'GET', base + '/critical', priority=PRIORITY_CRITICAL))
+    await asyncio.gather(*background, critical)
+    assert [name for name, _ in arrivals] == ['warmup', 'critical', 'bg0', 'bg1', 'bg2']
+
+
+@pytest.mark.asyncio
+async def test_scheduler_rate(endpoint, client):
+    base, arrivals, _ = endpoint
+    scheduler = request_scheduler(rate=20, burst=2)
+    start = time.monotonic()
+    await asyncio.gather(*(scheduler.request(client, 'GET', f'{base}/{n}') for n in range(8)))
+    times = sorted(t - start for _, t in arrivals)
+    assert times[1] - times[0] < 1 / 20  # The burst goes at once
+    # Then the rest at the token rate: none arrives before its token (network delay only makes arrivals later)
+    assert all(t >= (n - 1) / 20 * 0.95 for n, t in enumerate(times[2:], start=2))
+
+
+@pytest.mark.asyncio
+async def test_module_scheduler_paces_at_notion_rate(notion_api, client, monkeypatch):
+    # Fresh default scheduler, so other tests' use of the shared one doesn't leave it out of tokens
+    monkeypatch.setattr(notion, 'notion_scheduler', request_scheduler())
+    assert (notion.notion_scheduler.rate, notion.notion_scheduler.burst) == (notion.NOTION_RATE, 3)
+    start = time.monotonic()
+    await asyncio.gather(*(notion.database('db', 'token', client=client) for _ in range(4)))
+    # The 3-request burst goes at once, the 4th waits for a token
+    assert time.monotonic() - start >= 1 / notion.NOTION_RATE * 0.9
+    assert [kind for kind, _ in notion_api.requests] == ['database'] * 4
@@ -0,0 +1,124 @@
+# test/test_obj_schema.py
+import json
+from typing import Optional
+
+import pytest
+from pydantic import BaseModel, ValidationError
+
+from arkestra.components.obj_schema import type_adapter, validate_json, validate_many, incremental_validator
+
+
+class research_step(BaseModel):
+    title: str
+    priority: int = 0
+
+
+class research_plan(BaseModel):
+    topic: str
+    research_steps: list[research_step]
+
+
+def test_type_adapter_cached():
+    assert type_adapter(research_step) is type_adapter(research_step)
+    assert type_adapter(list[int]) is type_adapter(list[int])
+
+
+@pytest.mark.parametrize('data', [
+    {'title': 'Survey', 'priority': '2'},
+    '{"title": "Survey", "priority": 2}',
+    b'{"title": "Survey", "priority": 2}',
+])
+def test_validate_json_accepts_objects_or_raw(data):
+    assert validate_json(data, research_step) == research_step(title='Survey', priority=2)
+
+
+def test_validate_json_errors():
+    with pytest.raises(ValidationError):
+        validate_json({'priority': 1}, research_step)
+    with pytest.raises(ValidationError):
+        validate_json('{"title": ', research_step)  # Malformed JSON
+
+
+def test_validate_many():
+    payloads = ({'title': 'a'}, '{"title": "b"}', {'title': 'c', 'priority': 'high'}, 'not json')
+    ok, bad = validate_many(payloads, research_step)
+    assert [(i, m.title) for i, m in ok] == [(0, 'a'), (1, 'b')]
+    assert [i for i, _ in bad] == [2, 3]
+    assert bad[0][1][0]['loc'] == ('priority',)
+    assert 'url' not in bad[0][1][0]
+
+
+class optional_plan(BaseModel):
+    topic: str
+    research_steps: Optional[list[research_step]] = None
+
+
+class union_plan(BaseModel):
+    topic: str
+    research_steps: list[research_step] | None = None
+
+
+PLAN_JSON = json.dumps({
+    'topic': 'tides, "moon" & {braces}',
+    'meta': {'research_steps': [{'title': 'decoy'}]},  # Nested key of the same name isn't streamed
+    'research_steps': [{'title': 'Survey [1]', 'priority': 1}, {'title': 'Model \\"it\\"'}, {'title': 'Write'}],
+})
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 5, 1000])
+@pytest.mark.parametrize('model', [research_plan, optional_plan, union_plan])
+def test_incremental_validator_streams_items(chunk_size, model):
+    stream = '```json\n' + PLAN_JSON + '\n```'
+    chunks = [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+    validator = incremental_validator(model, 'research_steps')
+    seen = []
+    for n, chunk in enumerate(chunks):
+        for item in validator.feed(chunk):
+            seen.append((item.title, n))
+    assert [t for t, _ in seen] == ['Survey [1]', 'Model \\"it\\"', 'Write']
+    # Items arrive as soon as they close, not at the end
+    first_item_end = stream.index('"priority": 1}') + len('"priority": 1}')
+    assert seen[0][1] == (first_item_end - 1) // chunk_size
+    plan = validator.close()
+    assert plan.topic == 'tides, "moon" & {braces}' and len(plan.research_steps) == 3
+    assert validator.text == PLAN_JSON  # Only the JSON value itself is kept
+
+
+def test_incremental_validator_scalar_items():
+    class tags(BaseModel):
+        tags: list[int]
+
+    validator = incremental_validator(tags, 'tags')
+    assert list(validator.iter_items(['{"tags": [1', '2, 3', ',4]}'])) == [12, 3, 4]
+    assert validator.result.tags == [12, 3, 4]
+
+
+def test_incremental_validator_item_errors_early():
+    validator = incremental_validator(research_plan, 'research_steps')
+    with pytest.raises(ValidationError):
+        validator.feed('{"topic": "x", "research_steps": [{"priority": 1}, ')
+
+
+def test_incremental_validator_needs_list_field():
+    with pytest.raises(ValueError, match='topic'):
+        incremental_validator(research_plan, 'topic')
+    validator = incremental_validator(research_plan, 'topic', item_type=str)  # Unless told the item type
+    assert validator.item_adapter is type_adapter(str)
+
+
+@pytest.mark.asyncio
+async def test_incremental_validator_async():
+    async def tokens():
+        for i in range(0, len(PLAN_JSON), 3):
+            yield PLAN_JSON[i:i + 3]
+
+    validator = incremental_validator(research_plan, 'research_steps')
+    titles = [step.title async for step in validator.aiter_items(tokens())]
+    assert len(titles) == 3 and validator.result.research_steps[-1].title == 'Write'
+
+
+def test_incremental_validator_no_json():
+    validator = incremental_validator(research_plan)
+    validator.feed('Sorry, I cannot help with that')
+    with pytest.raises(ValueError):
+        validator.close()
@@ -0,0 +1,204 @@
+# test/test_pg_manager.py
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from arkestra.jobs.pg_manager import pg_manager
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_unbuffered_new_complete(pg_pool, pg_schema):
+    jm = pg_manager(f'{pg_schema}.jobs', pipeline_version='1.0')
+    await jm.async_init(pg_pool)
+    jobid = await jm.new('scrape', {'url': 'https://example.com'})
+    await jm.complete(jobid, True, {'length': 10}, metrics={'fetch': {'calls': 1}})
+    job = await jm.get(jobid)
+    assert job['request'] == {'url': 'https://example.com'}
+    assert job['success'] is True
+    assert job['response'] == {'length': 10}
+    assert job['metadata']['metrics'] == {'fetch': {'calls': 1}}
+
+
+async def test_buffered_calls_get_own_ids(pg_pool, pg_schema):
+    jm = pg_manager(f'{pg_schema}.jobs', batch_size=10, flush_interval=0.01)
+    await jm.async_init(pg_pool)
+    # Several batches' worth at once, & a partial batch left for the timer
+    jobids = await asyncio.gather(*(jm.new('op', {'n': n}) for n in range(35)))
+    assert len(set(jobids)) == 35
+    await asyncio.gather(*(jm.complete(jid, n % 2 == 0, {'n': n}) for n, jid in enumerate(jobids)))
+    await jm.close()
+    for n, jid in enumerate(jobids):
+        job = await jm.get(jid)
+        assert job['request'] == {'n': n}
+        assert job['response'] == {'n': n}
+        assert job['success'] is (n % 2 == 0)
+
+
+async def test_buffered_single_flush_task(pg_pool, pg_schema):
+    jm = pg_manager(f'{pg_schema}.jobs', batch_size=2, flush_interval=10)
+    await jm.async_init(pg_pool)
+    flushes = 0
+    running = 0
+    flush = jm.flush
+
+    async def counting_flush():
+        nonlocal flushes, running
+        flushes += 1
+        running += 1
+        assert running == 1  # Never two flushes at once
+        try:
+            await flush()
+        finally:
+            running -= 1
+
+    jm.flush = counting_flush
+    jobids = await asyncio.gather(*(jm.new('op') for _ in range(20)))
+    assert len(set(jobids)) == 20
+    assert not jm._flushing()
+    assert flushes <= 10  # Calls arriving during a flush go together in the next
+
+
+async def test_buffered_bad_row_fails_only_its_caller(pg_pool, pg_schema):
+    jm = pg_manager(f'{pg_schema}.jobs', batch_size=5, flush_interval=0.01)
+    await jm.async_init(pg_pool)
+    params = [{'n': n} for n in range(5)]
+    params[2] = {'bad': object()}  # Can't be encoded as JSON
+    results = await asyncio.gather(*(jm.new('op', p) for p in params), return_exceptions=True)
+    assert isinstance(results[2], Exception)  # asyncpg DataError
+    good = [r for n, r in enumerate(results) if n != 2]
+    assert all(isinstance(r, int) for r in good)
+    for n, jid in zip((0, 1, 3, 4), good):
+        assert (await jm.get(jid))['request'] == {'n': n}
+
+
+async def _partitions(pool, table_name):
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+            'WHERE i.inhparent = $1::text::regclass', table_name)
+    return sorted(row['relname'] for row in rows)
+
+
+async def test_partitioned_table(pg_pool, pg_schema):
+    now = datetime(2026, 3, 15, 12, tzinfo=timezone.utc)
+    jm = pg_manager(f'{pg_schema}.jobs', partition_interval='month', partitions_ahead=1)
+    await jm.async_init(pg_pool)
+    await jm.maintain_partitions(now=now)
+    assert {'jobs_p20260301', 'jobs_p20260401', 'jobs_default'} <= set(await _partitions(pg_pool, jm.table_name))
+    jobid = await jm.new('op', {'x': 1})
+    await jm.complete(jobid, True, {}, metrics={'stage': {'calls': 1}})
+    assert (await jm.get(jobid))['metadata']['metrics'] == {'stage': {'calls': 1}}
+
+
+async def test_partition_interval_on_existing_unpartitioned_table(pg_pool, pg_schema, caplog):
+    table_name = f'{pg_schema}.jobs'
+    plain = pg_manager(table_name)
+    await plain.async_init(pg_pool)
+    jobid = await plain.new('op')
+
+    jm = pg_manager(table_name, partition_interval='day')
+    with caplog.at_level(logging.WARNING):
+        await jm.async_init(pg_pool)
+    assert 'unpartitioned' in caplog.text
+    assert jm.partition_interval is None
+    assert jm.json_type == 'JSON'
+    assert await jm.maintain_partitions() == []
+    await jm.complete(jobid, True, {'ok': 1}, metrics={'stage': {}})
+    assert (await jm.get(jobid))['success'] is True
+
+
+async def test_partition_created_over_rows_in_default(pg_pool, pg_schema):
+    now = datetime(2026, 3, 15, 12, tzinfo=timezone.utc)
+    jm = pg_manager(f'{pg_schema}.jobs', partition_interval='day', partitions_ahead=0)
+    await jm.async_init(pg_pool)
+    await jm.maintain_partitions(now=now)
+    # A job 3 days ahead lands in the default partition, since maintenance hasn't caught up
+    later = now + timedelta(days=3)
+    async with pg_pool.acquire() as conn:
+        jobid = await conn.fetchval(
+            f'INSERT INTO {jm.table_name} (job_start, request) VALUES ($1, $2) RETURNING id', later, {'n': 1})
+    await jm.maintain_partitions(now=later)
+    async with pg_pool.acquire() as conn:
+        home = await conn.fetchval(f'SELECT tableoid::regclass::text FROM {jm.table_name} WHERE id=$1', jobid)
+    assert home == f'{jm.table_name}_p20260318'
+    assert (await jm.get(jobid))['request'] == {'n': 1}
+
+
+async def test_partition_retention(pg_pool, pg_schema):
+    start = datetime(2026, 3, 1, tzinfo=timezone.utc)
+    jm = pg_manager(f'{pg_schema}.jobs', partition_interval='day', partitions_ahead=2, retention=timedelta(days=1),
+                    drop_detached=True)
+    await jm.async_init(pg_pool)
+    await jm.maintain_partitions(now=start)
+    detached = await jm.maintain_partitions(now=start + timedelta(days=3))
+    assert detached == [f'{jm.table_name}_p20260301', f'{jm.table_name}_p20260302']
+    remaining = await _partitions(pg_pool, jm.table_name)
+    assert 'jobs_p20260301' not in remaining and 'jobs_p20260304' in remaining
+
+
+async def test_maintenance_survives_errors(pg_pool, pg_schema, caplog):
+    jm = pg_manager(f'{pg_schema}.jobs', partition_interval='day')
+    await jm.async_init(pg_pool)
+    calls = 0
+
+    async def flaky(now=None):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise ConnectionError('DB went away')
+        return []
+
+    jm.maintain_partitions = flaky
+    with caplog.at_level(logging.ERROR):
+        jm.start_maintenance(every=0.01)
+        await asyncio.sleep(0.1)
+        await jm.close()
+    assert calls >= 2
+    assert 'DB went away' in caplog.text
+
+
+async def _seed_history(pool, jm, count=10):
+    base = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    async with pool.acquire() as conn:
+        for n in range(count):
+            # Pairs of jobs share a start time, so pages must break ties by id
+            await conn.execute(
+                f'INSERT INTO {jm.table_name} (job_start, job_end, success, request, pipeline_version, metadata) '
+                'VALUES ($1, $2, $3, $4, $5, $6)',
+                base + timedelta(hours=n // 2), None if n == 9 else base + timedelta(hours=n // 2, minutes=1),
+                None if n == 9 else n % 3 != 0, {'n': n, 'kind': 'even' if n % 2 == 0 else 'odd'},
+                '1.0' if n < 6 else '2.0', {'tag': 'x' if n < 4 else 'y'})
+    return base
+
+
+async def test_query_pages(pg_pool, pg_schema):
+    jm = pg_manager(f'{pg_schema}.jobs')
+    await jm.async_init(pg_pool)
+    base = await _seed_history(pg_pool, jm)
+
+    async def ns(**kwargs):
+        return [row['request']['n'] async for row in jm.query(page_size=3, **kwargs)]
+
+    assert await ns() == list(range(10))
+    assert await ns(descending=True) == list(range(9, -1, -1))
+    assert await ns(since=base + timedelta(hours=1), until=base + timedelta(hours=3)) == [2, 3, 4, 5]
+    assert await ns(success=False) == [0, 3, 6]
+    assert await ns(pipeline_version='2.0') == [6, 7, 8, 9]
+    assert await ns(incomplete=True) == [9]
+    assert await ns(incomplete=False) == list(range(9))
+    assert await ns(request_contains={'kind': 'odd'}) == [1, 3, 5, 7, 9]
+    assert await ns(metadata_contains={'tag': 'x'}, descending=True) == [3, 2, 1, 0]
+
+
+async def test_query_releases_connection(pg_pool, pg_schema):
+    jm = pg_manager(f'{pg_schema}.jobs')
+    await jm.async_init(pg_pool)
+    await _seed_history(pg_pool, jm)
+    idle = pg_pool.get_idle_size()
+    async for row in jm.query(page_size=4):
+        # Rows are yielded with the connection already back in the pool
+        assert pg_pool.get_idle_size() == idle
+        break
@@ -0,0 +1,119 @@
+# test/test_pg_queue.py
+import asyncio
+
+import pytest
+
+from arkestra.jobs.pg_queue import pg_queue
+
+pytestmark = pytest.mark.asyncio
+
+
+async def _job(pool, q, jobid):
+    async with pool.acquire() as conn:
+        return await conn.fetchrow(
+            f'SELECT status, attempts, worker_id, success, response FROM {q.table_name} WHERE id=$1', jobid)
+
+
+@pytest.fixture
+def queue_table(pg_schema):
+    return f'{pg_schema}.jobs'
+
+
+async def test_claim_complete(pg_pool, queue_table):
+    q = pg_queue(queue_table, retry_delay=0)
+    await q.async_init(pg_pool)
+    jobid = await q.enqueue('scrape', {'url': 'https://example.com'}, max_attempts=2)
+    [job] = await q.claim('w1')
+    assert job['id'] == jobid and job['operation'] == 'scrape' and job['attempts'] == 1
+    assert await q.claim('w2') == []  # Held by w1
+    assert await q.heartbeat(jobid, 'w1')
+    assert not await q.heartbeat(jobid, 'w2')
+
+    # Failure with an attempt left goes back to pending, then fails for good
+    assert await q.complete(jobid, False, {'error': 'boom'}, worker_id='w1') == 'pending'
+    [job] = await q.claim('w2')
+    assert job['attempts'] == 2
+    assert await q.complete(jobid, False, {'error': 'boom'}, worker_id='w2') == 'failed'
+    assert await q.claim('w1') == []
+
+
+async def test_stale_worker_cannot_complete(pg_pool, queue_table, caplog):
+    q = pg_queue(queue_table)
+    await q.async_init(pg_pool)
+    jobid = await q.enqueue('op', max_attempts=3)
+    await q.claim('w1', lease=0.05)
+    await asyncio.sleep(0.1)
+    [job] = await q.claim('w2')  # w1's lease lapsed
+    assert job['id'] == jobid
+
+    assert await q.complete(jobid, True, {'by': 'w1'}, worker_id='w1') is None
+    assert 'no longer held by worker w1' in caplog.text
+    row = await _job(pg_pool, q, jobid)
+    assert row['status'] == 'running' and row['worker_id'] == 'w2'
+
+    assert await q.complete(jobid, True, {'by': 'w2'}, worker_id='w2') == 'succeeded'
+    assert (await _job(pg_pool, q, jobid))['response'] == {'by': 'w2'}
+    # Already completed
+    assert await q.complete(jobid, False, {'by': 'w2'}) is None
+    assert (await _job(pg_pool, q, jobid))['success'] is True
+
+
+async def test_work_loop(pg_pool, queue_table):
+    q = pg_queue(queue_table, retry_delay=0)
+    await q.async_init(pg_pool)
+    jobids = [await q.enqueue('double', {'n': n}, max_attempts=2) for n in range(6)]
+    stop = asyncio.Event()
+    seen = []
+
+    async def handler(job):
+        n = job['request']['n']
+        seen.append(n)
+        if n == 3 and job['attempts'] == 1:
+            raise RuntimeError('flaky')
+        if len(seen) == 7:
+            stop.set()
+        return {'result': n * 2}
+
+    await asyncio.wait_for(q.work(handler, worker_id='w1', concurrency=3, poll_interval=0.05, stop=stop), 10)
+    for n, jobid in enumerate(jobids):
+        row = await _job(pg_pool, q, jobid)
+        assert row['status'] == 'succeeded' and row['response'] == {'result': n * 2}
+    assert (await _job(pg_pool, q, jobids[3]))['attempts'] == 2
+
+
+async def test_work_stops_without_claiming_more(pg_pool, queue_table):
+    q = pg_queue(queue_table)
+    await q.async_init(pg_pool)
+    first = await q.enqueue('op')
+    second = await q.enqueue('op')
+    stop = asyncio.Event()
+    started = asyncio.Event()
+    release = asyncio.Event()
+
+    async def handler(job):
+        started.set()
+        await release.wait()
+        return {}
+
+    worker = asyncio.ensure_future(q.work(handler, concurrency=1, poll_interval=0.05, stop=stop))
+    await asyncio.wait_for(started.wait(), 5)
+    stop.set()  # While the worker waits for its only slot
+    release.set()
+    await asyncio.wait_for(worker, 5)
+    assert (await _job(pg_pool, q, first))['status'] == 'succeeded'
+    row = await _job(pg_pool, q, second)
+    assert row['status'] == 'pending' and row['attempts'] == 0
+
+
+async def test_complete_plain_new_job(pg_pool, queue_table):
+    q = pg_queue(queue_table)
+    await q.async_init(pg_pool)
+    jobid = await q.new('log_only', {'x': 1})
+    assert await q.claim('w1') == []  # Plain jobs are never claimed
+    assert await q.complete(jobid, False, {'error': 'boom'}, metrics={'ms': 3}) == 'failed'
+    async with pg_pool.acquire() as conn:
+        row = await conn.fetchrow(f'SELECT * FROM {queue_table} WHERE id=$1', jobid)
+    assert row['success'] is False and row['job_end'] is not None and row['available_at'] is None
+    assert row['response'] == {'error': 'boom'}
+    assert await q.claim('w1') == []  # Not requeued
+    assert await q.complete(jobid, True, {}) is None  # Already completed
@@ -0,0 +1,86 @@
+# test/test_prompt.py
+import os
+import copy
+import json
+
+import pytest
+
+pytest.importorskip('ogbujipt')
+
+from arkestra.components.prompt import (load_loom, clear_loom_cache, loom_watcher, pack_loom,  # noqa: E402
+                                        unpack_loom)
+
+LOOM = '''lang = "en"
+
+[hello]
+_ = "Hello, {name}!"
+_m = ["name"]
+
+[bye]
+_ = "Goodbye"
+'''
+
+
+@pytest.fixture
+def loom_file(tmp_path):
+    clear_loom_cache()
+    fpath = tmp_path / 'lang.toml'
+    fpath.write_text(LOOM)
+    yield fpath
+    clear_loom_cache()
+
+
+def rewrite(fpath, text):
+    '''Change the file, making sure its stamp (mtime & size) changes too'''
+    st = fpath.stat()
+    fpath.write_text(text)
+    os.utime(fpath, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+
+def test_load_loom_cached_copies(loom_file):
+    loom = load_loom(loom_file)
+    assert type(loom) is dict and loom['hello'].format(name='Ada') == 'Hello, Ada!'
+    loom['hello'] = 'changed'  # Each caller gets its own dict
+    again = load_loom(str(loom_file))
+    assert again is not loom and again['hello'] == 'Hello, {name}!'
+    assert copy.copy(again) == again and json.loads(json.dumps(again)) == again
+    uncached = load_loom(loom_file, cache=False)
+    assert isinstance(uncached, dict) and uncached is not load_loom(loom_file, cache=False)
+    rewrite(loom_file, LOOM.replace('Goodbye', 'Farewell'))
+    assert load_loom(loom_file)['bye'] == 'Farewell'
+
+
+def test_load_loom_follows_symlink_swaps(tmp_path, loom_file):
+    other = tmp_path / 'other.toml'
+    other.write_text(LOOM.replace('Goodbye', 'See you'))
+    link = tmp_path / 'current.toml'
+    link.symlink_to(loom_file)
+    assert load_loom(link)['bye'] == 'Goodbye'
+    tmp_link = tmp_path / 'next.toml'
+    tmp_link.symlink_to(other)
+    os.replace(tmp_link, link)  # Atomic swap, as in a deploy
+    assert load_loom(link)['bye'] == 'See you'
+
+
+def test_precompiled_loom(tmp_path, loom_file):
+    cache_dir = tmp_path / 'precompiled'
+    loom = load_loom(loom_file, precompiled=cache_dir)
+    assert len(list(cache_dir.iterdir())) == 1
+    clear_loom_cache()
+    again = load_loom(loom_file, precompiled=cache_dir)  # From the precompiled file
+    assert dict(again) == dict(loom) and again['hello'].markers == ['name']
+    unpacked, header = unpack_loom(pack_loom(dict(loom), header=('x', 1)))
+    assert unpacked == dict(loom) and header == ('x', 1)
+    with pytest.raises(ValueError):
+        unpack_loom(b'not a loom')
+
+
+def test_loom_watcher(loom_file):
+    changes = []
+    watcher = loom_watcher(loom_file, interval=0, on_change=changes.append)
+    assert watcher['bye'] == 'Goodbye' and 'hello' in watcher
+    assert not watcher.refresh()
+    rewrite(loom_file, LOOM.replace('Goodbye', 'Later'))
+    assert watcher['bye'] == 'Later' and len(changes) == 1
+    rewrite(loom_file, 'not = [valid toml')
+    assert watcher['bye'] == 'Later'  # Keeps serving the last good loom
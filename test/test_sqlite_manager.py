@@ -0,0 +1,96 @@
+# test/test_sqlite_manager.py
+import asyncio
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import pytest_asyncio
+
+from arkestra.jobs.sqlite_manager import sqlite_manager
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest_asyncio.fixture
+async def jm(tmp_path):
+    jm = sqlite_manager(tmp_path / 'jobs.db', 'jobs', pipeline_version='1.0')
+    await jm.async_init()
+    yield jm
+    await jm.close()
+
+
+async def test_new_complete_get(jm):
+    jobid = await jm.new('scrape', {'url': 'a'}, {'tag': 'x'})
+    await jm.complete(jobid, True, {'length': 3}, metrics={'fetch': {'calls': 1}})
+    job = await jm.get(jobid)
+    assert job['request'] == {'url': 'a'} and job['response'] == {'length': 3}
+    assert job['success'] is True and job['pipeline_version'] == '1.0'
+    assert job['metadata'] == {'tag': 'x', 'metrics': {'fetch': {'calls': 1}}}
+    assert isinstance(job['job_start'], datetime) and job['job_end'] >= job['job_start']
+    assert await jm.get(jobid + 1000) is None
+
+
+async def test_wal_and_concurrent_writes(jm):
+    jobids = await asyncio.gather(*(jm.new('op', {'n': n}) for n in range(200)))
+    assert len(set(jobids)) == 200
+    await asyncio.gather(*(jm.complete(jid, True, {'n': n}) for n, jid in enumerate(jobids)))
+    conn = sqlite3.connect(jm.db_path)
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    assert conn.execute('SELECT count(*) FROM jobs WHERE job_end IS NOT NULL').fetchone()[0] == 200
+    conn.close()
+
+
+async def test_bad_write_fails_only_its_caller(jm):
+    conn = sqlite3.connect(jm.db_path)
+    conn.execute('''CREATE TRIGGER reject BEFORE UPDATE ON jobs WHEN NEW.response LIKE '%reject%'
+        BEGIN SELECT RAISE(ABORT, 'rejected'); END''')
+    conn.commit()
+    conn.close()
+    jobid = await jm.new('op', {'n': 0})
+
+    # Hold the writer thread on a flush, so the writes below queue up into one batch
+    batches = []
+    gate = threading.Event()
+    commit = jm._commit
+
+    def gated_commit(conn, batch):
+        gate.wait(5)
+        batches.append(len(batch))
+        return commit(conn, batch)
+
+    jm._commit = gated_commit
+    flushed = asyncio.ensure_future(jm.flush())
+    await asyncio.sleep(0.05)
+    writes = [asyncio.ensure_future(w) for w in (
+        jm.new('op', {'n': 1}), jm.complete(jobid, False, 'reject'), jm.new('op', {'n': 2}))]
+    await asyncio.sleep(0.05)
+    gate.set()
+    await flushed
+    new1, bad, new2 = await asyncio.gather(*writes, return_exceptions=True)
+    assert batches[:5] == [1, 3, 1, 1, 1]  # The failed batch, then retried one by one
+    assert isinstance(bad, sqlite3.IntegrityError) and 'rejected' in str(bad)
+    assert (await jm.get(new1))['request'] == {'n': 1} and (await jm.get(new2))['request'] == {'n': 2}
+    assert (await jm.get(jobid))['job_end'] is None
+    with pytest.raises(TypeError):  # Not JSON serializable, so fails before being queued
+        await jm.complete(jobid, True, object())
+
+
+async def test_query(jm):
+    jobids = [await jm.new('op', {'n': n, 'kind': 'even' if n % 2 == 0 else 'odd'}) for n in range(7)]
+    for n, jid in enumerate(jobids[:6]):
+        await jm.complete(jid, n % 3 != 0, {})
+    await jm.flush()
+
+    async def ns(**kwargs):
+        return [row['request']['n'] async for row in jm.query(page_size=2, **kwargs)]
+
+    assert await ns() == list(range(7))
+    assert await ns(descending=True) == list(range(6, -1, -1))
+    assert await ns(success=False) == [0, 3]
+    assert await ns(incomplete=True) == [6]
+    assert await ns(request_contains={'kind': 'odd'}) == [1, 3, 5]
+    assert await ns(pipeline_version='2.0') == []
+    future = datetime.now(tz=timezone.utc) + timedelta(hours=1)
+    assert await ns(since=future) == []
+    assert await ns(until=future) == list(range(7))
@@ -0,0 +1,86 @@
+# test/test_template.py
+import warnings
+
+import pytest
+
+from arkestra.components.prompt.template import prompt_template, compile_template, compile_loom
+
+
+class item(str):
+    '''Stand-in for a Word Loom language item: a str with declared markers'''
+    def __new__(cls, text, markers=None):
+        obj = super().__new__(cls, text)
+        obj.markers = markers
+        return obj
+
+
+def test_render_matches_str_format():
+    text = 'Summarize {title} ({year}) for {audience}: {price:.2f} {title!r} {{literal}}'
+    tmpl = prompt_template(text)
+    params = {'title': 'Dune', 'year': 1965, 'audience': 'kids', 'price': 9.5}
+    assert tmpl.render(params) == text.format(**params)
+    assert tmpl(**params) == text.format(**params)
+    assert tmpl.render(params, audience='adults') == text.format(**{**params, 'audience': 'adults'})
+    assert tmpl.fields == ('title', 'year', 'audience', 'price')
+
+
+def test_render_field_named_params():
+    tmpl = prompt_template('Use {params}')
+    assert tmpl.render(params='P') == 'Use {params}'.format(params='P')
+    assert tmpl.render({'params': 'P'}) == 'Use P'
+
+
+def test_format_spec_fields():
+    tmpl = prompt_template('{name:>{width}}|{price:{fmt}}')
+    assert tmpl.fields == ('name', 'width', 'price', 'fmt')
+    params = {'name': 'Ada', 'width': 5, 'price': 9.5, 'fmt': '.2f'}
+    assert tmpl.render(params) == '{name:>{width}}|{price:{fmt}}'.format(**params)
+    with pytest.raises(ValueError, match='Missing prompt parameters: width'):
+        tmpl.render(name='Ada', price=1.0, fmt='')
+    with pytest.raises(ValueError, match='width'):
+        list(tmpl.render_many([{'name': 'Ada', 'price': 1.0, 'fmt': ''}]))
+    with pytest.warns(UserWarning, match='width'):
+        prompt_template(item('{name:>{width}}', ['name']))
+    with pytest.raises(ValueError, match='Positional'):
+        prompt_template('{name:{}}')
+
+
+def test_marker_checks():
+    tmpl = prompt_template(item('Hi {name}', ['name', 'mood']))
+    with pytest.raises(ValueError, match='name'):
+        tmpl.render(mood='ok')
+    assert tmpl.render(name='Ada', extra=1) == 'Hi Ada'  # Unknown params allowed unless strict
+    strict = prompt_template(item('Hi {name}', ['name']), strict=True)
+    with pytest.raises(ValueError, match='extra'):
+        strict.render(name='Ada', extra=1)
+    with pytest.warns(UserWarning, match='other'):
+        prompt_template(item('{name} {other}', ['name']))
+    with pytest.raises(ValueError):
+        prompt_template(item('{name} {other}', ['name']), strict=True)
+    with pytest.raises(ValueError, match='Positional'):
+        prompt_template('{} {0}')
+
+
+def test_render_many():
+    tmpl = prompt_template('{name} is {age}')
+    rows = [{'name': 'Ada', 'age': 36}, {'name': 'Alan', 'age': 41}]
+    assert list(tmpl.render_many(rows)) == ['Ada is 36', 'Alan is 41']
+    assert list(tmpl.render_many([('Ada', 36)], columns=['name', 'age'])) == ['Ada is 36']
+    assert list(prompt_template('{name:>5}').render_many([('Ada',)], columns=['name'])) == ['  Ada']
+    with pytest.raises(ValueError):
+        list(tmpl.render_many([('Ada',)], columns=['name']))
+
+
+def test_render_many_dataframe():
+    pd = pytest.importorskip('pandas')
+    df = pd.DataFrame({'name': ['Ada', 'Alan'], 'age': [36, 41]})
+    assert list(prompt_template('{name} is {age}').render_many(df)) == ['Ada is 36', 'Alan is 41']
+
+
+def test_compile_cached():
+    hello = item('Hello {name}', ['name'])
+    assert compile_template(hello) is compile_template(item('Hello {name}', ['name']))
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        compiled = compile_loom({'hello': hello, 'bye': item('Bye')})
+    assert compiled['hello'].render(name='Ada') == 'Hello Ada' and compiled['bye'].render() == 'Bye'
@@ -0,0 +1,432 @@
+# test/test_website.py
+import os
+import sys
+import time
+import asyncio
+import subprocess
+import collections
+import urllib.error
+
+import pytest
+import pytest_asyncio
+
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp import web  # noqa: E402
+
+from arkestra.components import website  # noqa: E402
+from arkestra.components.website import load_pages  # noqa: E402
+
+needs_selectolax = pytest.mark.skipif(not website._available('selectolax'), reason='Requires selectolax')
+
+PAGES = [
+    '<html><head><title>T</title></head><body><nav>Menu</nav><h1>Title</h1><p>Some <a href="/x">linked</a> text'
+    '<ul><li>one<li>two<ol><li>a</li></ol></ul><table><tr><th>h</th></tr><tr><td>d</td></tr></table>'
+    '<pre>x  y\n z</pre><p>unclosed<div>div</div><p>a&nbsp;b</body></html>',
+    '<b>1<i>2</b>3</i>4',  # Misnested markup
+    '<table>stray<tr><td>c</td></tr></table>',  # Foster-parented text
+    '<p><div>x</div></p><h1>h<h2>i</h2></h1>',
+]
+
+
+@needs_selectolax
+def test_lexbor_parser():
+    from selectolax.lexbor import LexborHTMLParser
+    assert website._html_parser() is LexborHTMLParser
+
+
+@needs_selectolax
+def test_template_contents_not_walked():
+    # Lexbor keeps <template> contents out of the tree; the Modest parser walked them
+    tree = website._html_parser()('<p>x<template><p>hidden</template>y</p>')
+    assert [n.text(deep=False) for n in tree.root.traverse(include_text=True) if n.tag == '-text'] == ['x', 'y']
+    assert website.html_to_markdown(tree) == 'xy\n'
+
+
+@needs_selectolax
+@pytest.mark.parametrize('html', PAGES)
+def test_modest_and_lexbor_agree(html):
+    try:
+        from selectolax.parser import HTMLParser
+    except ImportError:
+        pytest.skip('Modest parser not available (removed in selectolax 1.0)')
+    from selectolax.lexbor import LexborHTMLParser
+    assert website.html_to_markdown(HTMLParser(html)) == website.html_to_markdown(LexborHTMLParser(html))
+
+
+@pytest_asyncio.fixture
+async def server():
+    '''Local test site: each route's handler records requests; `serve` adds routes & returns the base URL'''
+    runner = None
+
+    async def serve(routes):
+        nonlocal runner
+        app = web.Application()
+        for path, handler in routes.items():
+            app.router.add_get(path, handler)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        return f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}'
+
+    yield serve
+    if runner is not None:
+        await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_session_pool_reuses_connections(server):
+    peers = []
+
+    async def hello(request):
+        peers.append(request.transport.get_extra_info('peername'))
+        return web.Response(text='hello')
+
+    base = await server({'/': hello})
+    pool = website.session_pool()
+    session = pool.aiohttp_session()
+    assert pool.aiohttp_session() is session
+    for _ in range(3):
+        assert await website.load_page_aiohttp(base + '/', session=session) == b'hello'
+    assert len(set(peers)) == 1  # One kept-alive connection
+    client = pool.httpx_client()
+    assert pool.httpx_client() is client
+    for _ in range(2):
+        assert (await client.get(base + '/')).text == 'hello'
+    assert len(set(peers[3:])) == 1
+    await pool.close()
+    assert session.closed and client.is_closed
+    assert pool.aiohttp_session() is not session  # Recreated on next use
+    await pool.close()
+
+
+def test_session_pool_per_event_loop():
+    pool = website.session_pool()
+
+    async def get_session():
+        session = pool.aiohttp_session()
+        await pool.close()
+        return session
+
+    assert asyncio.run(get_session()) is not asyncio.run(get_session())
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_rate():
+    bucket = website.token_bucket(rate=20, burst=2)
+    start = time.monotonic()
+    for _ in range(6):
+        await bucket.acquire()
+    # 2 at once, then 4 more at 20/s
+    assert 0.18 <= time.monotonic() - start < 0.4
+
+
+@pytest.mark.asyncio
+async def test_load_pages_retries_and_failures(server):
+    hits = collections.Counter()
+
+    async def page(request):
+        n = request.match_info['n']
+        hits[n] += 1
+        if n == 'flaky' and hits[n] == 1:
+            return web.Response(status=503, headers={'Retry-After': '0'})
+        if n == 'missing':
+            return web.Response(status=404)
+        return web.Response(text=f'page {n}')
+
+    base = await server({'/{n}': page})
+    urls = [f'{base}/{n}' for n in ('1', '2', 'flaky', 'missing')]
+    async with aiohttp.ClientSession() as session:
+        results = {r.url.rsplit('/', 1)[1]: r async for r in load_pages(
+            urls, session=session, per_host_rate=None, backoff=0.01)}
+    assert results['1'].content == b'page 1' and results['1'].error is None
+    assert results['flaky'].content == b'page flaky' and results['flaky'].attempts == 2
+    assert results['missing'].status == 404 and results['missing'].content is None
+    assert isinstance(results['missing'].error, urllib.error.HTTPError)
+    assert hits['missing'] == 1  # 404 isn't retried
+
+
+@pytest.mark.asyncio
+async def test_load_pages_concurrency_and_host_rate(server):
+    in_flight = peak = 0
+    times = []
+
+    async def page(request):
+        nonlocal in_flight, peak
+        times.append(time.monotonic())
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.02)
+        in_flight -= 1
+        return web.Response(text='ok')
+
+    base = await server({'/{n}': page})
+    pulled = []
+
+    def urls():  # Pulled lazily, as slots free up
+        for n in range(12):
+            pulled.append(n)
+            yield f'{base}/{n}'
+
+    async with aiohttp.ClientSession() as session:
+        gen = load_pages(urls(), concurrency=3, per_host_rate=40, per_host_burst=3, session=session)
+        first = await anext(gen)
+        assert first.error is None and len(pulled) <= 4
+        rest = [r async for r in gen]
+    assert len(rest) == 11 and all(r.content == b'ok' for r in rest)
+    assert peak <= 3
+    # Burst of 3, then 9 more at 40/s
+    assert times[-1] - times[0] >= 9 / 40 * 0.9
+
+
+@pytest_asyncio.fixture
+async def browsers():
+    '''Started browser_pool factory; skips if playwright or its Chromium isn't installed'''
+    pytest.importorskip('playwright.async_api')
+    pytest.importorskip('playwright_stealth')
+    pools = []
+
+    async def start(**kwargs):
+        pool = website.browser_pool(**kwargs)
+        pools.append(pool)
+        try:
+            return await pool.start()
+        except Exception as e:  # e.g. browser binaries not downloaded
+            pytest.skip(f'Chromium not available: {e}')
+
+    yield start
+    for pool in pools:
+        await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_browser_pool_recycles_and_blocks(server, browsers):
+    requested = collections.Counter()
+
+    async def page(request):
+        requested['page'] += 1
+        return web.Response(text='<html><body><p>Hello</p><img src="/img.png"></body></html>',
+                            content_type='text/html')
+
+    async def image(request):
+        requested['image'] += 1
+        return web.Response(body=b'', content_type='image/png')
+
+    base = await server({'/': page, '/img.png': image})
+    pool = await browsers(size=1, pages_per_browser=2, page_budget=2)
+    first_browser = pool._slots[0].browser
+    contents = await asyncio.gather(*(website.load_page_playwright_stealth(base + '/', pool=pool)
+                                      for _ in range(3)))
+    assert all('<p>Hello</p>' in c for c in contents)
+    assert requested == {'page': 3}  # Images blocked
+    assert len(pool._slots) == 1 and pool._slots[0].browser is not first_browser  # Replaced after its budget
+
+
+@pytest.mark.asyncio
+async def test_browser_pool_not_started():
+    pytest.importorskip('playwright.async_api')
+    pytest.importorskip('playwright_stealth')
+    with pytest.raises(RuntimeError):
+        async with website.browser_pool().page():
+            pass
+
+
+@pytest.mark.asyncio
+async def test_http_cache_fresh_and_revalidated(server, tmp_path):
+    hits = collections.Counter()
+
+    async def fresh(request):
+        hits['fresh'] += 1
+        return web.Response(text='fresh', headers={'Cache-Control': 'max-age=60'})
+
+    async def etagged(request):
+        hits['etagged'] += 1
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304, headers={'ETag': '"v1"'})
+        return web.Response(text='etagged', headers={'ETag': '"v1"'})
+
+    async def private(request):
+        hits['private'] += 1
+        return web.Response(text='private', headers={'Cache-Control': 'no-store'})
+
+    base = await server({'/fresh': fresh, '/etagged': etagged, '/private': private})
+    cache = website.http_cache(tmp_path)
+    async with aiohttp.ClientSession() as session:
+        for _ in range(2):
+            for path in ('fresh', 'etagged', 'private'):
+                assert await website.load_page_aiohttp(f'{base}/{path}', session=session, cache=cache) == \
+                    path.encode()
+    assert hits == {'fresh': 1, 'etagged': 2, 'private': 2}  # Second etagged fetch was a 304
+    assert cache.get(f'{base}/private') is None
+
+
+@pytest.mark.asyncio
+async def test_http_cache_keyed_by_request_headers(server, tmp_path):
+    async def agent(request):
+        return web.Response(text=request.headers['User-Agent'], headers={'Cache-Control': 'max-age=60'})
+
+    base = await server({'/': agent})
+    cache = website.http_cache(tmp_path)
+    async with aiohttp.ClientSession() as session:
+        for _ in range(2):
+            for ua in ('bot-a', 'bot-b'):
+                content = await website.load_page_aiohttp(base + '/', user_agent=ua, session=session, cache=cache)
+                assert content == ua.encode()
+        results = [r async for r in load_pages([base + '/'], user_agent='bot-a', session=session, cache=cache)]
+    assert results[0].content == b'bot-a' and results[0].attempts == 0  # Served from the cache
+    assert cache.key(base + '/', {'User-Agent': 'x'}) == cache.key(base + '/', {'user-agent': 'x'})
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_http_cache_evicts_lru(tmp_path, compression):
+    cache = website.http_cache(tmp_path, compression=compression)
+    urls = [f'https://example.com/{n}' for n in range(4)]
+    for n, url in enumerate(urls):
+        cache.put(url, 200, {'Cache-Control': 'max-age=60'}, b'x' * 1000)
+        os.utime(cache._paths(cache.key(url))[0], (n, n))
+    assert cache.get(urls[0]).body == b'x' * 1000  # Now the most recently used
+    kept = [cache.key(u) for u in (urls[0], urls[3])]
+    cache.max_bytes = sum(f.stat().st_size for k in kept for f in cache._paths(k))
+    cache.evict()
+    assert [cache.get(u) is not None for u in urls] == [True, False, False, True]
+    assert sorted(p.name for p in tmp_path.glob('*/*')) == sorted(p.name for k in kept for p in cache._paths(k))
+
+
+MARKDOWN_PAGE = '''<nav>Menu</nav><script>x()</script><h2>Title</h2>
+<p>Some <a href="/x">linked</a>, <a href="javascript:void(0)">js</a> <strong>bold</strong> <em>it</em> <code>c</code>
+text</p><ul><li>one</li><li>two<ol><li>a</li><li>b</li></ol></li></ul><blockquote><p>q1</p><p>q2</p></blockquote>
+<pre>x  y
+ z</pre><img src="i.png" alt="pic"><hr><table><tr><th>h1</th><th>h2</th></tr><tr><td>d1</td><td>d2</td></tr></table>
+line<br>break'''
+
+EXPECTED_MARKDOWN = '''## Title
+
+Some [linked](/x), js **bold** *it* `c` text
+
+- one
+- two
+  1. a
+  2. b
+
+> q1
+>
+> q2
+
+```
+x  y
+ z
+```
+
+![pic](i.png)
+
+---
+
+| h1 | h2 |
+| --- | --- |
+| d1 | d2 |
+
+line
+break
+'''
+
+
+@needs_selectolax
+def test_html_to_markdown():
+    assert website.html_to_markdown(MARKDOWN_PAGE) == EXPECTED_MARKDOWN
+    assert website.html_to_markdown(MARKDOWN_PAGE.encode()) == EXPECTED_MARKDOWN
+    assert website.html_to_markdown(website._html_parser()(MARKDOWN_PAGE)) == EXPECTED_MARKDOWN
+    # drop_tags overrides the default boilerplate list
+    assert website.html_to_markdown('<nav>Menu</nav><p>x</p>', drop_tags=()) == 'Menu\n\nx\n'
+
+
+@needs_selectolax
+def test_iter_markdown_chunks_and_deep_nesting():
+    html = ''.join(f'<p>paragraph {n}</p>' for n in range(2000))
+    pieces = list(website.iter_markdown(html, chunk_size=1000))
+    assert len(pieces) > 10 and all(len(p) < 1100 for p in pieces)
+    assert ''.join(pieces) == website.html_to_markdown(html)
+    # Nesting far beyond the recursion limit
+    deep = '<div>' * 5000 + 'deep' + '</div>' * 5000
+    assert website.html_to_markdown(deep) == 'deep\n'
+
+
+
+ANCHORED_PAGE = '''<html><head><title>Doc</title></head><body><p>Intro  text
+ here</p><a name="s1"></a><h2>One</h2><p>First <b>bold</b></p><a name="empty"></a><a name="s2">Two</a>\
+<script>var x;</script><p>End</p></body></html>'''
+
+
+@needs_selectolax
+def test_chunk_by_anchor_matches_baseline(capsys):
+    # Output of the original implementation (selectolax's Modest parser) on the same page: raw text, whitespace,
+    # head & scripts included, & empty sections kept
+    assert website.chunk_by_anchor(ANCHORED_PAGE) == {
+        '!head': 'DocIntro  text\n here', 's1': 'OneFirst bold', 'empty': '', 's2': 'Twovar x;End'}
+    assert capsys.readouterr().out == ''  # No progress printing
+
+
+@needs_selectolax
+def test_chunk_html_sections():
+    html = '''<nav>Menu</nav><h1 id="top">Guide</h1><p>Intro.</p><h2>Install</h2><p>Run pip.</p>
+<section id="usage"><h2>Usage</h2><ul><li>Import it</li><li>Call it</li></ul></section><a name="faq"></a><p>Ask.</p>'''
+    chunks = list(website.chunk_html(html))
+    assert [(c.text, c.breadcrumbs, c.anchor) for c in chunks] == [
+        ('Guide\nIntro.', ['Guide'], 'top'),
+        ('Install\nRun pip.', ['Guide', 'Install'], None),  # Heading without an id
+        ('Usage\nImport it\nCall it', ['Guide', 'Usage'], 'usage'),
+        ('Ask.', ['Guide', 'Usage'], 'faq'),
+    ]
+    assert [c.index for c in chunks] == [0, 1, 2, 3]
+    # Fewer split points, fewer chunks
+    assert len(list(website.chunk_html(html, split_on=('heading',)))) == 3
+
+
+@needs_selectolax
+def test_chunk_html_token_budget_and_overlap():
+    html = '<p>' + ' '.join(f'w{n}' for n in range(100)) + '</p>'
+    chunks = list(website.chunk_html(html, max_tokens=20, overlap=5, count_tokens=lambda word: 1))
+    assert all(c.tokens <= 20 for c in chunks)
+    assert chunks[0].text.split() == [f'w{n}' for n in range(20)]
+    assert chunks[1].text.split()[:5] == [f'w{n}' for n in range(15, 20)]  # Carried over
+    assert chunks[-1].text.split()[-1] == 'w99'
+    with pytest.raises(ValueError):
+        website.chunk_html(html, max_tokens=10, overlap=10)  # Raised on the call, not on first iteration
+    assert len(list(website.chunk_html(html, max_tokens=None, overlap=500))) == 1
+
+
+@needs_selectolax
+def test_extract_text():
+    html = '''<head><title>Shop</title></head><nav>Home | Cart</nav><h1>Products</h1>
+<p>The <strong>best</strong>   records, <a href="/r/1">Skratch  Vol. 1</a> for <em>$20</em></p>
+<ul><li>Vinyl</li><li>CD</li></ul><form><button>Add to cart</button></form>
+<table><tr><td>a</td><td>b</td></tr></table>'''
+    assert website.extract_text(html) == (
+        'Products\n\nThe best records, [Skratch Vol. 1](/r/1) for $20\n\n- Vinyl\n- CD\n\na b\n')
+    assert website.extract_text(html, links=False).splitlines()[2] == 'The best records, Skratch Vol. 1 for $20'
+    # Nav, form & button text is dropped by default, but can be kept
+    kept = website.extract_text(html, drop_tags=('head', 'script', 'style'))
+    assert 'Home | Cart' in kept and 'Add to cart' in kept
+
+
+def test_lazy_module_attributes():
+    # Formerly eager imports are still reachable as module attributes, imported on first access
+    import aiohttp as aiohttp_module
+    assert website.aiohttp is aiohttp_module
+    if website._available('markdownify'):
+        from markdownify import markdownify
+        assert website.md is markdownify
+    if website._available('selectolax'):
+        assert website.HTMLParser is website._html_parser()
+    if not website._available('playwright'):
+        assert website.async_playwright is None
+    with pytest.raises(AttributeError):
+        website.no_such_name
+    assert not hasattr(website, 'no_such_name')
+
+
+def test_import_stays_lazy():
+    # Importing the module doesn't import its heavy optional dependencies
+    code = ('import sys; import arkestra.components.website; '
+            'print([m for m in ("aiohttp", "httpx", "markdownify", "selectolax", "playwright") if m in sys.modules])')
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    assert out.strip() == '[]'